@@ -0,0 +1,132 @@
+def _encode(value):
+    if isinstance(value, bytes):
+        return value
+    return str(value).encode()
+
+
+class FakeRedis:
+    """
+    In-memory stand-in for the redis client of the engine,
+    only the commands the engine uses.
+    Counts round trips: every command or pipeline execute is one.
+    """
+
+    def __init__(self):
+        self.data = {}
+        self.round_trips = 0
+
+    def _call(self):
+        self.round_trips += 1
+
+    def get(self, key):
+        self._call()
+        return self.data.get(key)
+
+    def set(self, key, value, ex=None, px=None):
+        # expiry is not kept
+        self._call()
+        self.data[key] = _encode(value)
+        return True
+
+    def mget(self, keys):
+        self._call()
+        return [self.data.get(key) for key in keys]
+
+    def delete(self, *keys):
+        self._call()
+        return sum(self.data.pop(key, None) is not None for key in keys)
+
+    def incrbyfloat(self, key, amount):
+        self._call()
+        value = float(self.data.get(key, b'0')) + float(amount)
+        self.data[key] = _encode(repr(value))
+        return value
+
+    def hget(self, name, key):
+        self._call()
+        return self.data.get(name, {}).get(_encode(key))
+
+    def hset(self, name, key, value):
+        self._call()
+        self.data.setdefault(name, {})[_encode(key)] = _encode(value)
+        return 1
+
+    def hdel(self, name, *keys):
+        self._call()
+        fields = self.data.get(name, {})
+        return sum(fields.pop(_encode(key), None) is not None for key in keys)
+
+    def hkeys(self, name):
+        self._call()
+        return list(self.data.get(name, {}))
+
+    def hgetall(self, name):
+        self._call()
+        return dict(self.data.get(name, {}))
+
+    def zadd(self, name, mapping):
+        self._call()
+        self.data.setdefault(name, {}).update(
+            {_encode(member): score for member, score in mapping.items()}
+        )
+
+    def _zsorted(self, name):
+        return sorted(self.data.get(name, {}).items(),
+                      key=lambda item: item[1])
+
+    def zrangebyscore(self, name, start, end):
+        self._call()
+        start = float('-inf') if start in ('-inf', None) else float(start)
+        end = float('inf') if end in ('+inf', None) else float(end)
+        return [member for member, score in self._zsorted(name)
+                if start <= score <= end]
+
+    def zrevrange(self, name, start, end):
+        self._call()
+        members = [member for member, _ in reversed(self._zsorted(name))]
+        return members[start:None if end == -1 else end + 1]
+
+    def zremrangebyscore(self, name, start, end):
+        self._call()
+        members = self.data.get(name, {})
+        for member, score in list(members.items()):
+            if start <= score <= end:
+                del members[member]
+
+    def zremrangebyrank(self, name, start, end):
+        self._call()
+        members = self._zsorted(name)
+        end = len(members) + end if end < 0 else end
+        for member, _ in members[start:end + 1]:
+            del self.data[name][member]
+
+    def pipeline(self):
+        return FakePipeline(self)
+
+
+class FakePipeline:
+    """Commands are applied at execute, as one round trip"""
+
+    def __init__(self, redis):
+        self.redis = redis
+        self.commands = []
+
+    def __getattr__(self, command):
+        def queue(*args, **kwargs):
+            self.commands.append((command, args, kwargs))
+            return self
+        return queue
+
+    def execute(self):
+        round_trips = self.redis.round_trips
+        result = [getattr(self.redis, command)(*args, **kwargs)
+                  for command, args, kwargs in self.commands]
+        self.redis.round_trips = round_trips + 1
+        self.commands = []
+        return result
+
+
+def patch_redis(fake):
+    """Inject the fake as the redis client of the engine modules"""
+    from orders.order_matching_engine.utils import r
+    r.set_connection(fake)
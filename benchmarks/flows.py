@@ -0,0 +1,114 @@
+"""
+Synthetic order flows.
+
+A flow is a generator of messages in the form SocketHandler passes
+them to the engine: new orders and {"order_id", "cancelled": True}.
+Prices are kept on a tick grid around a mid price.
+"""
+import random
+from _decimal import Decimal
+
+
+TICK = Decimal('0.001')
+
+
+class OrderFlow:
+    def __init__(self, pair='BTC_ETH', seed=0, users=100):
+        self.pair = pair
+        self.random = random.Random(seed)
+        self.users = users
+        self.order_id = 0
+        self.timestamp = 1500000000.0
+        self.live = []      # ids of orders that may still rest
+
+    def user(self):
+        return self.random.randint(1, self.users)
+
+    def order(self, side, order_type, price, quantity, user_id=None, **extra):
+        self.order_id += 1
+        self.timestamp += 0.001
+        quote = {
+            'order_id': self.order_id,
+            'user_id': user_id or self.user(),
+            'pair': self.pair, 'side': side, 'order_type': order_type,
+            'price': str(price), 'quantity': str(quantity),
+            'initial_quantity': str(quantity),
+            'timestamp': self.timestamp,
+        }
+        quote.update(extra)
+        if order_type != 'market':
+            self.live.append(self.order_id)
+        return quote
+
+    def limit(self, mid, spread=50, user_id=None):
+        side = self.random.choice(('bid', 'ask'))
+        offset = self.random.randint(1, spread) * TICK
+        price = mid - offset if side == 'bid' else mid + offset
+        quantity = Decimal(self.random.randint(1, 100)) / 10
+        return self.order(side, 'limit', price, quantity, user_id)
+
+    def market(self, quantity=None, user_id=None):
+        side = self.random.choice(('bid', 'ask'))
+        quantity = quantity or Decimal(self.random.randint(1, 50)) / 10
+        return self.order(side, 'market', 0, quantity, user_id)
+
+    def cancel(self):
+        if not self.live:
+            return None
+        index = self.random.randrange(len(self.live))
+        self.live[index], self.live[-1] = self.live[-1], self.live[index]
+        self.timestamp += 0.001
+        return {'order_id': self.live.pop(), 'timestamp': self.timestamp,
+                'cancelled': True}
+
+    def walk(self, mid):
+        return max(mid + self.random.choice((-1, 0, 1)) * TICK, 100 * TICK)
+
+
+def random_walk(flow, count, mid=Decimal(1)):
+    """Limit orders around a drifting mid, 5% market orders"""
+    for _ in range(count):
+        mid = flow.walk(mid)
+        if flow.random.random() < 0.05:
+            yield flow.market()
+        else:
+            yield flow.limit(mid)
+
+
+def cancel_heavy(flow, count, mid=Decimal(1)):
+    """Market makers requoting: 70% of messages are cancels"""
+    for _ in range(count):
+        mid = flow.walk(mid)
+        quote = flow.cancel() if flow.random.random() < 0.7 else None
+        yield quote or flow.limit(mid, spread=20)
+
+
+def sweep_heavy(flow, count, mid=Decimal(1)):
+    """Large market orders taking many levels, the book is refilled"""
+    for i in range(count):
+        if i % 20 == 19:
+            yield flow.market(quantity=Decimal(flow.random.randint(50, 300)))
+        else:
+            yield flow.limit(mid, spread=200)
+
+
+def deep_book(flow, count, mid=Decimal(1)):
+    """Resting orders spread over 2000 levels each side (warm up)"""
+    for _ in range(count):
+        yield flow.limit(mid, spread=2000)
+
+
+def self_trade(flow, count, mid=Decimal(1)):
+    """Random walk of a few users, so many orders meet their own"""
+    flow.users = 3
+    yield from random_walk(flow, count, mid)
+
+
+# name: (warm up flow, number of warm up messages, measured flow)
+SCENARIOS = {
+    'random_walk': (random_walk, 1000, random_walk),
+    'cancel_heavy': (random_walk, 1000, cancel_heavy),
+    'sweep_heavy': (sweep_heavy, 1000, sweep_heavy),
+    'deep_book': (deep_book, 20000, random_walk),
+    'self_trade': (self_trade, 1000, self_trade),
+}
@@ -0,0 +1,81 @@
+"""
+Import time of the engine modules.
+
+Every module is imported in a fresh interpreter, the best of --repeat
+runs is reported with the number of modules it loaded and whether
+Django came with it. Core modules must not load Django, the run fails
+(exit status 1) if one does or takes more than --max-ms.
+
+    python -m orders.benchmarks.import_time
+    python -m orders.benchmarks.import_time --modules ordertree order_book
+"""
+import argparse
+import json
+import os
+import subprocess
+import sys
+
+
+PACKAGE = 'orders.order_matching_engine'
+# pure data structures, importable without Django and redis
+CORE = ('ordertree', 'orderlist', 'order', 'level_sums', 'stop_index',
+        'timing_wheel', 'heapq_with_removal')
+
+PROBE = """
+import json, sys, time
+before = set(sys.modules)
+start = time.perf_counter()
+import {module}
+elapsed = time.perf_counter() - start
+loaded = set(sys.modules) - before
+print(json.dumps({{
+    "ms": elapsed * 1000, "modules": len(loaded),
+    "django": any(name == "django" or name.startswith("django.")
+                  for name in loaded),
+}}))
+"""
+
+
+def measure(module, repeat):
+    env = dict(os.environ, PYTHONPATH=os.pathsep.join(sys.path))
+    runs = []
+    for _ in range(repeat):
+        process = subprocess.run(
+            [sys.executable, '-c', PROBE.format(module=module)], env=env,
+            stdout=subprocess.PIPE, stderr=subprocess.PIPE
+        )
+        if process.returncode:
+            error = process.stderr.decode().strip().splitlines()
+            return {'error': error[-1] if error else process.returncode}
+        runs.append(json.loads(process.stdout.decode().splitlines()[-1]))
+    return min(runs, key=lambda run: run['ms'])
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--modules', nargs='+', default=list(CORE) + [''],
+                        help="modules of the engine package, '' - the "
+                             "package itself")
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--max-ms', type=float, default=50)
+    args = parser.parse_args(argv)
+
+    failed = False
+    for name in args.modules:
+        module = f"{PACKAGE}.{name}" if name else PACKAGE
+        result = measure(module, args.repeat)
+        core = name in CORE or not name
+        if 'error' in result:
+            failed = failed or core
+            print(f"{module:45} {result['error']}")
+            continue
+        bad = core and (result['django'] or result['ms'] > args.max_ms)
+        failed = failed or bad
+        print(f"{module:45} {result['ms']:8.2f} ms {result['modules']:5} "
+              f"modules{'   django' if result['django'] else ''}"
+              f"{'   FAIL' if bad else ''}")
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,339 @@
+"""
+End-to-end load of the order pipeline: HTTP API -> engine -> DB writer.
+
+Drives CreateOrderView, CancelOrderView and EditOrderView of a local
+stack (runserver/gunicorn, redis, Postgres, the engine daemon) with a
+closed loop of --stages concurrent clients per pair, each stage for
+--duration seconds. Every --sample-th created order is followed in RDB:
+end-to-end latency is from sending the request to closed_at of the
+order (completed or cancelled by the DB writer), so the load generator
+has to run on the same host as the stack (same clock) with its Django
+settings. The saturation point is the stage after which throughput
+grows less than --min-gain.
+
+    python -m orders.benchmarks.load_generator --pairs BTC_ETH \\
+        --users 1-50 --fund 1000000 --stages 1 2 4 8 16 32
+    python -m orders.benchmarks.load_generator --mix limit=80,market=20 \\
+        --output load.json
+"""
+import argparse
+import http.client
+import json
+import random
+import sys
+import time
+from _decimal import Decimal
+from threading import Thread, Lock
+from urllib.parse import urlsplit
+
+from .flows import TICK
+from .run import percentiles
+
+
+MIX = 'limit=55,market=15,cancel=20,edit=10'
+# paths of the views at the project's urls
+PATHS = {
+    'create': '/orders/create/',
+    'cancel': '/orders/cancel/',
+    'edit': '/orders/edit/',
+}
+
+
+def parse_mix(text):
+    """'limit=55,market=15' -> (('limit', 'market'), (55, 15))"""
+    kinds, weights = [], []
+    for item in text.split(','):
+        kind, weight = item.split('=')
+        if kind not in ('limit', 'market', 'cancel', 'edit'):
+            raise ValueError(f"unknown kind of request {kind}")
+        kinds.append(kind)
+        weights.append(float(weight))
+    return tuple(kinds), tuple(weights)
+
+
+def parse_users(text):
+    """'1-50' or '1,2,7'"""
+    if '-' in text:
+        first, last = text.split('-')
+        return list(range(int(first), int(last) + 1))
+    return [int(user_id) for user_id in text.split(',')]
+
+
+class Client:
+    """Keep-alive connection of a worker, reconnects after errors"""
+
+    def __init__(self, url, timeout):
+        parts = urlsplit(url)
+        self.host = parts.hostname
+        self.port = parts.port
+        self.prefix = parts.path.rstrip('/')
+        self.timeout = timeout
+        self.connection = None
+
+    def post(self, path, data):
+        """:return: status (0 - connection error), dict of the response"""
+        if self.connection is None:
+            self.connection = http.client.HTTPConnection(
+                self.host, self.port, timeout=self.timeout
+            )
+        try:
+            self.connection.request(
+                'POST', self.prefix + path, json.dumps(data),
+                {'Content-Type': 'application/json'}
+            )
+            response = self.connection.getresponse()
+            body = response.read()
+        except (OSError, http.client.HTTPException):
+            self.connection.close()
+            self.connection = None
+            return 0, {}
+        try:
+            return response.status, json.loads(body or b'{}')
+        except ValueError:
+            return response.status, {}
+
+
+class Stage:
+    """
+    Requests of one pair at one concurrency
+    :param live: ids of created orders that may still be open, shared
+                 between the stages of the pair
+    """
+
+    def __init__(self, args, pair, concurrency, live, seed):
+        self.args = args
+        self.pair = pair
+        self.concurrency = concurrency
+        self.live = live
+        self.random = random.Random(seed)
+        self.kinds, self.weights = parse_mix(args.mix)
+        self.users = parse_users(args.users)
+        self.lock = Lock()
+        self.latencies = {}     # kind: [ns]
+        self.errors = {}        # kind: count
+        self.busy = {}          # kind: count of 503 answers
+        self.samples = {}       # order_id: sent at, wall clock
+        self.created = 0
+        self.deadline = None
+
+    def quote(self, kind):
+        side = self.random.choice(('bid', 'ask'))
+        quantity = Decimal(self.random.randint(1, 100)) / 10
+        quote = {
+            'user_id': self.random.choice(self.users), 'pair': self.pair,
+            'side': side, 'order_type': kind, 'quantity': str(quantity),
+        }
+        if kind == 'limit':
+            ticks = self.random.randint(1, self.args.spread)
+            if self.random.random() < self.args.cross:
+                ticks = -ticks  # crosses the mid, usually matched at once
+            offset = ticks * TICK
+            mid = Decimal(self.args.mid)
+            quote['price'] = str(mid - offset if side == 'bid'
+                                 else mid + offset)
+        return quote
+
+    def request(self, client):
+        with self.lock:
+            kind = self.random.choices(self.kinds, self.weights)[0]
+            order_id = None
+            if kind in ('cancel', 'edit'):
+                if not self.live:
+                    kind = 'limit'
+                else:
+                    index = self.random.randrange(len(self.live))
+                    self.live[index], self.live[-1] = \
+                        self.live[-1], self.live[index]
+                    order_id = self.live.pop()
+            quote = self.quote(kind) if order_id is None else None
+        if kind == 'cancel':
+            path, data = PATHS['cancel'], {'order_id': order_id,
+                                           'pair': self.pair}
+        elif kind == 'edit':
+            path, data = PATHS['edit'], {
+                'order_id': order_id, 'pair': self.pair,
+                'edited_quantity': str(
+                    Decimal(self.random.randint(1, 100)) / 10
+                ),
+            }
+        else:
+            path, data = PATHS['create'], quote
+        sent = time.time()
+        start = time.perf_counter_ns()
+        status, response = client.post(path, data)
+        elapsed = time.perf_counter_ns() - start
+        created = response.get('order_id') if kind in ('limit', 'market') \
+            else None
+        with self.lock:
+            if status == 503:
+                # shed by the engine (admission control), not an error
+                self.busy[kind] = self.busy.get(kind, 0) + 1
+                if order_id is not None:
+                    self.live.append(order_id)
+                return
+            if status != 200 or (kind in ('limit', 'market') and
+                                 not created):
+                self.errors[kind] = self.errors.get(kind, 0) + 1
+                return
+            self.latencies.setdefault(kind, []).append(elapsed)
+            if created:
+                self.created += 1
+                if kind == 'limit':
+                    self.live.append(created)
+                if self.created % self.args.sample == 0:
+                    self.samples[created] = sent
+
+    def worker(self):
+        client = Client(self.args.url, self.args.timeout)
+        while time.monotonic() < self.deadline:
+            self.request(client)
+
+    def run(self):
+        self.deadline = time.monotonic() + self.args.duration
+        started = time.perf_counter()
+        workers = [Thread(target=self.worker, daemon=True)
+                   for _ in range(self.concurrency)]
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()
+        self.seconds = time.perf_counter() - started
+
+    def lifecycle(self, settle_timeout):
+        """
+        Wait until the sampled orders are closed in RDB or settle_timeout
+        passes, resting limit orders stay pending
+        :return: end-to-end latency of the closed ones, seconds
+        """
+        from orders.models import Order
+        deadline = time.monotonic() + settle_timeout
+        closed = {}
+        while True:
+            rows = Order.objects.filter(
+                pk__in=list(self.samples), closed_at__isnull=False
+            ).values_list('pk', 'status', 'closed_at')
+            closed = {pk: (status, closed_at.timestamp() - self.samples[pk])
+                      for pk, status, closed_at in rows}
+            if len(closed) == len(self.samples) or \
+                    time.monotonic() > deadline:
+                return closed
+            time.sleep(0.5)
+
+    def report(self, settle_timeout):
+        requests = sum(map(len, self.latencies.values()))
+        result = {
+            'concurrency': self.concurrency,
+            'requests': requests,
+            'throughput': requests / self.seconds,
+            'errors': dict(self.errors),
+            'busy': dict(self.busy),
+            'http_latency_us': {kind: percentiles(latencies)
+                                for kind, latencies in self.latencies.items()},
+            'sampled': len(self.samples),
+        }
+        closed = self.lifecycle(settle_timeout)
+        statuses = {}
+        for status, seconds in closed.values():
+            statuses[status] = statuses.get(status, 0) + 1
+        result['closed'] = statuses
+        result['pending'] = len(self.samples) - len(closed)
+        if closed:
+            # percentiles takes ns and reports us, end-to-end is in ms
+            e2e = percentiles([seconds * 10 ** 6
+                               for status, seconds in closed.values()])
+            result['end_to_end_ms'] = e2e
+        return result
+
+
+def saturation(stages, min_gain):
+    """
+    :return: concurrency after which throughput stopped growing by
+             min_gain, None - it never stopped
+    """
+    for previous, stage in zip(stages, stages[1:]):
+        if stage['throughput'] < previous['throughput'] * (1 + min_gain):
+            return previous['concurrency']
+    return None
+
+
+def fund(users, pairs, amount):
+    """Add amount to the active assets of the users at redis"""
+    from orders.order_matching_engine.storage import redis_balances
+    currencies = {curr for pair in pairs for curr in pair.split('_')}
+    redis_balances.change({('active', curr, user_id): Decimal(amount)
+                           for curr in currencies for user_id in users})
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--url', default='http://localhost:8000')
+    parser.add_argument('--pairs', nargs='+', default=['BTC_ETH'])
+    parser.add_argument('--users', default='1-10',
+                        help="existing users with wallets: 1-50 or 1,2,7")
+    parser.add_argument('--fund', help="add to active assets of the users "
+                                       "at redis before the run")
+    parser.add_argument('--mix', default=MIX,
+                        help="weights of limit, market, cancel, edit")
+    parser.add_argument('--mid', default='1')
+    parser.add_argument('--spread', type=int, default=50,
+                        help="ticks of limit prices from the mid")
+    parser.add_argument('--cross', type=float, default=0.3,
+                        help="share of limit orders priced over the mid")
+    parser.add_argument('--stages', nargs='+', type=int,
+                        default=[1, 2, 4, 8, 16, 32, 64],
+                        help="concurrent clients of every stage")
+    parser.add_argument('--duration', type=float, default=20,
+                        help="seconds of every stage")
+    parser.add_argument('--sample', type=int, default=10,
+                        help="follow every Nth created order in RDB")
+    parser.add_argument('--settle-timeout', type=float, default=30,
+                        help="seconds to wait for sampled orders to close")
+    parser.add_argument('--timeout', type=float, default=10,
+                        help="seconds of a HTTP request")
+    parser.add_argument('--min-gain', type=float, default=0.1)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', help="write results as json")
+    args = parser.parse_args(argv)
+
+    from orders.order_matching_engine.utils import setup_django
+    setup_django()
+    if args.fund:
+        fund(parse_users(args.users), args.pairs, args.fund)
+
+    results = {'meta': {'time': time.time(), 'args': vars(args)},
+               'pairs': {}}
+    for pair in args.pairs:
+        live = []
+        stages = []
+        for number, concurrency in enumerate(args.stages):
+            stage = Stage(args, pair, concurrency, live,
+                          f"{args.seed}_{pair}_{number}")
+            stage.run()
+            result = stage.report(args.settle_timeout)
+            stages.append(result)
+            e2e = result.get('end_to_end_ms', {})
+            print(f"{pair:8} x{concurrency:<4} {result['throughput']:8.0f} "
+                  f"req/s   errors {sum(result['errors'].values()):5}   "
+                  f"busy {sum(result['busy'].values()):5}   "
+                  f"e2e p50 {e2e.get('p50', 0):8.1f}ms   "
+                  f"p99 {e2e.get('p99', 0):8.1f}ms   "
+                  f"pending {result['pending']}")
+        saturated = saturation(stages, args.min_gain)
+        results['pairs'][pair] = {
+            'stages': stages,
+            'saturated_at': saturated,
+            'max_throughput': max(stage['throughput'] for stage in stages),
+        }
+        print(f"{pair:8} saturates at "
+              f"{saturated if saturated else 'more than ' + str(args.stages[-1])}"
+              f" clients, max {results['pairs'][pair]['max_throughput']:.0f}"
+              f" req/s")
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+    return results
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
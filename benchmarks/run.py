@@ -0,0 +1,227 @@
+"""
+Matching engine benchmark.
+
+Runs OrderBook.process_order in-process over synthetic order flows
+(benchmarks.flows) with redis replaced by an in-memory fake and the DB
+writer by the in-memory persistence, so only the engine itself is
+measured. --backend memory keeps orders and balances in the in-memory
+stores too (pure matching speed). One iteration is what
+OrderBook.run does per message: the order, triggered stops, expiries
+and market data publishing.
+
+    python -m orders.benchmarks --count 20000 --output before.json
+    python -m orders.benchmarks --compare before.json --output after.json
+    python -m orders.benchmarks --low-latency-gc --compare after.json
+    python -m orders.benchmarks --backend memory
+    python -m orders.benchmarks --self-trade-prevention none
+"""
+import argparse
+import gc
+import json
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+from collections import Counter
+
+from .fakes import FakeRedis, patch_redis
+from .flows import OrderFlow, SCENARIOS
+
+
+PERCENTILES = (('p50', 0.5), ('p90', 0.9), ('p99', 0.99), ('p999', 0.999))
+
+
+def make_book(pair, directory, users, backend='redis'):
+    from orders.order_matching_engine.order_book import OrderBook
+    from orders.order_matching_engine.storage import (
+        Backends, InMemoryPersistence, memory_backends, redis_balances,
+        redis_orders
+    )
+    redis = FakeRedis()
+    patch_redis(redis)
+    if backend == 'memory':
+        backends = memory_backends()
+    else:
+        backends = Backends(redis_orders, redis_balances,
+                            InMemoryPersistence())
+    backends.balances.change({
+        ('active', curr, user_id): 1000000000000
+        for curr in pair.split('_') for user_id in range(1, users + 1)
+    })
+    book = OrderBook(pair, backends)
+    book.trade_log.path = os.path.join(directory, f"{pair}_trades.bin")
+    book.trade_log.open()
+    book.expiries.start(time.time())
+    return book, redis
+
+
+def host(book, redis, quote):
+    """
+    What the API does before sending an order: the redis hash
+    (not counted as round trips of the engine)
+    """
+    from orders.order_matching_engine.storage import InMemoryOrderStore
+    if quote.get('cancelled'):
+        return
+    if isinstance(book.orders, InMemoryOrderStore):
+        book.orders.update(quote['order_id'], quote)
+        return
+    redis.data[f"order_{quote['order_id']}"] = {
+        key.encode(): str(value).encode() for key, value in quote.items()
+    }
+
+
+def step(book, quote):
+    book.process_order(quote)
+    while book.heap_queue.size():
+        priority, timestamp, quote = book.heap_queue.get()
+        book.process_order(quote)
+    book.expire_orders()
+    book.depth.mark_dirty()
+    book.publish_market_data()
+    book.gc.tick()
+
+
+def percentiles(latencies):
+    latencies = sorted(latencies)
+    result = {name: latencies[min(len(latencies) - 1,
+                                  int(len(latencies) * q))] / 1000
+              for name, q in PERCENTILES}
+    result['max'] = latencies[-1] / 1000
+    return result
+
+
+def run_scenario(name, count, seed, pair, users=100, low_latency_gc=False,
+                 backend='redis', self_trade_prevention=None):
+    from orders.order_matching_engine.histogram import Histogram
+    warm_up, warm_up_count, measured = SCENARIOS[name]
+    with tempfile.TemporaryDirectory() as directory:
+        book, redis = make_book(pair, directory, users, backend)
+        book.gc.low_latency = low_latency_gc
+        if self_trade_prevention:
+            book.self_trade_prevention = self_trade_prevention
+        book.gc.install()
+        flow = OrderFlow(pair, seed, users)
+        for quote in warm_up(flow, warm_up_count):
+            host(book, redis, quote)
+            step(book, quote)
+        # the warm up book plays the part of fill_book
+        book.gc.after_load()
+        book.gc.pauses = Histogram()
+        trades = book.trade_log.count
+        round_trips = redis.round_trips
+        writer = Counter(book.persistence.commands)
+
+        latencies = []
+        started = time.perf_counter()
+        for quote in measured(flow, count):
+            host(book, redis, quote)
+            start = time.perf_counter_ns()
+            step(book, quote)
+            latencies.append(time.perf_counter_ns() - start)
+        elapsed = time.perf_counter() - started
+
+        writer = book.persistence.commands - writer
+        result = {
+            'messages': count,
+            'seconds': elapsed,
+            'throughput': count / elapsed,
+            'latency_us': percentiles(latencies),
+            'trades': book.trade_log.count - trades,
+            'resting_orders': len(book.bids) + len(book.asks),
+            'redis_round_trips_per_message':
+                (redis.round_trips - round_trips) / count,
+            'writer_commands_per_message': sum(writer.values()) / count,
+            'writer_commands': dict(writer),
+            'gc_pause_us': book.gc.pauses.summary(),
+        }
+        book.gc.uninstall()
+        gc.unfreeze()
+        gc.enable()
+        book.trade_log.close()
+    return result
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(
+            ['git', 'rev-parse', '--short', 'HEAD'],
+            cwd=os.path.dirname(os.path.abspath(__file__)),
+            stderr=subprocess.DEVNULL
+        ).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare(previous, current):
+    for name, result in current['scenarios'].items():
+        before = previous['scenarios'].get(name)
+        if not before:
+            continue
+        throughput = (result['throughput'] / before['throughput'] - 1) * 100
+        p99 = (result['latency_us']['p99'] /
+               before['latency_us']['p99'] - 1) * 100
+        print(f"{name:14} throughput {throughput:+7.1f}%   p99 {p99:+7.1f}%")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--scenarios', nargs='+', default=list(SCENARIOS),
+                        choices=list(SCENARIOS))
+    parser.add_argument('--count', type=int, default=20000)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--pair', default='BTC_ETH')
+    parser.add_argument('--output', help="write results as json")
+    parser.add_argument('--compare', help="json of a previous run")
+    parser.add_argument('--backend', choices=('redis', 'memory'),
+                        default='redis',
+                        help="order and balance stores of the engine")
+    parser.add_argument('--low-latency-gc', action='store_true',
+                        help="freeze the warm up book and defer collection "
+                             "(settings.LOW_LATENCY_GC)")
+    parser.add_argument('--self-trade-prevention',
+                        choices=('none', 'cancel_newest', 'cancel_oldest',
+                                 'decrement_both'),
+                        help="mode of the orders without their own "
+                             "(settings.SELF_TRADE_PREVENTION)")
+    args = parser.parse_args(argv)
+
+    results = {
+        'meta': {
+            'commit': git_commit(),
+            'python': platform.python_version(),
+            'time': time.time(),
+            'count': args.count,
+            'seed': args.seed,
+            'low_latency_gc': args.low_latency_gc,
+            'backend': args.backend,
+            'self_trade_prevention': args.self_trade_prevention,
+        },
+        'scenarios': {},
+    }
+    for name in args.scenarios:
+        result = run_scenario(name, args.count, args.seed, args.pair,
+                              low_latency_gc=args.low_latency_gc,
+                              backend=args.backend,
+                              self_trade_prevention=args.self_trade_prevention)
+        results['scenarios'][name] = result
+        latency = result['latency_us']
+        gc_pause = result['gc_pause_us']
+        print(f"{name:14} {result['throughput']:10.0f} msg/s   "
+              f"p50 {latency['p50']:8.1f}us   p99 {latency['p99']:8.1f}us   "
+              f"p999 {latency['p999']:8.1f}us   trades {result['trades']}   "
+              f"gc {gc_pause['count']} pauses, max {gc_pause['max']:.0f}us")
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+    if args.compare:
+        with open(args.compare) as f:
+            compare(json.load(f), results)
+    return results
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
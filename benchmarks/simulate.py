@@ -0,0 +1,138 @@
+"""
+Simulation of a quoting strategy over recorded or generated order flow.
+
+Recorded flows are the files of settings.RECORD_ORDER_FLOW, generated
+ones the scenarios of benchmarks.flows. The flow is matched by the real
+OrderBook on in-memory backends (order_matching_engine.simulation), the
+quoter below keeps a bid and an ask around the mid of the book.
+
+    python -m orders.benchmarks.simulate --flow BTC_ETH_flow_20261019.jsonl
+    python -m orders.benchmarks.simulate --scenario random_walk --count 1000000
+    python -m orders.benchmarks.simulate --no-strategy --output report.json
+
+Events per minute count the processing of messages only: generating or
+reading the flow is reported separately (wall time). Matching is pure
+Python in one thread. On one vCPU the random_walk scenario runs at about
+0.85M events/min with the quoter and 1.1M without it, so the target of
+several million events per minute is not met. That needs a faster
+matching core, not tuning of the simulation.
+"""
+import argparse
+import json
+import sys
+from _decimal import Decimal
+
+from .flows import OrderFlow, SCENARIOS, TICK
+
+
+STRATEGY_USER = 10 ** 9
+
+
+def make_quoter(user_id, balances, spread, quantity, requote_every,
+                max_position):
+    from orders.order_matching_engine.simulation import Strategy
+
+    class Quoter(Strategy):
+        """
+        Bid and ask spread ticks away from the mid of the book, requoted
+        every requote_every messages, the side that would take the
+        position over max_position is not quoted
+        """
+
+        def __init__(self):
+            Strategy.__init__(self, user_id, balances)
+            self.live = []
+            self.messages = 0
+
+        def on_message(self, quote):
+            self.messages += 1
+            if self.messages % requote_every:
+                return
+            for order_id in self.live:
+                self.cancel(order_id)
+            self.live = []
+            book = self.simulation.book
+            best_bid, best_ask = book.bids.max_price(), book.asks.min_price()
+            if best_bid is None or best_ask is None:
+                return
+            mid = (best_bid + best_ask) / 2
+            position = self.bought - self.sold
+            if position < max_position:
+                self.live.append(self.buy(quantity, mid - spread * TICK))
+            if position > -max_position:
+                self.live.append(self.sell(quantity, mid + spread * TICK))
+            self.live = [order_id for order_id in self.live if order_id]
+
+    return Quoter()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--pair', default='BTC_ETH')
+    parser.add_argument('--flow', nargs='+',
+                        help="recorded flow files, generated if not given")
+    parser.add_argument('--scenario', default='random_walk',
+                        choices=list(SCENARIOS))
+    parser.add_argument('--count', type=int, default=100000,
+                        help="messages to generate / replay at most")
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--spread', type=int, default=5,
+                        help="ticks of the quotes from the mid")
+    parser.add_argument('--quantity', default='1')
+    parser.add_argument('--requote-every', type=int, default=10)
+    parser.add_argument('--max-position', default='50')
+    parser.add_argument('--no-strategy', action='store_true')
+    parser.add_argument('--output', help="write the report as json")
+    args = parser.parse_args(argv)
+
+    from orders.order_matching_engine.order_flow import read_flow
+    from orders.order_matching_engine.simulation import Simulation
+    from orders.order_matching_engine.utils import setup_django
+    setup_django()
+
+    strategies = []
+    if not args.no_strategy:
+        strategies.append(make_quoter(
+            STRATEGY_USER, {curr: 10 ** 6 for curr in args.pair.split('_')},
+            args.spread, Decimal(args.quantity), args.requote_every,
+            Decimal(args.max_position)
+        ))
+    if args.flow:
+        flow = read_flow(*args.flow)
+    else:
+        warm_up, warm_up_count, measured = SCENARIOS[args.scenario]
+        order_flow = OrderFlow(args.pair, args.seed)
+
+        def generate():
+            yield from warm_up(order_flow, warm_up_count)
+            yield from measured(order_flow, args.count)
+        flow = generate()
+
+    simulation = Simulation(args.pair, strategies)
+    try:
+        report = simulation.run(flow, limit=args.count if args.flow else None)
+    finally:
+        simulation.close()
+
+    print(f"{report['messages']} messages in {report['seconds']:.1f}s "
+          f"({report['wall_seconds']:.1f}s with the flow), "
+          f"{report['events_per_second'] * 60 / 10 ** 6:.2f}M events/min, "
+          f"{report['trades']} trades, last price {report['last_price']}")
+    spread = report['spread']
+    if spread['mean'] is not None:
+        print(f"spread mean {spread['mean']:.6f} min {spread['min']:.6f} "
+              f"max {spread['max']:.6f}")
+    print(f"resting orders {report['book']['resting_orders']}")
+    for user_id, result in report['strategies'].items():
+        print(f"strategy {user_id}: {result['fills']} fills "
+              f"({result['maker_fills']} maker), position "
+              f"{result['position']}, pnl {result['pnl']} "
+              f"(fees {result['fees']})")
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+    return report
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
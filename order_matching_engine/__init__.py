@@ -1,7 +1,28 @@
-from .main_daemon import daemon
-from .ordertree import OrderTree
-from .orderlist import OrderList
-from .order import Order
-from .order_book import OrderBook
-from .db_writer import DBwriter
-from .heapq_with_removal import HeapQueue
+import importlib
+
+# name: module, imported on first access (PEP 562), so the data structures
+# (OrderTree, OrderList, Order, HeapQueue) are usable without Django and
+# redis, and OrderBook / DBwriter load them only when asked for
+_LAZY = {
+    'daemon': '.main_daemon',
+    'OrderTree': '.ordertree',
+    'OrderList': '.orderlist',
+    'Order': '.order',
+    'OrderBook': '.order_book',
+    'DBwriter': '.db_writer',
+    'HeapQueue': '.heapq_with_removal',
+}
+
+__all__ = list(_LAZY)
+
+
+def __getattr__(name):
+    if name not in _LAZY:
+        raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+    value = getattr(importlib.import_module(_LAZY[name], __name__), name)
+    globals()[name] = value
+    return value
+
+
+def __dir__():
+    return sorted(set(globals()) | set(__all__))
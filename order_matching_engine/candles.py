@@ -0,0 +1,106 @@
+import time
+from _decimal import Decimal
+
+from django.conf import settings
+
+from .utils import r
+
+
+# period name: seconds, names are the same as GraphicOrderView's periods
+PERIODS = {
+    "1_min": 60,
+    "5_min": 5 * 60,
+    "15_min": 15 * 60,
+    "30_min": 30 * 60,
+    "1_hour": 60 * 60,
+    "4_hour": 4 * 60 * 60,
+    "1_day": 24 * 60 * 60,
+    "3_day": 3 * 24 * 60 * 60,
+    "1_week": 7 * 24 * 60 * 60,
+}
+
+
+def dump_bar(bar):
+    return ":".join(str(value) for value in bar)
+
+
+def load_bar(member):
+    start, *values = member.decode().split(":")
+    return [int(start)] + [Decimal(value) for value in values]
+
+
+def get_candles(pair, period, start='-inf', end='+inf'):
+    """
+    Read bars of a pair in one request
+    :return: [[start, open, high, low, close, volume], ...] sorted by start
+    """
+    members = r.zrangebyscore(f"candles_{pair}_{period}", start, end)
+    return [load_bar(member) for member in members]
+
+
+class CandleAggregator:
+    """
+    Maintains OHLCV bars of every period incrementally from the trades.
+
+    Bars of a period are stored in the `candles_{pair}_{period}` sorted set
+    with bar start as a score and "start:open:high:low:close:volume"
+    as a member. Only the bars touched since the previous flush are written.
+    """
+
+    def __init__(self, pair):
+        self._pair = pair
+        self.max_bars = getattr(settings, "CANDLES_MAX_BARS", 5000)
+        self.interval = getattr(settings, "CANDLES_FLUSH_INTERVAL", 1)
+        self.current = {}   # period: [start, open, high, low, close, volume]
+        self.dirty = set()  # periods whose current bar wasn't flushed
+        self.closed = []    # (period, bar) closed before they were flushed
+        self.last_flush = 0
+
+    def load(self):
+        """Continue the last stored bars after restart"""
+        for period in PERIODS:
+            last = r.zrevrange(f"candles_{self._pair}_{period}", 0, 0)
+            if last:
+                self.current[period] = load_bar(last[0])
+
+    def add_trade(self, timestamp, price, quantity):
+        for period, seconds in PERIODS.items():
+            start = int(timestamp // seconds * seconds)
+            bar = self.current.get(period)
+            if bar is None or start > bar[0]:
+                if bar is not None and period in self.dirty:
+                    self.closed.append((period, bar))
+                self.current[period] = [start, price, price, price, price,
+                                        quantity]
+            else:
+                if price > bar[2]:
+                    bar[2] = price
+                if price < bar[3]:
+                    bar[3] = price
+                bar[4] = price
+                bar[5] += quantity
+            self.dirty.add(period)
+
+    def flush(self, force=False):
+        if not self.dirty:
+            return False
+        now = time.time()
+        if not force and now - self.last_flush < self.interval:
+            return False
+
+        bars = self.closed + [(period, self.current[period])
+                              for period in self.dirty]
+        pipe = r.pipeline()
+        for period, bar in bars:
+            key = f"candles_{self._pair}_{period}"
+            pipe.zremrangebyscore(key, bar[0], bar[0])
+            pipe.zadd(key, {dump_bar(bar): bar[0]})
+        for period in self.dirty:
+            pipe.zremrangebyrank(f"candles_{self._pair}_{period}",
+                                 0, -self.max_bars - 1)
+        pipe.execute()
+
+        self.closed = []
+        self.dirty = set()
+        self.last_flush = now
+        return True
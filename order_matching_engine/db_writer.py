@@ -1,15 +1,23 @@
 import json
 import os
+import time
 
 from multiprocessing import Process
 from _decimal import Decimal
 from django.utils import timezone
 from django.conf import settings
 from django.db import transaction
+from orders.order_matching_engine.utils import (r, get_quantity,
+                                                get_currencies, setup_django,
+                                                dec_to_str)
+from orders.order_matching_engine.histogram import start_recorder
+from orders.order_matching_engine.metrics import Metrics, start_metrics
+from orders.order_matching_engine.money_manager import (MoneyManager,
+                                                        nothing_frozen)
+
+setup_django()
+
 from djmoney.money import Money
-from orders.order_matching_engine.utils import r, get_quantity, get_currencies
-from orders.order_matching_engine.money_manager import MoneyManager
-from orders.serializers.utils import dec_to_str
 from orders.models import Order
 
 
@@ -18,8 +26,19 @@ class DBwriter(Process):
         Process.__init__(self)
         self._queue = queue
         self._pair = pair
+        self.wallets = {}   # (curr, user_id): wallet, for settlement rows
+        self.metrics = Metrics(pair, 'writer')
+        self.metrics.gauge('writer_queue_depth', self._queue.qsize,
+                           "Commands waiting for the DB writer")
+        self.metrics.gauge(
+            'writer_queue_lag_seconds',
+            lambda: getattr(self._queue, 'last_wait', 0) / 10 ** 9,
+            "Time the last command waited at the queue"
+        )
 
     def run(self):
+        latency = start_recorder(self._pair, 'writer')
+        metrics_server = start_metrics(self.metrics)
         while True:
             # Если какой-либо другой DBWriter упал
             if r.get("db_stopped"):
@@ -27,6 +46,7 @@ class DBwriter(Process):
                 break
 
             command, quote = self._queue.get()
+            start = time.monotonic_ns()
             try:
                 if command == 'update':
                     self._update_order(quote)
@@ -38,6 +58,12 @@ class DBwriter(Process):
                     self._cancel_order(order_id, edited=True)
                 elif command == 'freeze':
                     self.freeze(quote)
+                elif command == 'amend':
+                    self._amend_order(quote)
+                elif command == 'settle':
+                    self._settle(quote)
+                    self.metrics.observe('writer_batch_rows',
+                                         len(quote['rows']), command=command)
                 elif command == 'match_transaction':
                     incoming_quote = quote[0]
                     head_quote = quote[1]
@@ -45,9 +71,25 @@ class DBwriter(Process):
                     matcher.change_assets()
                 elif command == 'cancel_transaction':
                     self._cancel_transaction(quote)
+                elif command == 'cancel_many':
+                    self._cancel_orders(quote)
+                    self.metrics.observe('writer_batch_rows',
+                                         len(quote['orders']), command=command)
                 elif command == 'stop':
+                    if latency is not None:
+                        latency.publish(force=True)
+                    if metrics_server is not None:
+                        metrics_server.stop()
                     break
+                self.metrics.inc('writer_commands_total', command=command)
+                self.metrics.observe('writer_command_seconds',
+                                     (time.monotonic_ns() - start) / 10 ** 9,
+                                     command=command)
+                if latency is not None:
+                    latency.since('db_apply', start)
+                    latency.publish()
             except Exception as e:
+                self.metrics.inc('writer_errors_total', command=command)
                 r.set("db_stopped", True)
                 pf = os.path.join(os.path.dirname(__file__), 'db_errors.txt')
                 with open(pf, 'a') as f:
@@ -155,6 +197,128 @@ class DBwriter(Process):
             )
             order.save()
 
+    @transaction.atomic
+    def _settle(self, data):
+        """
+        Match transactions of an incoming order aggregated by
+        settlement.settle_trades, one insert per currency
+        :param data: {"order_id": 1, "rows": [[curr, user_id, order_id,
+                      tx_type, amount, commission], ...]}
+        """
+        from transactions.models import (InternalTransactionBTC,
+                                         InternalTransactionETH,
+                                         InternalTransactionXRP,
+                                         InternalTransactionEOS)
+        from cryptocurrency.models import WalletBTC, WalletETH, WalletXRP
+        transactions = {}
+        for curr, user_id, order_id, tx_type, amount, commission \
+                in data['rows']:
+            if (curr, user_id) not in self.wallets:
+                self.wallets[(curr, user_id)] = eval(
+                    f"Wallet{curr}"
+                ).objects.get(user_id=user_id)
+            tx = eval(f"InternalTransaction{curr}")
+            transactions.setdefault(curr, []).append(tx(
+                user_id=user_id, order_id=order_id, category='match',
+                amount=Money(Decimal(amount), curr),
+                commission_amount=Money(Decimal(commission), curr),
+                wallet=self.wallets[(curr, user_id)], tx_type=tx_type
+            ))
+        for curr, rows in transactions.items():
+            eval(f"InternalTransaction{curr}").objects.bulk_create(rows)
+
+    @staticmethod
+    @transaction.atomic
+    def _cancel_orders(data):
+        """
+        Close many orders with one update and write their cancel_bet
+        transactions with one insert per currency
+        :param data: {"orders": [quote, ...]} - quotes with str values
+        """
+        from transactions.models import (InternalTransactionBTC,
+                                         InternalTransactionETH,
+                                         InternalTransactionXRP,
+                                         InternalTransactionEOS)
+        from cryptocurrency.models import WalletBTC, WalletETH, WalletXRP
+        quotes = data['orders']
+        Order.objects.filter(
+            pk__in=[quote['order_id'] for quote in quotes]
+        ).update(status='cancelled', closed_at=timezone.now())
+
+        transactions = {}
+        wallets = {}
+        for quote in quotes:
+            if nothing_frozen(quote):
+                continue
+            quote = {
+                'order_id': quote['order_id'], 'user_id': quote['user_id'],
+                'pair': quote['pair'], 'side': quote['side'],
+                'price': Decimal(quote['price']),
+                'quantity': Decimal(quote['quantity']),
+                'initial_quantity': Decimal(quote['initial_quantity']),
+            }
+            main_curr, fil_curr = get_currencies(quote)
+            key = (main_curr, quote['user_id'])
+            if key not in wallets:
+                wallets[key] = eval(f"Wallet{main_curr}").objects.get(
+                    user_id=quote['user_id']
+                )
+            amount = get_quantity(quote)
+            comm_amount = Decimal(0)
+            if 0 < quote['quantity'] < quote['initial_quantity']:
+                comm_amount = Decimal(settings.DEFAULT_COMMISSION) * amount
+            tx = eval(f"InternalTransaction{main_curr}")
+            transactions.setdefault(main_curr, []).append(tx(
+                user_id=quote['user_id'], order_id=quote['order_id'],
+                category='cancel_bet', amount=Money(amount, main_curr),
+                commission_amount=Money(comm_amount, main_curr),
+                tx_type='incoming', wallet=wallets[key]
+            ))
+        for curr, rows in transactions.items():
+            eval(f"InternalTransaction{curr}").objects.bulk_create(rows)
+
+    @staticmethod
+    @transaction.atomic
+    def _amend_order(quote):
+        """
+        Amended order keeps its row, assets frozen (or unfrozen)
+        for the difference are written as freeze/cancel_bet transaction
+        """
+        from transactions.models import (InternalTransactionBTC,
+                                         InternalTransactionETH,
+                                         InternalTransactionXRP,
+                                         InternalTransactionEOS)
+        from cryptocurrency.models import WalletBTC, WalletETH, WalletXRP
+        order_qs = Order.objects.filter(pk=quote['order_id'])
+        order_qs.update(
+            price=quote['price'], quantity=quote['quantity'],
+            initial_quantity=quote['initial_quantity']
+        )
+        order_qs.first().save()
+
+        amount = Decimal(quote['amount'])
+        commission = Decimal(quote['commission'])
+        if not (amount or commission):
+            return None
+        main_curr, fil_curr = get_currencies(quote)
+        tx = eval(f"InternalTransaction{main_curr}")
+        wallet = eval(f"Wallet{main_curr}")
+        if amount + commission > 0:
+            tx.objects.create(
+                user_id=quote['user_id'], order_id=quote['order_id'],
+                category='freeze', amount=Money(amount, main_curr),
+                commission_amount=Money(commission, main_curr),
+                wallet=wallet.objects.get(user_id=quote['user_id'])
+            )
+        else:
+            tx.objects.create(
+                user_id=quote['user_id'], order_id=quote['order_id'],
+                category='cancel_bet', amount=Money(-amount, main_curr),
+                commission_amount=Money(-commission, main_curr),
+                tx_type='incoming',
+                wallet=wallet.objects.get(user_id=quote['user_id'])
+            )
+
     @staticmethod
     def freeze(quote):
         from transactions.models import (InternalTransactionBTC,
@@ -0,0 +1,114 @@
+import json
+import time
+from bisect import bisect_left
+from _decimal import Decimal
+
+from django.conf import settings
+
+from .utils import r
+
+
+def estimate_sweep(levels, quantity):
+    """
+    Cost of taking quantity from the published levels
+    (cumulative volume is searched by bisection)
+    :return: filled quantity, notional, worst price
+    """
+    if not levels:
+        return Decimal(0), Decimal(0), None
+    volumes = [Decimal(level[3]) for level in levels]
+    index = bisect_left(volumes, quantity)
+    if index == len(levels):
+        return volumes[-1], Decimal(levels[-1][4]), Decimal(levels[-1][0])
+    price = Decimal(levels[index][0])
+    if index:
+        previous_volume = volumes[index - 1]
+        previous_notional = Decimal(levels[index - 1][4])
+    else:
+        previous_volume = previous_notional = Decimal(0)
+    notional = previous_notional + (quantity - previous_volume) * price
+    return quantity, notional, price
+
+
+class DepthPublisher:
+    """
+    Publishes top-N aggregated price levels of the book to redis.
+
+    Snapshot is stored under `depth_{pair}` key:
+    {
+        "pair": "BTC_ETH", "seq": 1, "timestamp": 1532590590.3393712,
+        "bids": [["0.125", "16", 2, "16", "2.000"], ...],
+        "asks": [["0.126", "8", 1, "8", "1.008"], ...]
+    }
+    Level is [price, volume, orders, cumulative volume, cumulative notional].
+    Levels grouped by every band of the trees (DEPTH_BANDS) are stored
+    the same way under `depth_{pair}_{band}`.
+    The book is marked dirty after each processed order and is written
+    at most once per `interval` seconds.
+    """
+
+    def __init__(self, pair, bids, asks):
+        self._pair = pair
+        self.bids = bids
+        self.asks = asks
+        self.levels = getattr(settings, "DEPTH_SNAPSHOT_LEVELS", 50)
+        self.interval = getattr(settings, "DEPTH_SNAPSHOT_INTERVAL", 0.1)
+        self.seq = 0
+        self.dirty = True
+        self.last_publish = 0
+        self.published = {"bids": {}, "asks": {}}
+
+    def mark_dirty(self):
+        self.dirty = True
+
+    def snapshot(self, band=None):
+        return {
+            "pair": self._pair,
+            "seq": self.seq,
+            "timestamp": time.time(),
+            "band": str(band) if band else None,
+            "bids": self.bids.price_levels(self.levels, reverse=True,
+                                           band=band, cumulative=True),
+            "asks": self.asks.price_levels(self.levels, band=band,
+                                           cumulative=True),
+        }
+
+    def delta(self, snapshot):
+        """
+        Levels changed since the previous delta,
+        levels that left the book (or top-N) have 0 orders
+        """
+        delta = {}
+        for side in ("bids", "asks"):
+            levels = {price: [volume, orders]
+                      for price, volume, orders, *_ in snapshot[side]}
+            previous = self.published[side]
+            changes = [[price] + level for price, level in levels.items()
+                       if previous.get(price) != level]
+            changes += [[price, "0", 0] for price in previous
+                        if price not in levels]
+            delta[side] = changes
+            self.published[side] = levels
+        return delta
+
+    def publish(self, force=False):
+        """
+        :return: written snapshot
+                 None - book wasn't changed or throttled
+        """
+        if not self.dirty:
+            return None
+        now = time.time()
+        if not force and now - self.last_publish < self.interval:
+            return None
+        self.seq += 1
+        snapshot = self.snapshot()
+        pipe = r.pipeline()
+        pipe.set(f"depth_{self._pair}", json.dumps(snapshot))
+        for band in self.bids.bands:
+            pipe.set(f"depth_{self._pair}_{band}",
+                     json.dumps(self.snapshot(band)))
+        pipe.execute()
+        self.dirty = False
+        self.last_publish = now
+        return snapshot
@@ -0,0 +1,82 @@
+import gc
+import time
+
+from django.conf import settings
+
+from . import histogram
+from .histogram import Histogram
+
+
+class GCControl:
+    """
+    Garbage collection of the engine process.
+
+    Every collection pause is recorded (all generations in self.pauses,
+    per generation as gc_gen{N} of the latency recorder and
+    engine_gc_pause_seconds of the metrics).
+
+    Low latency mode (settings.LOW_LATENCY_GC):
+    - after the book is loaded everything alive is collected once and
+      frozen (gc.freeze), so the loaded orders are never walked again
+    - automatic collection is off, the engine collects when there are
+      no orders (on_idle) with the same generation thresholds, or in
+      the loop if GC_MAX_DEFERRED allocations piled up without idle
+    """
+
+    def __init__(self, metrics=None):
+        self.metrics = metrics
+        self.low_latency = getattr(settings, "LOW_LATENCY_GC", False)
+        self.max_deferred = getattr(settings, "GC_MAX_DEFERRED", 100000)
+        self.pauses = Histogram()
+        self._started = None
+
+    def install(self):
+        if self.callback not in gc.callbacks:
+            gc.callbacks.append(self.callback)
+
+    def uninstall(self):
+        if self.callback in gc.callbacks:
+            gc.callbacks.remove(self.callback)
+
+    def callback(self, phase, info):
+        if phase == 'start':
+            self._started = time.perf_counter_ns()
+            return
+        if self._started is None:
+            return
+        pause = time.perf_counter_ns() - self._started
+        self._started = None
+        self.pauses.record(pause)
+        if histogram.recorder is not None:
+            histogram.recorder.record(f"gc_gen{info['generation']}", pause)
+        if self.metrics is not None:
+            self.metrics.observe('engine_gc_pause_seconds', pause / 10 ** 9,
+                                 generation=info['generation'])
+
+    def after_load(self):
+        """Called once the book is filled"""
+        if not self.low_latency:
+            return
+        gc.collect()
+        gc.freeze()
+        gc.disable()
+
+    def collect(self):
+        """Collect the generations that are due by the thresholds"""
+        count = gc.get_count()
+        threshold = gc.get_threshold()
+        generation = 0
+        if count[1] >= threshold[1]:
+            generation = 1
+            if count[2] >= threshold[2]:
+                generation = 2
+        gc.collect(generation)
+
+    def on_idle(self):
+        if self.low_latency and gc.get_count()[0] > 0:
+            self.collect()
+
+    def tick(self):
+        """Called after every message, collects only if idle never came"""
+        if self.low_latency and gc.get_count()[0] > self.max_deferred:
+            self.collect()
@@ -1,46 +1,89 @@
 import threading
+import time
+from itertools import count
 from heapq import heappush, heappop, heapify
+from queue import Empty
 
 
 class HeapQueue:
     """
     Min-heap queue:
-    lesser number of priority - higher priority
+    lesser number of priority - higher priority,
+    equal priority and timestamp - in the order of put
     """
 
-    def __init__(self):
+    def __init__(self, capacities=None):
+        """
+        :param capacities: {priority: max queued items} - offer rejects
+                           items over it, put always adds
+        """
         self._queue = []
+        self.capacities = dict(capacities or {})
+        self.sizes = {}     # priority: queued items
+        self.shed = {}      # priority: items rejected by offer
         self.mutex = threading.Lock()
         self.not_empty = threading.Condition(self.mutex)
         self.not_full = threading.Condition(self.mutex)
+        self._seq = count()
 
-    def get(self):
+    def get(self, timeout=None):
+        """
+        Pop the item with the highest priority.
+        If timeout is given - raise queue.Empty when nothing was put
+        during timeout seconds
+        """
         with self.not_empty:
-            while not self.size():
-                self.not_empty.wait()   # waits for notify
+            if timeout is None:
+                while not self.size():
+                    self.not_empty.wait()   # waits for notify
+            else:
+                end_time = time.monotonic() + timeout
+                while not self.size():
+                    remaining = end_time - time.monotonic()
+                    if remaining <= 0:
+                        raise Empty
+                    self.not_empty.wait(remaining)
             self.not_full.notify()
-            return heappop(self._queue)
+            priority, timestamp, seq, quote = heappop(self._queue)
+            self.sizes[priority] -= 1
+            return priority, timestamp, quote
 
     def put(self, priority, timestamp=None, quote=None):
         with self.not_full:
-            if quote == 'STOP':
-                timestamp = 2000000000
-            item = priority, timestamp, quote
-            heappush(self._queue, item)
-            self.not_empty.notify()
+            self._push(priority, timestamp, quote)
+
+    def offer(self, priority, timestamp=None, quote=None):
+        """
+        Put the item if its priority has room, never waits
+        :return: True - queued, False - rejected, the priority is full
+        """
+        capacity = self.capacities.get(priority)
+        with self.not_full:
+            if capacity is not None and \
+                    self.sizes.get(priority, 0) >= capacity:
+                self.shed[priority] = self.shed.get(priority, 0) + 1
+                return False
+            self._push(priority, timestamp, quote)
+            return True
+
+    def _push(self, priority, timestamp, quote):
+        if quote == 'STOP':
+            timestamp = 2000000000
+        item = priority, timestamp, next(self._seq), quote
+        heappush(self._queue, item)
+        self.sizes[priority] = self.sizes.get(priority, 0) + 1
+        self.not_empty.notify()
 
     def delete(self, order_id):
-        index = None
-        quote = None
-        for item in self._queue:
-            if item[2]['order_id'] == order_id:
-                index = self._queue.index(item)
-                quote = item[2]
-                break
-        if index:
-            self._queue.remove(index)
-            heapify(self._queue)
-            return True, quote
+        with self.mutex:
+            for index, item in enumerate(self._queue):
+                quote = item[3]
+                if isinstance(quote, dict) and \
+                        quote.get('order_id') == order_id:
+                    del self._queue[index]
+                    heapify(self._queue)
+                    self.sizes[item[0]] -= 1
+                    return True, quote
         return False, None
 
     def size(self):
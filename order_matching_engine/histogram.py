@@ -0,0 +1,195 @@
+import json
+import time
+from functools import wraps
+
+from django.conf import settings
+
+
+SUB_BITS = 5
+SUB_BUCKETS = 1 << SUB_BITS     # buckets per power of two, ~3% precision
+
+
+class Histogram:
+    """
+    HDR-style histogram of non-negative integers (nanoseconds).
+
+    Values below 2 * SUB_BUCKETS are counted exactly, above that every
+    power of two is split into SUB_BUCKETS buckets, so recording is O(1)
+    and the relative error is kept under 1 / SUB_BUCKETS for any value.
+    """
+
+    def __init__(self):
+        self.counts = {}
+        self.count = 0
+        self.total = 0
+        self.min = None
+        self.max = 0
+
+    @staticmethod
+    def index(value):
+        if value < 2 * SUB_BUCKETS:
+            return value
+        shift = value.bit_length() - SUB_BITS - 1
+        return (shift + 1) * SUB_BUCKETS + (value >> shift) - SUB_BUCKETS
+
+    @staticmethod
+    def value(index):
+        """Middle of the bucket"""
+        if index < 2 * SUB_BUCKETS:
+            return index
+        shift = index // SUB_BUCKETS - 1
+        lowest = (index % SUB_BUCKETS + SUB_BUCKETS) << shift
+        return lowest + (1 << shift) // 2
+
+    def record(self, value):
+        index = self.index(value) if value > 0 else 0
+        self.counts[index] = self.counts.get(index, 0) + 1
+        self.count += 1
+        self.total += value
+        if self.min is None or value < self.min:
+            self.min = value
+        if value > self.max:
+            self.max = value
+
+    def percentile(self, percent):
+        if not self.count:
+            return 0
+        rank = max(1, int(self.count * percent / 100 + 0.5))
+        seen = 0
+        for index in sorted(self.counts):
+            seen += self.counts[index]
+            if seen >= rank:
+                return min(self.value(index), self.max)
+        return self.max
+
+    def merge(self, other):
+        for index, count in other.counts.items():
+            self.counts[index] = self.counts.get(index, 0) + count
+        self.count += other.count
+        self.total += other.total
+        if other.min is not None and (self.min is None or other.min < self.min):
+            self.min = other.min
+        self.max = max(self.max, other.max)
+
+    def summary(self):
+        """Microseconds"""
+        return {
+            'count': self.count,
+            'min': (self.min or 0) / 1000,
+            'mean': self.total / self.count / 1000 if self.count else 0,
+            'p50': self.percentile(50) / 1000,
+            'p90': self.percentile(90) / 1000,
+            'p99': self.percentile(99) / 1000,
+            'p999': self.percentile(99.9) / 1000,
+            'max': self.max / 1000,
+        }
+
+
+class LatencyRecorder:
+    """
+    Histograms of the stages of one process of a pair
+    (the engine or its DB writer).
+
+    Summaries are stored as json in the `latency_{pair}` hash,
+    one field per process.
+    """
+
+    def __init__(self, pair, process):
+        self._pair = pair
+        self.process = process
+        self.histograms = {}
+        self.interval = getattr(settings, "LATENCY_PUBLISH_INTERVAL", 5)
+        self.last_publish = time.time()
+
+    def record(self, stage, nanoseconds):
+        histogram = self.histograms.get(stage)
+        if histogram is None:
+            histogram = self.histograms[stage] = Histogram()
+        histogram.record(nanoseconds)
+
+    def since(self, stage, stamp):
+        """Record the time passed since a time.monotonic_ns() stamp"""
+        self.record(stage, time.monotonic_ns() - stamp)
+
+    def publish(self, force=False):
+        from .utils import r
+        now = time.time()
+        if not force and now - self.last_publish < self.interval:
+            return
+        self.last_publish = now
+        r.hset(f"latency_{self._pair}", self.process, json.dumps({
+            stage: histogram.summary()
+            for stage, histogram in self.histograms.items()
+        }))
+
+
+# recorder of the current process, None - histograms are disabled
+recorder = None
+
+
+def enabled():
+    return getattr(settings, "LATENCY_HISTOGRAMS", False)
+
+
+def start_recorder(pair, process):
+    """Called in the process that records, does nothing if disabled"""
+    global recorder
+    if enabled():
+        recorder = LatencyRecorder(pair, process)
+    return recorder
+
+
+def timed(stage):
+    """Record duration of the function calls if histograms are enabled"""
+    def decorator(function):
+        @wraps(function)
+        def wrapper(*args, **kwargs):
+            if recorder is None:
+                return function(*args, **kwargs)
+            start = time.monotonic_ns()
+            try:
+                return function(*args, **kwargs)
+            finally:
+                recorder.since(stage, start)
+        return wrapper
+    return decorator
+
+
+def get_latency(pair):
+    """
+    :return: {process: {stage: summary}}
+    """
+    from .utils import r
+    return {process.decode(): json.loads(summary) for process, summary
+            in r.hgetall(f"latency_{pair}").items()}
+
+
+class TimedQueue:
+    """
+    Queue wrapper that stamps items on put, so the consumer records
+    how long they waited. Items are passed as is if disabled.
+    """
+
+    def __init__(self, queue, stage='writer_queue', stamped=None):
+        self._queue = queue
+        self.stage = stage
+        self.stamped = enabled() if stamped is None else stamped
+        self.last_wait = 0  # ns, wait of the last item taken
+
+    def put(self, item):
+        if self.stamped:
+            item = (time.monotonic_ns(), item)
+        self._queue.put(item)
+
+    def get(self, *args, **kwargs):
+        item = self._queue.get(*args, **kwargs)
+        if not self.stamped:
+            return item
+        stamp, item = item
+        self.last_wait = time.monotonic_ns() - stamp
+        if recorder is not None:
+            recorder.record(self.stage, self.last_wait)
+        return item
+
+    def qsize(self):
+        return self._queue.qsize()
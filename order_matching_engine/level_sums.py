@@ -0,0 +1,170 @@
+import random
+from _decimal import Decimal, ROUND_DOWN
+
+
+QUANT = Decimal('0.0000000001')     # 10 decimal places as in RDB
+
+
+class Node(object):
+    __slots__ = ('price', 'priority', 'volume', 'sum_volume', 'sum_notional',
+                 'left', 'right')
+
+    def __init__(self, price, volume):
+        self.price = price
+        self.priority = random.random()
+        self.volume = volume
+        self.sum_volume = volume
+        self.sum_notional = volume * price
+        self.left = None
+        self.right = None
+
+    def recount(self):
+        self.sum_volume = self.volume
+        self.sum_notional = self.volume * self.price
+        if self.left is not None:
+            self.sum_volume += self.left.sum_volume
+            self.sum_notional += self.left.sum_notional
+        if self.right is not None:
+            self.sum_volume += self.right.sum_volume
+            self.sum_notional += self.right.sum_notional
+
+
+class LevelSums(object):
+    """
+    A treap of price levels where every node keeps sums of volume and
+    notional (price * volume) of its subtree.
+
+    Lets OrderTree answer "how much does it cost to take N units from the
+    best price" and "how many units can be taken for X" in O(log levels)
+    without walking the levels.
+    """
+
+    def __init__(self):
+        self.root = None
+
+    def update(self, price, volume):
+        """Add volume (may be negative) to the level"""
+        if volume:
+            self.root = self._update(self.root, price, volume)
+
+    def _update(self, node, price, volume):
+        if node is None:
+            return Node(price, volume)
+        if price == node.price:
+            node.volume += volume
+            if not node.volume:
+                return self._merge(node.left, node.right)
+        elif price < node.price:
+            node.left = self._update(node.left, price, volume)
+            if node.left is not None and node.left.priority > node.priority:
+                node = self._rotate_right(node)
+        else:
+            node.right = self._update(node.right, price, volume)
+            if node.right is not None and node.right.priority > node.priority:
+                node = self._rotate_left(node)
+        node.recount()
+        return node
+
+    @staticmethod
+    def _rotate_right(node):
+        left = node.left
+        node.left = left.right
+        node.recount()
+        left.right = node
+        return left
+
+    @staticmethod
+    def _rotate_left(node):
+        right = node.right
+        node.right = right.left
+        node.recount()
+        right.left = node
+        return right
+
+    def _merge(self, left, right):
+        if left is None:
+            return right
+        if right is None:
+            return left
+        if left.priority > right.priority:
+            left.right = self._merge(left.right, right)
+            left.recount()
+            return left
+        right.left = self._merge(left, right.left)
+        right.recount()
+        return right
+
+    @staticmethod
+    def _last_price(node, reverse=False):
+        """The highest price of the subtree (or the lowest one if reverse)"""
+        while True:
+            child = node.left if reverse else node.right
+            if child is None:
+                return node.price
+            node = child
+
+    @property
+    def volume(self):
+        return self.root.sum_volume if self.root is not None else 0
+
+    def sweep(self, quantity, reverse=False):
+        """
+        Take quantity starting from the lowest price
+        (or the highest one if reverse)
+        :return: filled quantity, notional, worst taken price
+        """
+        filled = notional = Decimal(0)
+        worst_price = None
+        node = self.root
+        while node is not None and quantity > 0:
+            near, far = (node.right, node.left) if reverse \
+                else (node.left, node.right)
+            if near is not None:
+                if near.sum_volume >= quantity:
+                    node = near
+                    continue
+                filled += near.sum_volume
+                notional += near.sum_notional
+                quantity -= near.sum_volume
+            taken = min(quantity, node.volume)
+            filled += taken
+            notional += taken * node.price
+            quantity -= taken
+            worst_price = node.price
+            node = far
+        return filled, notional, worst_price
+
+    def sweep_notional(self, budget, reverse=False):
+        """
+        Take levels starting from the lowest price
+        (or the highest one if reverse) while notional fits the budget,
+        stops at the first level that can't be taken whole
+        :return: filled quantity, notional, worst taken price
+        """
+        filled = notional = Decimal(0)
+        worst_price = None
+        node = self.root
+        while node is not None and budget > 0:
+            near, far = (node.right, node.left) if reverse \
+                else (node.left, node.right)
+            if near is not None:
+                if near.sum_notional >= budget:
+                    node = near
+                    continue
+                filled += near.sum_volume
+                notional += near.sum_notional
+                budget -= near.sum_notional
+            taken = min(node.volume, (budget / node.price).quantize(
+                QUANT, rounding=ROUND_DOWN
+            ))
+            if taken > 0:
+                filled += taken
+                notional += taken * node.price
+                budget -= taken * node.price
+                worst_price = node.price
+            elif near is not None:
+                worst_price = self._last_price(near, reverse)
+            if taken < node.volume:
+                break
+            node = far
+        return filled, notional, worst_price
@@ -0,0 +1,248 @@
+import json
+import socket
+import time
+
+from collections import deque
+from multiprocessing import Process, Queue as mpqueue
+from queue import Empty
+from _decimal import Decimal
+
+from django.conf import settings
+
+
+def market_data_port(pair):
+    ports = getattr(settings, "MARKET_DATA_PORTS", {})
+    if pair in ports:
+        return ports[pair]
+    return settings.SOCKET_PAIR_PORTS[pair] + 1000
+
+
+class MarketDataPublisher:
+    """
+    Engine side of the market data stream.
+
+    Every message gets the next sequence number of the pair and is passed
+    to the MarketDataFanout process, so a slow subscriber never blocks
+    matching. Messages:
+        (seq, 'book', {"bids": [[price, volume, orders], ...], "asks": ...})
+            - changed levels, removed levels have 0 orders
+        (seq, 'trades', [[trade_seq, time, price, quantity, side], ...])
+        (seq, 'ticker', {...})
+    """
+
+    def __init__(self, pair):
+        self._pair = pair
+        self.seq = 0
+        self._queue = None
+        self.fanout = None
+
+    def start(self):
+        self._queue = mpqueue()
+        self.fanout = MarketDataFanout(self._queue, self._pair)
+        self.fanout.start()
+
+    def stop(self):
+        if self._queue is None:
+            return
+        self._queue.put((self.seq, 'stop', None))
+        self.fanout.join()
+        self._queue = None
+
+    def publish(self, channel, data):
+        if self._queue is None:
+            return
+        self.seq += 1
+        self._queue.put((self.seq, channel, data))
+
+
+class Subscriber:
+    """
+    Conflated state of one client.
+
+    Updates that weren't sent yet are merged: a level keeps only its
+    latest volume, ticker - the latest one, trades - the last MAX_TRADES.
+    So a slow client gets the current state instead of a backlog.
+    """
+    MAX_TRADES = 100
+
+    def __init__(self, sock):
+        self.sock = sock
+        self.buffer = b''
+        self.snapshot = True    # the full book goes first
+        self.book = {'bids': {}, 'asks': {}}
+        self.trades = deque(maxlen=self.MAX_TRADES)
+        self.trades_dropped = 0
+        self.ticker = None
+        self.seq = 0
+
+    def has_pending(self):
+        return bool(self.snapshot or self.book['bids'] or self.book['asks']
+                    or self.trades or self.ticker)
+
+    def add_trades(self, trades):
+        overflow = len(self.trades) + len(trades) - self.MAX_TRADES
+        if overflow > 0:
+            self.trades_dropped += overflow
+        self.trades.extend(trades)
+
+    def message(self, state):
+        if self.snapshot:
+            message = state.snapshot()
+            message['trades'] = list(self.trades)
+            self.snapshot = False
+        else:
+            message = {
+                'type': 'update', 'pair': state.pair,
+                'bids': [[price] + level
+                         for price, level in self.book['bids'].items()],
+                'asks': [[price] + level
+                         for price, level in self.book['asks'].items()],
+                'trades': list(self.trades),
+                'ticker': self.ticker,
+            }
+            if self.trades_dropped:
+                message['trades_dropped'] = self.trades_dropped
+        message['seq'] = self.seq
+        self.book = {'bids': {}, 'asks': {}}
+        self.trades.clear()
+        self.trades_dropped = 0
+        self.ticker = None
+        return (json.dumps(message) + "\n").encode()
+
+    def flush(self, state):
+        """
+        Write as much as the socket takes without blocking
+        :return: False - client disconnected
+        """
+        if not self.buffer and self.has_pending():
+            self.buffer = self.message(state)
+        if not self.buffer:
+            return True
+        try:
+            sent = self.sock.send(self.buffer)
+        except BlockingIOError:
+            return True
+        except OSError:
+            return False
+        self.buffer = self.buffer[sent:]
+        return True
+
+
+class BookState:
+    """Full book levels and the latest ticker as seen by the fan-out"""
+
+    def __init__(self, pair):
+        self.pair = pair
+        self.seq = 0
+        self.book = {'bids': {}, 'asks': {}}
+        self.ticker = None
+
+    def apply_book(self, delta):
+        for side, levels in delta.items():
+            for price, volume, orders in levels:
+                if orders:
+                    self.book[side][price] = [volume, orders]
+                else:
+                    self.book[side].pop(price, None)
+
+    def snapshot(self):
+        bids = sorted(self.book['bids'].items(),
+                      key=lambda level: Decimal(level[0]), reverse=True)
+        asks = sorted(self.book['asks'].items(),
+                      key=lambda level: Decimal(level[0]))
+        return {
+            'type': 'snapshot', 'pair': self.pair, 'seq': self.seq,
+            'bids': [[price] + level for price, level in bids],
+            'asks': [[price] + level for price, level in asks],
+            'ticker': self.ticker,
+        }
+
+
+class MarketDataFanout(Process):
+    """
+    Serves the market data of a pair to any number of local subscribers.
+
+    Clients connect to MARKET_DATA_PORTS[pair] and read newline delimited
+    json: a snapshot first, then updates with the sequence number of the
+    last message included. A fresh snapshot is sent to everyone every
+    MARKET_DATA_SNAPSHOT_INTERVAL seconds.
+    """
+
+    def __init__(self, queue, pair):
+        Process.__init__(self)
+        self._queue = queue
+        self._pair = pair
+        self.snapshot_interval = getattr(
+            settings, "MARKET_DATA_SNAPSHOT_INTERVAL", 30
+        )
+
+    def run(self):
+        sock = socket.socket()
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        sock.bind(('localhost', market_data_port(self._pair)))
+        sock.listen()
+        sock.setblocking(False)
+
+        state = BookState(self._pair)
+        subscribers = []
+        last_snapshot = time.time()
+        stopped = False
+        while not stopped:
+            messages = []
+            try:
+                messages.append(self._queue.get(timeout=0.01))
+                while len(messages) < 1000:
+                    messages.append(self._queue.get_nowait())
+            except Empty:
+                pass
+            for seq, channel, data in messages:
+                if channel == 'stop':
+                    stopped = True
+                    break
+                self.apply(state, subscribers, seq, channel, data)
+
+            while True:
+                try:
+                    conn, addr = sock.accept()
+                except BlockingIOError:
+                    break
+                conn.setblocking(False)
+                subscriber = Subscriber(conn)
+                subscriber.seq = state.seq
+                subscribers.append(subscriber)
+
+            if time.time() - last_snapshot >= self.snapshot_interval:
+                last_snapshot = time.time()
+                for subscriber in subscribers:
+                    subscriber.snapshot = True
+
+            for subscriber in list(subscribers):
+                if not subscriber.flush(state):
+                    subscriber.sock.close()
+                    subscribers.remove(subscriber)
+
+        for subscriber in subscribers:
+            subscriber.sock.close()
+        sock.close()
+
+    @staticmethod
+    def apply(state, subscribers, seq, channel, data):
+        state.seq = seq
+        if channel == 'book':
+            state.apply_book(data)
+        elif channel == 'ticker':
+            state.ticker = data
+        for subscriber in subscribers:
+            subscriber.seq = seq
+            if subscriber.snapshot:
+                # snapshot will already contain book and ticker
+                if channel == 'trades':
+                    subscriber.add_trades(data)
+            elif channel == 'book':
+                for side, levels in data.items():
+                    for price, volume, orders in levels:
+                        subscriber.book[side][price] = [volume, orders]
+            elif channel == 'trades':
+                subscriber.add_trades(data)
+            elif channel == 'ticker':
+                subscriber.ticker = data
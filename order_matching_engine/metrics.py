@@ -0,0 +1,183 @@
+import logging
+import time
+from http.server import HTTPServer, BaseHTTPRequestHandler
+from threading import Thread, Lock
+
+from django.conf import settings
+
+
+_logger = logging.getLogger(__name__)
+
+# port of the metrics endpoint relative to SOCKET_PAIR_PORTS
+PORT_OFFSETS = {'engine': 2000, 'writer': 3000}
+
+
+def metrics_port(pair, process):
+    ports = getattr(settings, "METRICS_PORTS", {})
+    if pair in ports:
+        return ports[pair][process]
+    return settings.SOCKET_PAIR_PORTS[pair] + PORT_OFFSETS[process]
+
+
+def _labels(labels):
+    if not labels:
+        return ''
+    return '{' + ','.join(f'{key}="{value}"'
+                          for key, value in sorted(labels.items())) + '}'
+
+
+class Metrics:
+    """
+    Counters and gauges of one process of a pair (the engine or its
+    DB writer) in the Prometheus text format.
+
+    Counters are changed by the process itself, gauges are functions
+    called when the endpoint is scraped, so the hot path only pays for
+    a dict increment. Counters are changed by more than one thread
+    (the engine and its socket thread) and read by the endpoint's one,
+    so they are changed under a lock and rendered from a copy.
+    """
+
+    def __init__(self, pair, process):
+        self._pair = pair
+        self.process = process
+        self.counters = {}  # name: {labels: value}
+        self.gauges = {}    # name: function returning value or {labels: value}
+        self.help = {}
+        self.lock = Lock()
+        self.started = time.time()
+        self.gauge('process_start_time_seconds', lambda: self.started,
+                   "Start time of the process, unix seconds")
+
+    def inc(self, name, value=1, **labels):
+        key = tuple(sorted(labels.items())) if labels else ()
+        with self.lock:
+            series = self.counters.get(name)
+            if series is None:
+                series = self.counters[name] = {}
+            series[key] = series.get(key, 0) + value
+
+    def observe(self, name, value, **labels):
+        """Summary without quantiles: name_sum and name_count"""
+        self.inc(f"{name}_sum", value, **labels)
+        self.inc(f"{name}_count", 1, **labels)
+
+    def gauge(self, name, function, help_text=''):
+        with self.lock:
+            self.gauges[name] = function
+            if help_text:
+                self.help[name] = help_text
+
+    def describe(self, name, help_text):
+        with self.lock:
+            self.help[name] = help_text
+
+    def render(self):
+        """
+        :return: str, text exposition format
+        """
+        common = {'pair': self._pair, 'process': self.process}
+        with self.lock:
+            counters = {name: dict(series)
+                        for name, series in self.counters.items()}
+            gauges = dict(self.gauges)
+            help_texts = dict(self.help)
+        lines = []
+        for name, series in sorted(counters.items()):
+            if name in help_texts:
+                lines.append(f"# HELP {name} {help_texts[name]}")
+            lines.append(f"# TYPE {name} counter")
+            for key, value in series.items():
+                lines.append(f"{name}{_labels(dict(key, **common))} {value}")
+        for name, function in sorted(gauges.items()):
+            try:
+                value = function()
+            except Exception as e:
+                _logger.warning("metrics: gauge %s failed - %s", name, e)
+                continue
+            if name in help_texts:
+                lines.append(f"# HELP {name} {help_texts[name]}")
+            lines.append(f"# TYPE {name} gauge")
+            if not isinstance(value, dict):
+                value = {(): value}
+            for key, item in value.items():
+                lines.append(f"{name}{_labels(dict(key, **common))} {item}")
+        return '\n'.join(lines) + '\n'
+
+
+class MetricsServer(Thread):
+    """HTTP endpoint of Metrics: GET /metrics on localhost"""
+
+    def __init__(self, metrics, port):
+        Thread.__init__(self, daemon=True)
+        self.metrics = metrics
+        self.port = port
+        self.server = None
+
+    def run(self):
+        metrics = self.metrics
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path.split('?')[0] not in ('/', '/metrics'):
+                    self.send_error(404)
+                    return
+                body = metrics.render().encode()
+                self.send_response(200)
+                self.send_header('Content-Type',
+                                 'text/plain; version=0.0.4; charset=utf-8')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        host = getattr(settings, "METRICS_HOST", 'localhost')
+        try:
+            self.server = HTTPServer((host, self.port), Handler)
+        except OSError as e:
+            _logger.warning("metrics: can't listen on %s:%s - %s",
+                            host, self.port, e)
+            return
+        self.server.serve_forever()
+
+    def stop(self):
+        if self.server is not None:
+            self.server.shutdown()
+
+
+def count_round_trips(metrics, connection):
+    """
+    Count redis round trips of the process: every command and every
+    pipeline execution takes a connection from the pool once
+    """
+    pool = connection.connection_pool
+    get_connection = pool.get_connection
+
+    def counted(*args, **kwargs):
+        metrics.inc('redis_round_trips_total')
+        return get_connection(*args, **kwargs)
+
+    metrics.describe('redis_round_trips_total', "Redis commands and pipelines")
+    pool.get_connection = counted
+
+
+def enabled():
+    return getattr(settings, "METRICS_ENABLED", True)
+
+
+def start_metrics(metrics):
+    """
+    Start the endpoint of metrics in the process that owns them and
+    count its redis round trips, does nothing if disabled
+    :return: MetricsServer or None
+    """
+    if not enabled():
+        return None
+    from .utils import r
+    count_round_trips(metrics, r)
+    server = MetricsServer(metrics,
+                           metrics_port(metrics._pair, metrics.process))
+    server.start()
+    return server
@@ -1,14 +1,11 @@
 import logging
-import os
-import django
 from _decimal import Decimal
 
 from django.conf import settings
 
 from orders.order_matching_engine.utils import r
-
-os.environ['DJANGO_SETTINGS_MODULE'] = 'cex_backend.settings'
-django.setup()
+from orders.order_matching_engine.histogram import timed
+from orders.order_matching_engine.storage import redis_balances
 
 
 logging.basicConfig(filename='money_manager.log', filemode='a',
@@ -17,12 +14,14 @@ log = logging.getLogger('ex')
 
 
 class MoneyManager:
-    def __init__(self, data, cancelled=False):
+    def __init__(self, data, cancelled=False, balances=None):
         """
         Redis money manager.
         Manages money of user for each order that was modified/created
         :param data - order dict with changed/current price and/or quantity
+        :param balances - BalanceStore, redis by default
         """
+        self.balances = balances or redis_balances
         try:
             self.user_id = data['user_id']
             self.side = data['side']
@@ -47,6 +46,7 @@ class MoneyManager:
         except Exception as e:
             log.exception(f"Error occurred - {e}")
 
+    @timed('redis_assets')
     def check_assets(self):
         """
         Compare user's active assets and the desired order
@@ -54,11 +54,10 @@ class MoneyManager:
                  False - not enough
         """
         try:
-            active_assets = r.get(f"active_{self.curr}_{self.user_id}")
+            active_assets = self.balances.get('active', self.curr,
+                                              self.user_id)
             if not active_assets:
-                r.set(f"active_{self.curr}_{self.user_id}", 0)
                 return False
-            active_assets = Decimal(active_assets.decode())
 
             if self.side == 'bid' and active_assets >= self.total_quantity + self.bid_commission:
                 return True
@@ -68,6 +67,25 @@ class MoneyManager:
         except Exception as e:
             log.exception(f"Error_occurred - {e}")
 
+    def reserved(self):
+        """
+        :return: Decimal - assets frozen for the order, commission included
+        """
+        if self.side == 'bid':
+            return self.total_quantity + self.bid_commission
+        return self.traded_quantity + self.ask_commission
+
+    @timed('redis_assets')
+    def active_assets(self):
+        """
+        :return: Decimal - user's active assets of the order's currency
+        """
+        active_assets = self.balances.get('active', self.curr, self.user_id)
+        if not active_assets:
+            return Decimal(0)
+        return active_assets
+
+    @timed('redis_assets')
     def freeze(self):
         """
         Market bid
@@ -83,55 +101,28 @@ class MoneyManager:
         """
         # TODO: at view don't check market bid
         try:
-            if self.side == 'bid':
-                r.incrbyfloat(
-                    f"frozen_{self.curr}_{self.user_id}",
-                    self.total_quantity + self.bid_commission
-                )
-                r.incrbyfloat(
-                    f"active_{self.curr}_{self.user_id}",
-                    f"-{self.total_quantity + self.bid_commission}"
-                )
-
-            if self.side == 'ask':
-                r.incrbyfloat(
-                    f"frozen_{self.curr}_{self.user_id}",
-                    self.traded_quantity + self.ask_commission
-                )
-                r.incrbyfloat(
-                    f"active_{self.curr}_{self.user_id}",
-                    f"-{self.traded_quantity + self.ask_commission}"
-                )
+            self.move('active', 'frozen', self.reserved())
         except Exception as e:
             log.exception(f"Error occurred - {e}")
 
+    @timed('redis_assets')
     def refund(self):
         try:
             if not hasattr(self, 'quantity_triggered'):
                 # Если объем менялся - не возвращаем коммиссию
                 self.bid_commission = Decimal(0)
                 self.ask_commission = Decimal(0)
-            if self.side == 'bid':
-                r.incrbyfloat(
-                    f"frozen_{self.curr}_{self.user_id}",
-                    f"-{self.total_quantity + self.bid_commission}"
-                )
-                r.incrbyfloat(
-                    f"active_{self.curr}_{self.user_id}",
-                    self.total_quantity + self.bid_commission
-                )
-            if self.side == 'ask':
-                r.incrbyfloat(
-                    f"frozen_{self.curr}_{self.user_id}",
-                    f"-{self.traded_quantity + self.ask_commission}"
-                )
-                r.incrbyfloat(
-                    f"active_{self.curr}_{self.user_id}",
-                    self.traded_quantity + self.ask_commission
-                )
+            self.move('frozen', 'active', self.reserved())
         except Exception as e:
             log.exception(f"Error occurred - {e}")
 
+    def move(self, source, target, amount):
+        """Move amount of the order's currency between user's balances"""
+        self.balances.change({
+            (source, self.curr, self.user_id): -amount,
+            (target, self.curr, self.user_id): amount,
+        })
+
     def __str__(self):
         return_value = "*MoneyManager*\n"
         returned_dict = {}
@@ -142,13 +133,23 @@ class MoneyManager:
         return return_value
 
 
+def nothing_frozen(quote):
+    """
+    Market bids (and stop bids that become market ones) don't freeze
+    assets: the price is unknown until they are matched
+    """
+    return quote['side'] == 'bid' and \
+        quote['order_type'] in ('market', 'stop')
+
+
 def cancel_order(order_id):
     pipe = r.pipeline()
     pipe.hset(f"cancelled", f"{order_id}", order_id)
     pipe.delete(f"order_{order_id}")
 
 
-def change_assets(order, head_order, traded_quantity):
+@timed('redis_assets')
+def change_assets(order, head_order, traded_quantity, balances=None):
     try:
         another_order = {}
         another_head_order = {}
@@ -160,73 +161,34 @@ def change_assets(order, head_order, traded_quantity):
         # log.info(msg=f"another_head_order q"
         #              f" - {another_head_order['quantity']}, "
         #              f"head_order q - {head_order['quantity']}")
-        o = MoneyManager(another_order)
+        o = MoneyManager(another_order, balances=balances)
         # log.info(msg=f"order info:\n{o}")
-        h = MoneyManager(another_head_order)
+        h = MoneyManager(another_head_order, balances=balances)
         # log.info(msg=f"order info:\n{h}")
 
-        if o.order_type == 'market' and o.side == 'bid':
-            pipe = r.pipeline()
-            pipe.incrbyfloat(
-                f"active_{o.curr}_{o.user_id}",
-                f"-{o.total_quantity + o.bid_commission}"
-            )
-            pipe.incrbyfloat(
-                f"active_{o.counter_curr}_{o.user_id}",
-                o.traded_quantity
-            )
+        deltas = {}
 
-            pipe.incrbyfloat(
-                f"frozen_{h.curr}_{h.user_id}",
-                f"-{h.traded_quantity}"
-            )
-            pipe.incrbyfloat(
-                f"active_{h.counter_curr}_{h.user_id}",
-                h.total_quantity
-            )
-            pipe.execute()
-            return another_order, another_head_order
-
-        if o.side == 'bid':
-            pipe = r.pipeline()
-            pipe.incrbyfloat(
-                f"frozen_{o.curr}_{o.user_id}",
-                f"-{o.total_quantity}"
-            )
-            pipe.incrbyfloat(
-                f"active_{o.counter_curr}_{o.user_id}",
-                o.traded_quantity
-            )
+        def add(kind, curr, user_id, amount):
+            key = (kind, curr, user_id)
+            deltas[key] = deltas.get(key, Decimal(0)) + amount
 
-            pipe.incrbyfloat(
-                f"frozen_{h.curr}_{h.user_id}",
-                f"-{h.traded_quantity}"
-            )
-            pipe.incrbyfloat(
-                f"active_{h.counter_curr}_{h.user_id}",
-                h.total_quantity
-            )
-            pipe.execute()
+        if o.order_type == 'market' and o.side == 'bid':
+            add('active', o.curr, o.user_id,
+                -(o.total_quantity + o.bid_commission))
+            add('active', o.counter_curr, o.user_id, o.traded_quantity)
+            add('frozen', h.curr, h.user_id, -h.traded_quantity)
+            add('active', h.counter_curr, h.user_id, h.total_quantity)
+        elif o.side == 'bid':
+            add('frozen', o.curr, o.user_id, -o.total_quantity)
+            add('active', o.counter_curr, o.user_id, o.traded_quantity)
+            add('frozen', h.curr, h.user_id, -h.traded_quantity)
+            add('active', h.counter_curr, h.user_id, h.total_quantity)
         elif o.side == 'ask':
-            pipe = r.pipeline()
-            pipe.incrbyfloat(
-                f"frozen_{o.curr}_{o.user_id}",
-                f"-{o.traded_quantity}"
-            )
-            pipe.incrbyfloat(
-                f"active_{o.counter_curr}_{o.user_id}",
-                o.total_quantity
-            )
-
-            pipe.incrbyfloat(
-                f"frozen_{h.curr}_{h.user_id}",
-                f"-{h.total_quantity}"
-            )
-            pipe.incrbyfloat(
-                f"active_{h.counter_curr}_{h.user_id}",
-                h.traded_quantity
-            )
-            pipe.execute()
+            add('frozen', o.curr, o.user_id, -o.traded_quantity)
+            add('active', o.counter_curr, o.user_id, o.total_quantity)
+            add('frozen', h.curr, h.user_id, -h.total_quantity)
+            add('active', h.counter_curr, h.user_id, h.traded_quantity)
+        o.balances.change(deltas)
         return another_order, another_head_order
     except Exception as e:
         # with open('money_manager.txt', 'a') as f:
@@ -234,7 +196,70 @@ def change_assets(order, head_order, traded_quantity):
         log.exception(f"Error occurred - {e}")
 
 
-def can_handle(new_quote, quote):
+@timed('redis_assets')
+def amend_assets(quote, new_price, new_quantity, balances=None):
+    """
+    Freeze (or unfreeze) the difference between assets reserved for
+    the order before and after amend
+    :param quote: dict of the resting order
+    :param balances: BalanceStore, redis by default
+    :return: (amount, commission) - frozen differences, negative if unfrozen
+             None - not enough assets
+    """
+    new_quote = {}
+    new_quote.update(quote)
+    new_quote['price'] = new_price
+    new_quote['quantity'] = new_quantity
+    old = MoneyManager(quote, balances=balances)
+    new = MoneyManager(new_quote, balances=balances)
+    if new.side == 'bid':
+        amount = new.total_quantity - old.total_quantity
+        commission = new.bid_commission - old.bid_commission
+    else:
+        amount = new.traded_quantity - old.traded_quantity
+        commission = new.ask_commission - old.ask_commission
+    difference = amount + commission
+    if difference > 0 and new.active_assets() < difference:
+        return None
+    new.move('active', 'frozen', difference)
+    return amount, commission
+
+
+@timed('redis_assets')
+def refund_assets(quotes, balances=None):
+    """
+    Unfreeze assets of many cancelled orders at once:
+    refunds are netted per user and currency and written in one pipeline.
+    Market bids are skipped - nothing was frozen for them.
+    Commission is returned only if the order was partially traded,
+    the same as MoneyManager.refund
+    :param balances: BalanceStore, redis by default
+    :return: dict (curr, user_id): refunded amount
+    """
+    refunds = {}
+    for quote in quotes:
+        if nothing_frozen(quote):
+            continue
+        mm = MoneyManager(quote, cancelled=True, balances=balances)
+        if mm.side == 'bid':
+            amount = mm.total_quantity
+            commission = mm.bid_commission
+        else:
+            amount = mm.traded_quantity
+            commission = mm.ask_commission
+        if hasattr(mm, 'quantity_triggered'):
+            amount += commission
+        key = (mm.curr, mm.user_id)
+        refunds[key] = refunds.get(key, Decimal(0)) + amount
+    deltas = {}
+    for (curr, user_id), amount in refunds.items():
+        deltas[('frozen', curr, user_id)] = -amount
+        deltas[('active', curr, user_id)] = amount
+    (balances or redis_balances).change(deltas)
+    return refunds
+
+
+def can_handle(new_quote, quote, balances=None):
     edited_price = None
     edited_quantity = None
 
@@ -245,7 +270,8 @@ def can_handle(new_quote, quote):
     quantity = quote['quantity']
     main_curr, second_curr = quote['pair'].split('_')
     curr = main_curr if side == 'bid' else second_curr
-    current_assets = Decimal(r.get(f"active_{curr}_{user_id}").decode())
+    current_assets = (balances or redis_balances).get('active', curr,
+                                                      user_id) or Decimal(0)
 
     if new_quote['price'] > 0:
         edited_price = new_quote['price']
@@ -15,6 +15,13 @@ class Order(object):
         self.order_type = quote['order_type']
         self.quantity = Decimal(quote['quantity'])
         self.initial_quantity = Decimal(quote['initial_quantity'])
+        # iceberg order: only display_quantity is shown at the book,
+        # the rest is hidden and refills the displayed slice after fills
+        self.display_quantity = Decimal(quote.get('display_quantity') or 0)
+        self.hidden_quantity = Decimal(0)
+        if 0 < self.display_quantity < self.quantity:
+            self.hidden_quantity = self.quantity - self.display_quantity
+            self.quantity = self.display_quantity
         self.price = Decimal(quote['price'])
         self.timestamp = int(quote['timestamp'])
         # doubly linked list to make it easier to re-order Orders
@@ -38,6 +45,25 @@ class Order(object):
         self.timestamp = new_timestamp
         self.quantity = new_quantity
 
+    def full_quantity(self):
+        """Displayed and hidden quantity"""
+        return self.quantity + self.hidden_quantity
+
+    def replenish(self, new_timestamp):
+        """
+        Refill the displayed slice of an iceberg order from the hidden
+        reserve, the order loses its time priority
+        :return: change of the displayed quantity
+        """
+        new_quantity = min(self.display_quantity, self.hidden_quantity)
+        delta = new_quantity - self.quantity
+        self.hidden_quantity -= new_quantity
+        self.order_list.move_to_tail(self)
+        self.order_list.volume += delta
+        self.timestamp = new_timestamp
+        self.quantity = new_quantity
+        return delta
+
     def __str__(self):
         q = self.quantity
         p = self.price
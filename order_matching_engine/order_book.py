@@ -1,41 +1,83 @@
+import gc
 import os
-import random
 import sys
 import time
 import json
 import socket
-import django
 
-from multiprocessing import Process, Queue as mpqueue
+from multiprocessing import Process
 from threading import Thread, Event
-from _decimal import Decimal
+from _decimal import Decimal, ROUND_FLOOR, ROUND_CEILING
 from collections import deque
+from queue import Empty
 
-from django.db import connections
 from django.utils import timezone
 from django.conf import settings
-from djmoney.money import Money
 
 from orders.order_matching_engine import OrderTree
-from orders.order_matching_engine.money_manager import (change_assets,
-                                                        MoneyManager,
-                                                        can_handle)
-from orders.order_matching_engine.utils import get_order_from_redis
-from orders.models import Order
-from userdata.models import CustomUser as User
-from .db_writer import DBwriter
+from orders.order_matching_engine.money_manager import (MoneyManager,
+                                                        can_handle,
+                                                        amend_assets,
+                                                        refund_assets,
+                                                        nothing_frozen)
+from .candles import CandleAggregator, get_candles
+from .depth import DepthPublisher
 from .heapq_with_removal import HeapQueue
-from .utils import change_order, r
+from . import histogram
+from .histogram import start_recorder
+from .metrics import Metrics, start_metrics
+from .order_flow import start_flow_recorder
+from .profiler import Diagnostics
+from .gc_control import GCControl
+from .market_data import MarketDataPublisher
+from .settlement import settle_trades
+from .stop_index import StopIndex
+from .storage import redis_backends, redis_orders
+from .timing_wheel import TimingWheel
+from .ticker import Ticker
+from .trade_log import TradeLog
+from .utils import r, setup_django, dec_to_str
 
-os.environ['DJANGO_SETTINGS_MODULE'] = 'cex_backend.settings'
-django.setup()
+# limit orders that never rest at the book: immediate-or-cancel, fill-or-kill
+IMMEDIATE_TYPES = ('ioc', 'fok')
+# stop orders wait at the StopIndex and become market/limit ones when triggered
+TRIGGERED_TYPES = {'stop': 'market', 'stop_limit': 'limit'}
+# what to do when an order meets a resting order of the same user
+STP_MODES = ('cancel_newest', 'cancel_oldest', 'decrement_both')
+# priorities of the HeapQueue, STOP is 0
+PRIORITIES = {'cancel': 1, 'edit': 2, 'market': 3, 'limit': 4}
+# max queued messages of a priority, settings.HEAP_QUEUE_CAPACITY,
+# cancels are always admitted
+CAPACITY = {'edit': 5000, 'market': 10000, 'limit': 10000}
+# answers of SocketHandler to the API
+OK = b'OK'
+BUSY = b'BUSY'
+
+
+def queue_capacities():
+    """:return: {priority: capacity} for HeapQueue"""
+    capacities = getattr(settings, "HEAP_QUEUE_CAPACITY", CAPACITY)
+    return {PRIORITIES[name]: capacity
+            for name, capacity in capacities.items()
+            if name != 'cancel' and capacity is not None}
 
 
 class SocketHandler(Thread):
-    def __init__(self, pair, heap_queue):
+    def __init__(self, pair, heap_queue, diagnostics=None, orders=None,
+                 flow=None, metrics=None):
+        """
+        :param flow: order_flow.FlowRecorder - record the received messages
+        :param metrics: Metrics of the engine - count shed messages
+        """
         Thread.__init__(self)
         self._pair = pair
         self.heap_queue = heap_queue
+        self.diagnostics = diagnostics
+        self.orders = orders or redis_orders
+        self.flow = flow
+        self.metrics = metrics
+        self.busy_ttl = getattr(settings, "BUSY_FLAG_TTL", 1000)
+        self.busy_until = 0
         self._stopped = Event()
 
     def stop(self):
@@ -51,117 +93,372 @@ class SocketHandler(Thread):
         sock.listen()
         while not self.is_stopped():
             conn, addr = sock.accept()
-            message = conn.recv(256).decode()
-            conn.close()
+            received = time.monotonic_ns()
+            message = conn.recv(4096).decode()
             if message == 'STOP':
+                conn.close()
                 self.heap_queue.put(0, quote='STOP')
                 self.stop()
-            else:
-                quote = json.loads(message)
-                if quote.get("cancelled", False):
-                    self.heap_queue.put(1, quote['timestamp'], quote)
-                elif quote.get("edited", False):
-                    self.heap_queue.put(2, quote['timestamp'], quote)
-                else:
-                    if r.hget("cancelled", f"{quote['order_id']}"):
-                        # Сюда попадают ордера которые были отменены до их обработки
-                        r.hdel("cancelled", f"{quote['order_id']}")
-                        continue
-                    order_type = quote['order_type']
-                    if order_type == 'market':
-                        self.heap_queue.put(3, quote['timestamp'], quote)
-                    elif order_type == 'limit':
-                        self.heap_queue.put(4, quote['timestamp'], quote)
+                continue
+            quote = json.loads(message)
+            if quote.get("control"):
+                conn.close()
+                # {"control": "profile", "seconds": 10} / {"control": "heap"}
+                if self.diagnostics is not None:
+                    self.diagnostics.request(quote['control'], **quote)
+                continue
+            admitted = self.admit(quote, received)
+            # the API waits for the answer: BUSY - roll the order back
+            try:
+                conn.sendall(OK if admitted else BUSY)
+            except OSError:
+                pass
+            conn.close()
+            if admitted and self.flow is not None:
+                self.flow.write(message)
         sock.close()
+        if self.flow is not None:
+            self.flow.close()
+
+    def admit(self, quote, received):
+        """
+        Queue the message by its priority. Cancels are always queued,
+        new and edited orders are shed once their priority is full
+        (settings.HEAP_QUEUE_CAPACITY)
+        :return: False - the message was shed
+        """
+        if histogram.recorder is not None:
+            quote['queued_at'] = time.monotonic_ns()
+            histogram.recorder.record('socket_receive',
+                                      quote['queued_at'] - received)
+        if quote.get("cancelled", False) or quote.get("cancel_all", False):
+            self.heap_queue.put(PRIORITIES['cancel'], quote['timestamp'],
+                                quote)
+            return True
+        if quote.get("edited", False):
+            priority = PRIORITIES['edit']
+        else:
+            if self.orders.pop_cancelled(quote['order_id']):
+                # Сюда попадают ордера которые были отменены до их обработки
+                return True
+            order_type = quote['order_type']
+            if order_type == 'market':
+                priority = PRIORITIES['market']
+            elif order_type == 'limit' or order_type in IMMEDIATE_TYPES \
+                    or order_type in TRIGGERED_TYPES:
+                priority = PRIORITIES['limit']
+            else:
+                return True
+        if self.heap_queue.offer(priority, quote['timestamp'], quote):
+            return True
+        self.shed(quote)
+        return False
+
+    def shed(self, quote):
+        """
+        Count the shed message and raise {pair}_busy for busy_ttl ms,
+        the API rejects orders of the pair without sending them meanwhile
+        """
+        if self.metrics is not None:
+            self.metrics.inc('engine_shed_total', type='edit'
+                             if quote.get("edited") else quote['order_type'])
+        now = time.monotonic()
+        if now >= self.busy_until:
+            r.set(f"{self._pair}_busy", 1, px=self.busy_ttl)
+            # refreshed at the half of the ttl at most
+            self.busy_until = now + self.busy_ttl / 2000
 
 
 class OrderBook(Process):
-    def __init__(self, pair):
+    def __init__(self, pair, backends=None):
+        """
+        :param backends: storage.Backends - order state, balances and
+                         persistence, redis/ORM by default
+        """
         Process.__init__(self)
         self._pair = pair
-        self.tape = deque(maxlen=None)  # Index[0] is most recent trade
+        self.backends = backends or redis_backends()
+        self.orders = self.backends.orders
+        self.balances = self.backends.balances
+        self.persistence = self.backends.persistence
+        # Index[0] is most recent trade
+        self.tape = deque(maxlen=getattr(settings, "TAPE_SIZE", 1000))
+        self.trade_log = TradeLog(pair)
         self.bids = OrderTree()
         self.asks = OrderTree()
-        self.heap_queue = HeapQueue()
-        self.total_time = 0
+        self.stops = StopIndex()
+        # good-till-time orders
+        self.expiries = TimingWheel(
+            getattr(settings, "EXPIRY_RESOLUTION", 1)
+        )
+        self.heap_queue = HeapQueue(queue_capacities())
+        self.self_trade_prevention = getattr(
+            settings, "SELF_TRADE_PREVENTION", 'cancel_newest'
+        )
+        for band in getattr(settings, "DEPTH_BANDS", {}).get(pair, ()):
+            self.bids.add_band(Decimal(band), ROUND_FLOOR)
+            self.asks.add_band(Decimal(band), ROUND_CEILING)
+        self.depth = DepthPublisher(pair, self.bids, self.asks)
+        self.candles = CandleAggregator(pair)
+        self.ticker = Ticker(pair)
+        self.market_data = MarketDataPublisher(pair)
+        self.new_trades = []
+        self.latency = None
+        self.metrics = Metrics(pair, 'engine')
+        self.metrics_server = None
+        self.register_gauges()
+        self.diagnostics = Diagnostics(pair)
+        self.gc = GCControl(self.metrics)
+
+    def register_gauges(self):
+        """Metrics of the engine, gauges are read when scraped"""
+        sides = (('bid', self.bids), ('ask', self.asks))
+        describe = self.metrics.describe
+        describe('engine_orders_total', "Messages processed by type")
+        describe('engine_fills_total', "Trades")
+        describe('engine_cancels_total', "Cancelled orders by reason")
+        describe('engine_busy_seconds_total', "Time spent processing messages")
+        describe('engine_shed_total',
+                 "Orders rejected because their queue was full")
+        gauge = self.metrics.gauge
+        gauge('engine_heap_queue_depth', self.heap_queue.size,
+              "Messages waiting for the engine")
+        gauge('engine_heap_queue_priority_depth',
+              lambda: {(('priority', str(priority)),): size
+                       for priority, size in self.heap_queue.sizes.items()},
+              "Messages waiting for the engine by priority")
+        gauge('engine_writer_queue_depth', self.persistence.qsize,
+              "Commands waiting for the DB writer")
+        gauge('engine_resting_orders',
+              lambda: {(('side', side),): len(tree) for side, tree in sides},
+              "Orders at the book")
+        gauge('engine_price_levels',
+              lambda: {(('side', side),): tree.depth for side, tree in sides},
+              "Price levels at the book")
+        gauge('engine_book_volume',
+              lambda: {(('side', side),): tree.volume for side, tree in sides},
+              "Quantity at the book")
+        gauge('engine_stop_orders', lambda: len(self.stops),
+              "Stop orders waiting for their price")
+        gauge('engine_gtt_orders', lambda: len(self.expiries),
+              "Good-till-time orders waiting for expiry")
+        gauge('engine_gc_frozen_objects', gc.get_freeze_count,
+              "Objects moved to the permanent generation")
 
     def run_helper_processes(self):
-        self.writer_mpqueue = mpqueue()
-        self.writer = DBwriter(self.writer_mpqueue, self._pair)
-        self.writer.start()
+        self.persistence.start(self._pair)
 
-        self.socket_handler = SocketHandler(self._pair, self.heap_queue)
+        self.market_data.start()
+
+        self.socket_handler = SocketHandler(self._pair, self.heap_queue,
+                                            self.diagnostics, self.orders,
+                                            start_flow_recorder(self._pair),
+                                            self.metrics)
         self.socket_handler.start()
 
     def process_order(self, quote):
         if quote == 'STOP':
             self.socket_handler.join()
-            self.writer_mpqueue.put(('stop', ''))
-            self.writer.join()
+            self.persistence.stop()
+            self.market_data.stop()
             return False
+        if quote.get('cancel_all', False):
+            self.metrics.inc('engine_orders_total', type='cancel_all')
+            self.cancel_all(quote['user_id'], quote.get('side'))
+            return True
         if quote.get('cancelled', False):
+            self.metrics.inc('engine_orders_total', type='cancel')
             self.cancel_order(quote['order_id'])
             return True
         elif quote.get("edited", False):
+            self.metrics.inc('engine_orders_total', type='edit')
             self.edit_order(quote)
             return True
 
+        if self.orders.pop_cancelled(quote['order_id']):
+            # ордер отменили, пока он был в очереди
+            return True
+
         quote['quantity'] = Decimal(quote['quantity'])
         quote['price'] = Decimal(quote['price'])
         quote['initial_quantity'] = Decimal(quote['initial_quantity'])
         # print(f"Incoming quote - {quote}")
-        if quote['order_type'] == 'market':
+        self.metrics.inc('engine_orders_total', type=quote['order_type'])
+        if quote['order_type'] in TRIGGERED_TYPES:
+            self.add_stop(quote)
+        elif quote['order_type'] == 'market':
             self.process_market_order(quote)
         else:
             self.process_limit_order(quote)
+        if quote.get('expires_at') and self.is_resting(quote['order_id']):
+            self.expiries.add(int(quote['order_id']),
+                              float(quote['expires_at']))
         # print(self)
         # print()
         return True
 
     def run(self):
+        setup_django()
+        # latency histograms (settings.LATENCY_HISTOGRAMS)
+        self.latency = start_recorder(self._pair, 'engine')
+        self.metrics_server = start_metrics(self.metrics)
+        # SIGUSR1 - profile, SIGUSR2 - heap
+        self.diagnostics.start()
+        self.gc.install()
         self.run_helper_processes()
+        self.trade_log.open()
+        self.expiries.start(time.time())
         # fill the book with orders from RDB
         self.fill_book()
+        self.candles.load()
+        self.ticker.load(get_candles(
+            self._pair, '1_min', time.time() - self.ticker.window
+        ))
+        # loaded orders are long-lived (settings.LOW_LATENCY_GC)
+        self.gc.after_load()
         r.set('{}_OrderBook_runs'.format(self._pair), True)
 
         while True:
-            priority, timestamp, quote = self.heap_queue.get()
-            ok = self.process_order(quote)
+            try:
+                priority, timestamp, quote = self.heap_queue.get(
+                    timeout=self.depth.interval
+                )
+            except Empty:
+                self.on_idle()
+                continue
+            start = time.perf_counter()
+            if self.latency is not None:
+                ok = self.process_order_timed(quote)
+            else:
+                ok = self.process_order(quote)
+            self.metrics.inc('engine_busy_seconds_total',
+                             time.perf_counter() - start)
             if not ok or self.socket_is_stopped() or self.db_felt():
                 break
+            self.expire_orders()
+            self.depth.mark_dirty()
+            self.publish_market_data()
+            if self.diagnostics.pending:
+                self.diagnostics.run_pending(self.bids, self.asks)
+            self.gc.tick()
         # TODO: Отменить ордера пользователей, чьи ордера находятся в очереди
+        self.publish_market_data(force=True)
+        if self.metrics_server is not None:
+            self.metrics_server.stop()
         r.delete('{}_OrderBook_runs'.format(self._pair))
+        self.trade_log.close()
         self.log_book()
         sys.exit(0)
 
+    def process_order_timed(self, quote):
+        """
+        process_order recording the queue wait since SocketHandler
+        and the matching time
+        :return: result of process_order
+        """
+        queued_at = quote.pop('queued_at', None)
+        start = time.monotonic_ns()
+        if queued_at is not None:
+            self.latency.record('queue_wait', start - queued_at)
+        ok = self.process_order(quote)
+        self.latency.since('match', start)
+        return ok
+
+    def on_idle(self):
+        """Called when no orders came during the publishing interval"""
+        if self.expire_orders():
+            self.depth.mark_dirty()
+        self.publish_market_data(force=True)
+        self.gc.on_idle()
+        if self.diagnostics.pending:
+            self.diagnostics.run_pending(self.bids, self.asks)
+
+    def is_resting(self, order_id):
+        """Is the order at the book or waiting for its stop price"""
+        order_id = int(order_id)
+        return self.bids.order_exists(order_id) or \
+            self.asks.order_exists(order_id) or \
+            self.stops.order_exists(order_id)
+
+    def expire_orders(self, now=None):
+        """
+        Cancel good-till-time orders expired since the previous call
+        with one batch per tick
+        :param now: timestamp to expire up to, the current time by default
+        :return: number of cancelled orders
+        """
+        expired = self.expiries.advance(now or time.time())
+        if not expired:
+            return 0
+        orders = []
+        stops = []
+        for order_id in expired:
+            if self.bids.order_exists(order_id):
+                orders.append(self.bids.get_order(order_id))
+            elif self.asks.order_exists(order_id):
+                orders.append(self.asks.get_order(order_id))
+            elif self.stops.order_exists(order_id):
+                stops.append(self.stops.remove(order_id))
+        return self.cancel_orders(orders, stops, reason='expired')
+
+    def publish_market_data(self, force=False):
+        if self.new_trades:
+            self.market_data.publish('trades', self.new_trades)
+            self.new_trades = []
+        snapshot = self.depth.publish(force)
+        if snapshot:
+            self.market_data.publish('book', self.depth.delta(snapshot))
+        self.candles.flush(force)
+        self.ticker.update_book(self.bids.max_price(), self.asks.min_price())
+        stats = self.ticker.flush(force)
+        if stats:
+            self.market_data.publish('ticker', stats)
+        if self.latency is not None:
+            self.latency.publish(force)
+
+    def record_trade(self, trade):
+        self.metrics.inc('engine_fills_total')
+        trade['seq'] = self.trade_log.append(trade)
+        self.tape.appendleft(trade)
+        self.new_trades.append([
+            trade['seq'], trade['time'], str(trade['price']),
+            str(trade['quantity']), trade['party2'][1]
+        ])
+        self.candles.add_trade(trade['time'], trade['price'],
+                               trade['quantity'])
+        self.ticker.add_trade(trade['time'], trade['price'],
+                              trade['quantity'])
+
     def socket_is_stopped(self):
         if self.socket_handler.is_stopped():
             self.socket_handler.join()
 
-            self.writer_mpqueue.put(('stop', ''))
-            self.writer.join()
+            self.persistence.stop()
+            self.market_data.stop()
             return True
         return False
 
     def fill_book(self):
-        orders = Order.objects.filter(
-            pair=self._pair,
-            quantity__gt=0,
-            status='pending',
-        )
-        for order in orders:
-            quote = {
-                'user_id': order.user_id, 'pair': order.pair,
-                'side': order.side, 'order_type': order.order_type,
-                'initial_quantity': order.initial_quantity,
-                'quantity': order.quantity, 'price': order.price,
-                'timestamp': order.created_at.timestamp(),
-                'order_id': order.pk,
-            }
-            r.hset(f"order_{quote['order_id']}", "at_book", True)
+        for quote in self.persistence.load_orders(self._pair):
+            order_id = quote['order_id']
+            # the order as the API and the engine left it, read at once
+            stored = self.orders.get(order_id)
+            expires_at = stored.get("expires_at")
+            if expires_at:
+                self.expiries.add(order_id, float(expires_at))
+            display_quantity = stored.get("display_quantity")
+            if display_quantity:
+                quote['display_quantity'] = Decimal(str(display_quantity))
+            if quote['order_type'] in TRIGGERED_TYPES:
+                stop_price = stored.get("stop_price")
+                if stop_price:
+                    self.stops.add(quote, Decimal(str(stop_price)))
+                    continue
+                # сработавший стоп-ордер
+                quote['order_type'] = TRIGGERED_TYPES[quote['order_type']]
+            self.orders.update(order_id, {"at_book": True})
             self.bids.insert_order(quote) if quote['side'] == 'bid' \
                 else self.asks.insert_order(quote)
-        connections['default'].close()
 
     def process_order_list(self, side, order_list, quantity_still_to_trade,
                            quote):
@@ -169,188 +466,375 @@ class OrderBook(Process):
         Takes an OrderList (stack of orders at one price)
         and an incoming order and matches
         appropriate trades given the order's quantity.
+        :return: quantity left to trade, trades,
+                 False - the rest of the incoming order is cancelled
+                 by self-trade prevention
         """
         trades = []
         quantity_to_trade = quantity_still_to_trade
+        taker = int(quote['user_id'])
+        stp = self.stp_mode(quote)
         while order_list and quantity_to_trade > 0:
             head_order = order_list.get_head_order()
+            if head_order.user_id == taker and stp in STP_MODES:
+                quantity_to_trade, matching = self.prevent_self_trade(
+                    stp, head_order, quote, quantity_to_trade
+                )
+                if not matching:
+                    return quantity_to_trade, trades, False
+                continue
             head_order_id = head_order.order_id
             traded_price = head_order.price
             counter_party = head_order.user_id
             new_book_quantity = 0
-            if quote['order_type'] == 'market' and quote['side'] == 'bid':
-                ch_quant = head_order.quantity if \
-                    quantity_to_trade <= head_order.quantity \
-                    else quantity_to_trade
-                to_be_checked = quote
-                to_be_checked['price'] = head_order.price
-                to_be_checked['quantity'] = ch_quant
-                enough_assets = MoneyManager(to_be_checked).check_assets()
-                if not enough_assets:
-                    return quantity_to_trade, trades, False
-
             # print(f"Check for comparable:"
             #       f" type of q - {type(quantity_to_trade)}"
             #       f" type of hq - {type(head_order.quantity)}")
 
+            book_side = self.bids if side == 'bid' else self.asks
             if quantity_to_trade < head_order.quantity:
                 traded_quantity = quantity_to_trade
                 # Do the transaction
                 new_book_quantity = head_order.quantity - quantity_to_trade
-                head_order.update_quantity(new_book_quantity,
-                                           head_order.timestamp)
+                book_side.update_order_quantity(head_order_id,
+                                                new_book_quantity)
+                new_book_quantity += head_order.hidden_quantity
                 quantity_to_trade = 0
+            elif head_order.hidden_quantity:
+                # displayed slice of an iceberg is taken - refill it
+                traded_quantity = head_order.quantity
+                book_side.replenish_order(head_order_id, time.time())
+                new_book_quantity = head_order.full_quantity()
+                quantity_to_trade -= traded_quantity
             elif quantity_to_trade == head_order.quantity:
                 traded_quantity = quantity_to_trade
-                if side == 'bid':
-                    self.bids.remove_order_by_id(head_order.order_id)
-                else:
-                    self.asks.remove_order_by_id(head_order.order_id)
+                book_side.remove_order_by_id(head_order.order_id)
                 quantity_to_trade = 0
             else:  # quantity to trade is larger than the head order
                 traded_quantity = head_order.quantity
-                if side == 'bid':
-                    self.bids.remove_order_by_id(head_order.order_id)
-                else:
-                    self.asks.remove_order_by_id(head_order.order_id)
+                book_side.remove_order_by_id(head_order.order_id)
                 quantity_to_trade -= traded_quantity
 
-            # make a dict of head_order
-            head_quote = head_order.__dict__
-            head_quote['pair'] = self._pair
-            head_quote['quantity'] = new_book_quantity
+            trade = {
+                'time': time.time(),
+                'price': traded_price,
+                'quantity': traded_quantity,
+                'party1': [counter_party, side, head_order_id,
+                           new_book_quantity],
+                'party2': [quote['user_id'], quote['side'],
+                           quote['order_id'], quantity_to_trade],
+            }
+            trades.append(trade)
+            self.record_trade(trade)
+            self.trigger_stops(traded_price)
+
+            # make a dict of head_order (the full quantity of an iceberg)
+            head_quote = {
+                'order_id': head_order_id, 'user_id': counter_party,
+                'pair': self._pair, 'side': head_order.side,
+                'order_type': head_order.order_type,
+                'price': traded_price, 'quantity': new_book_quantity,
+                'initial_quantity': head_order.initial_quantity,
+            }
 
             # change quantities of orders at redis
             # current_hq = r.hget(f"order_{head_order_id}", "quantity")
             # current_oq = r.hget(f"order_{quote['order_id']}", "quantity")
             # print(f"Before change: head_q - {current_hq},"
             #       f"order_q - {current_oq}")
-            change_order(head_order_id, str(new_book_quantity))
-            change_order(quote['order_id'], str(quantity_to_trade))
+            self.orders.set_quantity(head_order_id, new_book_quantity)
+            self.orders.set_quantity(quote['order_id'], quantity_to_trade)
             # changed_hq = r.hget(f"order_{head_order_id}", "quantity")
             # changed_oq = r.hget(f"order_{quote['order_id']}", "quantity")
             # print(f"After change: head_q - {changed_hq},"
             #       f"order_q - {changed_oq}")
 
-            # change assets of users at redis and makes transactions to RDB
-            order, head_order = change_assets(quote, head_quote, traded_quantity)
-            self.writer_mpqueue.put(('match_transaction', [order, head_order]))
-
             # print(f"Head_quote quantity - {head_quote['quantity']}")
             # put changes of head_order to DBWriter's queue
-            self.writer_mpqueue.put(('update', head_quote))
+            self.persistence.put(('update', head_quote))
 
         return quantity_to_trade, trades, True
 
+    def add_stop(self, quote):
+        """
+        Put the stop order to the StopIndex,
+        it's triggered at once if the last price has already crossed it
+        """
+        self.stops.add(quote, Decimal(quote.pop('stop_price')))
+        if self.ticker.last_price:
+            self.trigger_stops(self.ticker.last_price)
+
+    def trigger_stops(self, last_price):
+        """
+        Stops crossed by the last price become market/limit orders
+        and are put to the queue, so they are matched after
+        the current order
+        """
+        for quote in self.stops.triggered(last_price):
+            quote['order_type'] = TRIGGERED_TYPES[quote['order_type']]
+            self.orders.update(quote['order_id'],
+                               {"order_type": quote['order_type']},
+                               removed=("stop_price",))
+            # already admitted when it came, so never shed
+            self.heap_queue.put(PRIORITIES[quote['order_type']],
+                                quote['timestamp'], quote)
+
+    def settle(self, quote, trades):
+        """
+        Change assets of users at redis and make transactions to RDB
+        for all fills of the incoming order at once
+        """
+        if trades:
+            rows = settle_trades(quote, trades, self.balances)
+            self.persistence.put(('settle', {
+                'order_id': quote['order_id'], 'rows': rows
+            }))
+
+    def stp_mode(self, quote):
+        """
+        Self-trade prevention mode of the incoming order.
+        Fill-or-kill orders cancel the resting orders of the user
+        (cancel_oldest): cancelling or decrementing the incoming order
+        would leave it partially filled
+        """
+        stp = quote.get('stp') or self.self_trade_prevention
+        if quote['order_type'] == 'fok' and stp in STP_MODES:
+            return 'cancel_oldest'
+        return stp
+
+    def prevent_self_trade(self, mode, head_order, quote, quantity_to_trade):
+        """
+        Incoming order met a resting order of the same user:
+        cancel_newest - cancel the rest of the incoming order
+        cancel_oldest - cancel the resting order
+        decrement_both - cancel the smaller quantity of both orders
+        :return: quantity left to trade, False - stop matching
+        """
+        if mode == 'cancel_newest':
+            return quantity_to_trade, False
+        if mode == 'cancel_oldest':
+            self.cancel_orders([head_order])
+            return quantity_to_trade, True
+
+        book_side = self.bids if head_order.side == 'bid' else self.asks
+        decrement = min(quantity_to_trade, head_order.quantity)
+        head_quote = {
+            'order_id': head_order.order_id, 'user_id': head_order.user_id,
+            'pair': self._pair, 'side': head_order.side,
+            'order_type': head_order.order_type,
+            'price': head_order.price, 'quantity': decrement,
+            'initial_quantity': head_order.initial_quantity,
+        }
+        if decrement == head_order.full_quantity():
+            self.cancel_orders([head_order])
+        else:
+            if decrement < head_order.quantity:
+                book_side.update_order_quantity(
+                    head_order.order_id, head_order.quantity - decrement
+                )
+            else:
+                book_side.replenish_order(head_order.order_id, time.time())
+            self.release_quantity(head_quote)
+            head_quote = dict(head_quote,
+                              quantity=head_order.full_quantity())
+            self.orders.set_quantity(head_order.order_id,
+                                     head_quote['quantity'])
+            self.persistence.put(('update', head_quote))
+        self.release_quantity(dict(quote, quantity=decrement))
+        quantity_to_trade -= decrement
+        self.orders.set_quantity(quote['order_id'], quantity_to_trade)
+        return quantity_to_trade, True
+
+    def release_quantity(self, quote):
+        """Unfreeze assets of a part (quote['quantity']) of an order"""
+        if not nothing_frozen(quote):
+            refund_assets([quote], self.balances)
+            self.persistence.put(('cancel_transaction', quote))
+
+    def affordable_quantity(self, quote):
+        """
+        How much a market bid can take from the asks with user's active
+        assets (commission included), checked once before matching.
+        Hidden quantity of icebergs counts: it is refilled at the same price
+        """
+        active_assets = MoneyManager(quote,
+                                     balances=self.balances).active_assets()
+        budget = active_assets / (1 + Decimal(settings.DEFAULT_COMMISSION))
+        quantity, _, _ = self.asks.sweep_budget(budget)
+        return quantity
+
     def process_market_order(self, quote):
         trades = []
         quantity_to_trade = quote['quantity']
         side = quote['side']
         enough_assets = True
+        matching = True
 
         if side == 'bid':
-            while quantity_to_trade > 0 and self.asks and enough_assets:
+            affordable = self.affordable_quantity(quote)
+            # денег не хватит на объем, который есть в стакане
+            # (вместе со скрытым объемом айсбергов)
+            enough_assets = affordable >= quantity_to_trade or \
+                affordable >= self.asks.full_volume()
+            not_affordable = quantity_to_trade - min(quantity_to_trade,
+                                                     affordable)
+            quantity_to_trade -= not_affordable
+            while quantity_to_trade > 0 and self.asks and matching:
                 best_price_asks = self.asks.min_price_list()
-                quantity_to_trade, new_trades, enough_assets = self.process_order_list(
-                    'ask',
-                    best_price_asks, quantity_to_trade, quote
-                )
+                quantity_to_trade, new_trades, matching = \
+                    self.process_order_list('ask', best_price_asks,
+                                            quantity_to_trade, quote)
                 trades += new_trades
+            quantity_to_trade += not_affordable
+            self.settle(quote, trades)
+            if trades:
+                quote['price'] = trades[-1]['price']
         else:
-            while quantity_to_trade > 0 and self.bids:
+            while quantity_to_trade > 0 and self.bids and matching:
                 best_price_bids = self.bids.max_price_list()
-                quantity_to_trade, new_trades, _ = self.process_order_list(
-                    'bid',
-                    best_price_bids, quantity_to_trade, quote
-                )
+                quantity_to_trade, new_trades, matching = \
+                    self.process_order_list('bid', best_price_bids,
+                                            quantity_to_trade, quote)
                 trades += new_trades
+            self.settle(quote, trades)
         quote['quantity'] = quantity_to_trade
 
+        # остаток отменен защитой от сделок с самим собой
+        if not matching:
+            self.persistence.put(('update', quote))
+            self.release_order(quote)
+            return trades
+
         # маркет бид не может удовлетворить требованиям ордеров в стакане
         if not enough_assets:
             # не размораживаем средства, так как нечего.
-            r.delete(f"order_{quote['order_id']}")
-            self.writer_mpqueue.put(('cancel', quote['order_id']))
+            self.orders.delete(quote['order_id'])
+            self.persistence.put(('cancel', quote['order_id']))
             return trades
 
         if quote['quantity'] > 0 and quote['side'] == 'bid':
             # 1) Проверить есть ли цена в стакане
-            # 2) Присвоить ордеру максимальную цену бида или дефолтную
+            # 2) Присвоить ордеру максимальную цену бида или последнюю цену
+            #    сделки, если ее нет - отменить остаток
             # 3) Проверить сможет ли пользователь потянуть ордер
             # 4) Если сможет заморозить средства,
             #    изменить цену ордера и добавить в дерево/ордерлист
-            # 5) Не сможет - отдать оставшиеся средства,
-            #    удалить ордер из редиса и отменить ордер в бд
-            max_bid_price = self.bids.max_price()
-            if max_bid_price:
-                quote['price'] = Decimal(max_bid_price)
-            else:
-                quote['price'] = Decimal(
-                    str(round(float(random.uniform(0.00000001, 10.0)), 9))
-                )
-
-            mm = MoneyManager(quote)
-            if mm.check_assets():
+            # 5) Не сможет - удалить ордер из редиса и отменить ордер в бд
+            # остаток не ставится по цене, пересекающей аски
+            quote['price'] = self.resting_price(self.bids.max_price())
+            mm = MoneyManager(quote, balances=self.balances) \
+                if quote['price'] and not self.crosses(quote) else None
+            if mm and mm.check_assets():
                 mm.freeze()
-                r.hset(f"order_{quote['order_id']}", "price",
-                       str(quote['price']))
-                r.hset(f"order_{quote['order_id']}", "at_book", True)
-                self.writer_mpqueue.put(('freeze', quote))
+                self.orders.update(quote['order_id'], {
+                    "price": quote['price'], "at_book": True
+                })
+                self.persistence.put(('freeze', quote))
                 self.bids.insert_order(quote)
             else:
-                mm.refund()
-                r.delete(f"order_{quote['order_id']}")
-                self.writer_mpqueue.put(('cancel', quote['order_id']))
+                if trades:
+                    self.persistence.put(('update', quote))
+                self.release_order(quote)
+                return trades
         elif quote['quantity'] > 0 and quote['side'] == 'ask':
-            # 1) Присвоить ордеру минимальную цену аска или дефолтную
+            # 1) Присвоить ордеру минимальную цену аска или последнюю цену
+            #    сделки, если ее нет - отменить остаток
             # 2) Изменить цену ордера в редисе и добавить в дерево/ордерлист
-            min_ask_price = self.asks.min_price()
-            if min_ask_price:
-                quote['price'] = Decimal(min_ask_price)
+            quote['price'] = self.resting_price(self.asks.min_price())
+            if quote['price'] and not self.crosses(quote):
+                self.orders.update(quote['order_id'], {
+                    "price": quote['price'], "at_book": True
+                })
+                self.asks.insert_order(quote)
             else:
-                quote['price'] = Decimal(
-                    str(round(float(random.uniform(0.00000001, 10.0)), 9))
-                )
-            r.hset(f"order_{quote['order_id']}", "price", str(quote['price']))
-            r.hset(f"order_{quote['order_id']}", "at_book", True)
-            self.asks.insert_order(quote)
-        self.writer_mpqueue.put(('update', quote))
+                if trades:
+                    self.persistence.put(('update', quote))
+                self.release_order(quote)
+                return trades
+        self.persistence.put(('update', quote))
         # print(trades)
         return trades
 
+    def resting_price(self, best_price):
+        """
+        Price of the rest of a market order:
+        the best price of its side or the last trade price
+        :return: Decimal, 0 - the pair has no price yet
+        """
+        if best_price:
+            return Decimal(best_price)
+        return self.ticker.last_price or Decimal(0)
+
+    def crosses(self, quote):
+        """
+        Would the order resting at its price match the other side
+        of the book
+        """
+        if quote['side'] == 'bid':
+            return bool(self.asks) and quote['price'] >= self.asks.min_price()
+        return bool(self.bids) and quote['price'] <= self.bids.max_price()
+
+    def release_order(self, quote):
+        """
+        Cancel the rest of an order that won't get to the book:
+        unfreeze assets (market bids have nothing frozen),
+        remove the order from redis and close it at RDB
+        """
+        if not nothing_frozen(quote):
+            mm = MoneyManager(quote, cancelled=True,
+                              balances=self.balances)
+            self.persistence.put(('cancel_transaction', quote))
+            mm.refund()
+        self.orders.delete(quote['order_id'])
+        self.persistence.put(('cancel', quote['order_id']))
+
     def process_limit_order(self, quote):
+        """
+        IOC - the rest that wasn't matched at once is cancelled,
+        FOK - the order is matched only if it can be filled completely
+        """
         trades = []
         quantity_to_trade = quote['quantity']
         side = quote['side']
         price = quote['price']
+        immediate = quote['order_type'] in IMMEDIATE_TYPES
+        matching = True
+
+        if quote['order_type'] == 'fok' and not self.can_fill(quote):
+            self.release_order(quote)
+            return trades
 
         if side == 'bid':
-            while self.asks and price >= self.asks.min_price() and quantity_to_trade > 0:
+            while self.asks and price >= self.asks.min_price() and quantity_to_trade > 0 and matching:
                 best_price_asks = self.asks.min_price_list()
                 # print(f"Best_price_asks\n{best_price_asks}")
-                quantity_to_trade, new_trades, _ = self.process_order_list(
-                    'ask',
-                    best_price_asks, quantity_to_trade, quote
-                )
+                quantity_to_trade, new_trades, matching = \
+                    self.process_order_list('ask', best_price_asks,
+                                            quantity_to_trade, quote)
                 trades += new_trades
+            # self-trade prevention cancelled the rest
+            immediate = immediate or not matching
+            self.settle(quote, trades)
             # If volume remains, need to update the book with new quantity
-            if quantity_to_trade > 0:
+            if quantity_to_trade > 0 and not immediate:
                 quote['quantity'] = quantity_to_trade
-                r.hset(f"order_{quote['order_id']}", "at_book", True)
+                self.orders.update(quote['order_id'], {"at_book": True})
                 self.bids.insert_order(quote)
         else:
-            while self.bids and price <= self.bids.max_price() and quantity_to_trade > 0:
+            while self.bids and price <= self.bids.max_price() and quantity_to_trade > 0 and matching:
                 best_price_bids = self.bids.max_price_list()
                 # print(f"Best_price_asks\n{best_price_bids}")
-                quantity_to_trade, new_trades, _ = self.process_order_list(
-                    'bid',
-                    best_price_bids, quantity_to_trade, quote
-                )
+                quantity_to_trade, new_trades, matching = \
+                    self.process_order_list('bid', best_price_bids,
+                                            quantity_to_trade, quote)
                 trades += new_trades
+            # self-trade prevention cancelled the rest
+            immediate = immediate or not matching
+            self.settle(quote, trades)
             # If volume remains, need to update the book with new quantity
-            if quantity_to_trade > 0:
+            if quantity_to_trade > 0 and not immediate:
                 quote['quantity'] = quantity_to_trade
-                r.hset(f"order_{quote['order_id']}", "at_book", True)
+                self.orders.update(quote['order_id'], {"at_book": True})
                 self.asks.insert_order(quote)
 
         # Pass the order to write into DB
@@ -358,10 +842,33 @@ class OrderBook(Process):
         quote['quantity'] = quantity_to_trade
         initial_quantity = quote['initial_quantity']
         if quantity_to_trade != initial_quantity:
-            self.writer_mpqueue.put(('update', quote))
+            self.persistence.put(('update', quote))
+        if quantity_to_trade > 0 and immediate:
+            self.release_order(quote)
         # print(f"Trades done - {trades}")
         return trades
 
+    def can_fill(self, quote):
+        """
+        Can the order be filled completely within its price,
+        checked by the level sums without touching the book.
+        Orders of the same user within the price are not liquidity
+        when self-trade prevention is on, so the sweep takes that much more
+        """
+        bid = quote['side'] == 'bid'
+        book_side = self.asks if bid else self.bids
+        price = quote['price']
+        quantity = quote['quantity']
+        if self.stp_mode(quote) in STP_MODES:
+            for order in book_side.user_orders(quote['user_id']):
+                if (order.price <= price) if bid else (order.price >= price):
+                    quantity += order.full_quantity()
+        filled, _, worst_price = book_side.sweep_cost(quantity,
+                                                      reverse=not bid)
+        if filled < quantity:
+            return False
+        return worst_price <= price if bid else worst_price >= price
+
     def cancel_order_at_book_db(self, order_id, edited=False):
         exists = self.bids.order_exists(order_id)
         if exists:
@@ -371,9 +878,9 @@ class OrderBook(Process):
             if exists:
                 self.asks.remove_order_by_id(order_id)
         if exists and edited:
-            self.writer_mpqueue.put(('edit', order_id))
+            self.persistence.put(('edit', order_id))
         elif exists:
-            self.writer_mpqueue.put(('cancel', order_id))
+            self.persistence.put(('cancel', order_id))
         else:
             return False
         return True
@@ -423,7 +930,7 @@ class OrderBook(Process):
             dumpfile.write(to_dump)
         dumpfile.close()
         if tapemode == 'wipe':
-            self.tape = []
+            self.tape.clear()
 
     def __str__(self):
         return_value = "*ORDERBOOK*\n"
@@ -465,10 +972,10 @@ class OrderBook(Process):
             f.write("\n")
 
     def db_felt(self):
-        if r.get("db_stopped"):
+        if self.persistence.failed():
             # Остановить DBWriter
-            self.writer_mpqueue.put(('stop', ''))
-            self.writer.join()
+            self.persistence.stop()
+            self.market_data.stop()
 
             # Остановить SocketHandler
             sock = socket.socket()
@@ -492,43 +999,179 @@ class OrderBook(Process):
            если это маркет бид - пропустить этот шаг
         4) удалить ордер в редисе
         """
-        quote = get_order_from_redis(order_id)
+        self.metrics.inc('engine_cancels_total',
+                         reason='edit' if edited else 'user')
+        quote = self.orders.get(order_id)
+        self.expiries.remove(int(order_id))
         # В стакане
         if quote and quote.get("at_book", False):
             self.cancel_order_at_book_db(order_id, edited)
-            mm = MoneyManager(quote, cancelled=True)
-            self.writer_mpqueue.put(('cancel_transaction', quote))
+            mm = MoneyManager(quote, cancelled=True,
+                              balances=self.balances)
+            self.persistence.put(('cancel_transaction', quote))
             mm.refund()
+        # Стоп-ордер, который еще не сработал
+        elif quote and self.stops.remove(order_id):
+            if edited:
+                self.persistence.put(('edit', order_id))
+            else:
+                self.persistence.put(('cancel', order_id))
+            if not nothing_frozen(quote):
+                mm = MoneyManager(quote, cancelled=True,
+                                  balances=self.balances)
+                self.persistence.put(('cancel_transaction', quote))
+                mm.refund()
         # В очереди
         elif quote:
             # Когда тред вытащит ордер - он его пропустит
-            r.hset("cancelled", f"{order_id}", order_id)
+            self.orders.mark_cancelled(order_id)
             if edited:
-                self.writer_mpqueue.put(('edit', order_id))
+                self.persistence.put(('edit', order_id))
             else:
-                self.writer_mpqueue.put(('cancel', order_id))
-            if not (quote['order_type'] == 'market' and quote['side'] == 'bid'):
-                mm = MoneyManager(quote, cancelled=True)
-                self.writer_mpqueue.put(('cancel_transaction', quote))
+                self.persistence.put(('cancel', order_id))
+            if not nothing_frozen(quote):
+                mm = MoneyManager(quote, cancelled=True,
+                                  balances=self.balances)
+                self.persistence.put(('cancel_transaction', quote))
                 mm.refund()
             # иначе не делать рефанд, т.к. маркет бид еще не попал в стакан
-        r.delete(f"order_{order_id}")
+        self.orders.delete(order_id)
+
+    def cancel_all(self, user_id, side=None):
+        """
+        Cancel all orders of the user at the book (of one side if given).
+        Orders still waiting in the queue are not touched
+        :return: number of cancelled orders
+        """
+        orders = []
+        if side in (None, 'bid'):
+            orders += self.bids.user_orders(user_id)
+        if side in (None, 'ask'):
+            orders += self.asks.user_orders(user_id)
+        return self.cancel_orders(orders, reason='mass')
+
+    def cancel_orders(self, orders, stops=(), reason='mass'):
+        """
+        Batch cancel of orders at the book:
+        1) удалить ордера из стакана
+        2) вернуть средства одним пайплайном (суммы по пользователям)
+        3) удалить ордера в редисе
+        4) отдать на запись в БД одной командой
+        :param orders: list of Order
+        :param stops: quotes of stop orders already removed from StopIndex
+        :param reason: label of the cancels counter
+        :return: number of cancelled orders
+        """
+        quotes = list(stops)
+        for order in orders:
+            book_side = self.bids if order.side == 'bid' else self.asks
+            if not book_side.order_exists(order.order_id):
+                continue
+            book_side.remove_order_by_id(order.order_id)
+            quotes.append({
+                'order_id': order.order_id, 'user_id': order.user_id,
+                'pair': self._pair, 'side': order.side,
+                'order_type': order.order_type, 'price': order.price,
+                'quantity': order.full_quantity(),
+                'initial_quantity': order.initial_quantity,
+            })
+        if not quotes:
+            return 0
+        for quote in quotes:
+            self.expiries.remove(int(quote['order_id']))
+        refund_assets(quotes, self.balances)
+        self.orders.delete(*[quote['order_id'] for quote in quotes])
+        self.persistence.put(('cancel_many', {
+            'orders': [dec_to_str(quote) for quote in quotes]
+        }))
+        self.metrics.inc('engine_cancels_total', len(quotes), reason=reason)
+        return len(quotes)
+
+    def amend_order(self, edited_quote, order):
+        """
+        Изменить ордер в стакане без создания нового:
+        1) заморозить/разморозить разницу средств
+        2) та же цена - меньший объем сохраняет место в очереди,
+           больший - ставит ордер в конец очереди
+        3) новая цена - ордер переносится на другой уровень
+           (и может исполниться), айсберг переносится в конец очереди
+        :return: False - not enough assets
+        """
+        book_side = self.bids if order.side == 'bid' else self.asks
+        current_quantity = order.full_quantity()
+        new_price = edited_quote['price'] or order.price
+        new_quantity = edited_quote['quantity'] or current_quantity
+        quote = {
+            'order_id': order.order_id, 'user_id': order.user_id,
+            'pair': self._pair, 'side': order.side,
+            'order_type': order.order_type,
+            'price': order.price, 'quantity': current_quantity,
+            'initial_quantity': order.initial_quantity,
+        }
+        frozen = amend_assets(quote, new_price, new_quantity, self.balances)
+        if frozen is None:
+            return False
+
+        # исполненный объем не меняется
+        quote['initial_quantity'] = order.initial_quantity + \
+            new_quantity - current_quantity
+        quote['price'] = new_price
+        quote['quantity'] = new_quantity
+        quote['timestamp'] = timezone.now().timestamp()
+        self.orders.update(order.order_id, {
+            "price": new_price, "quantity": new_quantity,
+            "initial_quantity": quote['initial_quantity'],
+        })
+        amended = {'amount': frozen[0], 'commission': frozen[1]}
+        amended.update(quote)
+        self.persistence.put(('amend', amended))
+
+        if order.display_quantity:
+            quote['display_quantity'] = order.display_quantity
+            book_side.remove_order_by_id(order.order_id)
+            self.process_limit_order(quote)
+        elif new_price == order.price:
+            order.initial_quantity = quote['initial_quantity']
+            book_side.update_order_quantity(
+                order.order_id, new_quantity,
+                quote['timestamp'] if new_quantity > order.quantity else None
+            )
+        else:
+            book_side.remove_order_by_id(order.order_id)
+            self.process_limit_order(quote)
+        return True
 
     def edit_order(self, edited_quote):
         """
+        Лимитный ордер в стакане изменяется на месте (amend_order), иначе:
         1) проверить сможет ли пользователь выдержать ордер
         2) если не сможет - пропустить ордер, иначе - дальше3) сделать отмену прошлого ордера4) захостить новый ордер"""
-        from orders.serializers.create_order import CreateOrderSerializer
         current_order_id = edited_quote['former_order_id']
-        current_quote = get_order_from_redis(current_order_id)
+        current_quote = self.orders.get(current_order_id)
+        if not current_quote or self.stops.order_exists(current_order_id):
+            # стоп-ордера не изменяются, только отменяются
+            return None
         order_type = current_quote['order_type']
 
         edited_quantity = Decimal(edited_quote['quantity'])
         edited_price = Decimal(edited_quote['price'])
+        # 0 - не изменяется, отрицательные и не числа отклоняются
+        # до изменения средств и стакана
+        if not (edited_quantity.is_finite() and edited_price.is_finite()) \
+                or edited_quantity < 0 or edited_price < 0:
+            return None
         edited_quote['quantity'] = edited_quantity
         edited_quote['price'] = edited_price
 
-        result = can_handle(edited_quote, current_quote)
+        book_side = self.bids if current_quote['side'] == 'bid' \
+            else self.asks
+        if order_type == 'limit' and \
+                book_side.order_exists(int(current_order_id)):
+            self.amend_order(edited_quote,
+                             book_side.get_order(int(current_order_id)))
+            return None
+
+        result = can_handle(edited_quote, current_quote, self.balances)
         if not result:
             return None
         self.cancel_order(current_order_id, edited=True)
@@ -547,9 +1190,11 @@ class OrderBook(Process):
             'quantity': edited_quantity,
             'price': edited_price
         }
-        errors = CreateOrderSerializer(data=new_quote).host_order()
-        if errors:
-            print(f"Errors occurred - {errors}")
+        self.host_order(new_quote)
+
+    def host_order(self, quote):
+        """New order of an edit is created like the API does"""
+        self.persistence.host_order(quote)
 
 
 if __name__ == '__main__':
@@ -0,0 +1,73 @@
+"""
+Recorded order flow of a pair.
+
+With settings.RECORD_ORDER_FLOW SocketHandler appends every message it
+receives (new, cancelled, edited orders, cancel_all) to
+{ORDER_FLOW_DIR}/{pair}_flow_{YYYYMMDD}.jsonl in the order they came,
+one message per line as the API sent it. simulation.Simulation replays
+these files through OrderBook.
+"""
+import json
+import os
+import time
+
+from django.conf import settings
+
+
+BUFFER = 1 << 16
+
+
+def flow_dir():
+    return getattr(settings, "ORDER_FLOW_DIR", os.path.join(
+        os.path.dirname(os.path.abspath(__file__)), 'order_book_logs'
+    ))
+
+
+class FlowRecorder:
+    """
+    Writes messages to a file per day (UTC). Called by the socket thread
+    and buffered, so recording takes nothing from the matching one
+    """
+
+    def __init__(self, pair, directory=None):
+        self._pair = pair
+        self.directory = directory or flow_dir()
+        self.day = None
+        self._file = None
+
+    def path(self, day):
+        return os.path.join(self.directory, f"{self._pair}_flow_{day}.jsonl")
+
+    def write(self, message):
+        day = time.strftime('%Y%m%d', time.gmtime())
+        if day != self.day:
+            self.close()
+            os.makedirs(self.directory, exist_ok=True)
+            self._file = open(self.path(day), 'a', buffering=BUFFER)
+            self.day = day
+        self._file.write(message.strip() + '\n')
+
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+            self.day = None
+
+
+def start_flow_recorder(pair):
+    """:return: FlowRecorder or None if recording is off"""
+    if not getattr(settings, "RECORD_ORDER_FLOW", False):
+        return None
+    return FlowRecorder(pair)
+
+
+def read_flow(*paths):
+    """
+    Messages of recorded files, in the order of the paths
+    :return: generator of dicts
+    """
+    for path in paths:
+        with open(path) as f:
+            for line in f:
+                if line.strip():
+                    yield json.loads(line)
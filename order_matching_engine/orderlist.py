@@ -92,6 +92,8 @@ class OrderList(object):
 
         Check to see that the quantity is larger than existing, update the quantities, then move to tail.
         """
+        if order is self.tail_order:                    # Already the last one
+            return
         if order.prev_order is not None:                # This Order is not the first Order in the OrderList
             order.prev_order.next_order = order.next_order      # Link the previous Order to the next Order,
                                                                 #  then move the Order to tail
@@ -101,6 +103,8 @@ class OrderList(object):
         order.next_order.prev_order = order.prev_order
 
         # Move Order to the last position. Link up the previous last position Order.
+        order.prev_order = self.tail_order
+        order.next_order = None
         self.tail_order.next_order = order
         self.tail_order = order
 
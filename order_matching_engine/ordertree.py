@@ -1,4 +1,7 @@
+from itertools import islice
+
 from bintrees import RBTree
+from .level_sums import LevelSums
 from .order import Order
 from .orderlist import OrderList
 
@@ -15,9 +18,18 @@ class OrderTree(object):
         self.price_tree = RBTree()
         self.price_map = {}     # Dictionary containing price : OrderList object
         self.order_map = {}     # Dictionary containing order_id : Order object
+        self.user_map = {}      # Dictionary containing user_id : {order_id : Order object}
         self.volume = 0         # Contains total quantity from all Orders in tree
         self.num_orders = 0     # Contains count of Orders in tree
         self.depth = 0          # Number of different prices in tree
+        # Dictionary containing band : (rounding, RBtree of band price :
+        # [volume, number of orders]), kept up to date on every change
+        self.bands = {}
+        # volume and notional sums of price levels, hidden quantity included
+        self.sums = LevelSums()
+        # Dictionary containing price : volume change not yet in sums,
+        # applied at once when a sweep needs them
+        self.pending_sums = {}
 
     def __len__(self):
         return len(self.order_map)
@@ -28,6 +40,10 @@ class OrderTree(object):
     def get_order(self, order_id):
         return self.order_map[order_id]
 
+    def user_orders(self, user_id):
+        """Orders of the user in the order they came to the tree"""
+        return list(self.user_map.get(int(user_id), {}).values())
+
     def create_price(self, price):
         # Add a price depth level to the tree
         self.depth += 1
@@ -59,23 +75,40 @@ class OrderTree(object):
         order = Order(quote, self.price_map[quote['price']])
         self.price_map[order.price].append_order(order)
         self.order_map[order.order_id] = order
+        self.user_map.setdefault(order.user_id, {})[order.order_id] = order
         self.volume += order.quantity
+        self._level_changed(order.price, order.quantity, 1,
+                            order.hidden_quantity)
 
     def update_order(self, order_update):
         order = self.order_map[order_update['order_id']]
-        original_quantity = order.quantity
         if order_update['price'] != order.price:
-            # Price changed. Remove order and update tree.
-            order_list = self.price_map[order.price]
-            order_list.remove_order(order)
-            # If there is nothing else in the OrderList, remove the price from RBtree
-            if len(order_list) == 0:
-                self.remove_price(order.price)
+            # Price changed. Remove order and insert it at the new price.
+            self.remove_order_by_id(order.order_id)
             self.insert_order(order_update)
         else:
             # Quantity changed. Price is the same.
-            order.update_quantity(order_update['quantity'], order_update['timestamp'])
-        self.volume += order.quantity - original_quantity
+            self.update_order_quantity(order.order_id,
+                                       order_update['quantity'],
+                                       order_update['timestamp'])
+
+    def update_order_quantity(self, order_id, new_quantity, timestamp=None):
+        order = self.order_map[order_id]
+        delta = new_quantity - order.quantity
+        order.update_quantity(
+            new_quantity, order.timestamp if timestamp is None else timestamp
+        )
+        self.volume += delta
+        self._level_changed(order.price, delta, 0)
+
+    def replenish_order(self, order_id, timestamp):
+        """Refill the displayed slice of an iceberg order"""
+        order = self.order_map[order_id]
+        hidden_quantity = order.hidden_quantity
+        delta = order.replenish(timestamp)
+        self.volume += delta
+        self._level_changed(order.price, delta, 0,
+                            order.hidden_quantity - hidden_quantity)
 
     def remove_order_by_id(self, order_id):
         self.num_orders -= 1
@@ -85,6 +118,106 @@ class OrderTree(object):
         if len(order.order_list) == 0:
             self.remove_price(order.price)
         del self.order_map[order_id]
+        user_orders = self.user_map[order.user_id]
+        del user_orders[order_id]
+        if not user_orders:
+            del self.user_map[order.user_id]
+        self._level_changed(order.price, -order.quantity, -1,
+                            -order.hidden_quantity)
+
+    def add_band(self, band, rounding):
+        """
+        Start grouping price levels by band.
+        :param band: Decimal, e.g. Decimal('0.01')
+        :param rounding: ROUND_FLOOR for bids, ROUND_CEILING for asks,
+                         so a band never looks better than its levels
+        """
+        self.bands[band] = (rounding, RBTree())
+        for price, order_list in self.price_tree.items():
+            self._band_changed(band, price, order_list.volume,
+                               len(order_list))
+
+    def _band_changed(self, band, price, volume, orders):
+        rounding, band_tree = self.bands[band]
+        band_price = (price / band).to_integral_value(rounding) * band
+        level = band_tree.get(band_price)
+        if level is None:
+            band_tree.insert(band_price, [volume, orders])
+            return
+        level[0] += volume
+        level[1] += orders
+        if not level[1]:
+            band_tree.remove(band_price)
+
+    def _level_changed(self, price, volume, orders, hidden=0):
+        # сумма уровней считает и скрытый объем айсбергов - его можно взять,
+        # бэнды и стакан показывают только видимый
+        pending = self.pending_sums
+        pending[price] = pending.get(price, 0) + volume + hidden
+        # only the bands of the touched level are recounted
+        for band in self.bands:
+            self._band_changed(band, price, volume, orders)
+
+    def price_levels(self, levels=None, reverse=False, band=None,
+                     cumulative=False):
+        """
+        Aggregated price levels starting from the lowest price
+        (or the highest one if reverse):
+        [[price, volume, number of orders], ...]
+        :param band: group levels by the band added with add_band
+        :param cumulative: append total volume and notional up to the level
+        """
+        if band is None:
+            items = ((price, order_list.volume, len(order_list))
+                     for price, order_list
+                     in self.price_tree.iter_items(reverse=reverse))
+        else:
+            items = ((price, volume, orders)
+                     for price, (volume, orders)
+                     in self.bands[band][1].iter_items(reverse=reverse))
+        result = []
+        total = notional = 0
+        for price, volume, orders in islice(items, levels):
+            level = [str(price), str(volume), orders]
+            if cumulative:
+                total += volume
+                notional += volume * price
+                level += [str(total), str(notional)]
+            result.append(level)
+        return result
+
+    def sweep_cost(self, quantity, reverse=False):
+        """
+        Cost of taking quantity from the lowest price
+        (or the highest one if reverse) in O(log levels)
+        :return: filled quantity, notional, worst price
+        """
+        self.flush_sums()
+        return self.sums.sweep(quantity, reverse)
+
+    def sweep_budget(self, notional, reverse=False):
+        """
+        How much can be taken from the lowest price
+        (or the highest one if reverse) for notional in O(log levels)
+        :return: filled quantity, notional, worst price
+        """
+        self.flush_sums()
+        return self.sums.sweep_notional(notional, reverse)
+
+    def full_volume(self):
+        """Quantity of all orders with the hidden quantity of icebergs"""
+        self.flush_sums()
+        return self.sums.volume
+
+    def flush_sums(self):
+        """
+        Apply the pending level changes to the sums: changes of a level
+        between two sweeps (fills, inserts, cancels) cost one treap update
+        """
+        if self.pending_sums:
+            for price, volume in self.pending_sums.items():
+                self.sums.update(price, volume)
+            self.pending_sums = {}
 
     def max_price(self):
         if self.depth > 0:
@@ -0,0 +1,201 @@
+import gc
+import os
+import signal
+import sys
+import time
+import tracemalloc
+from collections import Counter
+from threading import Thread, Lock, Timer
+from types import ModuleType, FunctionType
+
+from django.conf import settings
+
+
+def diagnostics_dir():
+    return getattr(settings, "DIAGNOSTICS_DIR", os.path.join(
+        os.path.dirname(os.path.abspath(__file__)), 'order_book_logs'
+    ))
+
+
+class SamplingProfiler(Thread):
+    """
+    Samples the stack of another thread of the process every interval
+    and writes them in the collapsed format of flamegraph.pl / speedscope:
+        file:function;file:function;... count
+    The profiled thread is never stopped, sampling only takes the GIL.
+    """
+
+    def __init__(self, thread_id, seconds, interval, path):
+        Thread.__init__(self, daemon=True)
+        self.thread_id = thread_id
+        self.seconds = seconds
+        self.interval = interval
+        self.path = path
+        self.samples = 0
+
+    @staticmethod
+    def collapse(frame):
+        stack = []
+        while frame is not None:
+            code = frame.f_code
+            stack.append(f"{os.path.basename(code.co_filename)}:"
+                         f"{code.co_name}")
+            frame = frame.f_back
+        return ';'.join(reversed(stack))
+
+    def run(self):
+        stacks = Counter()
+        end = time.monotonic() + self.seconds
+        while time.monotonic() < end:
+            frame = sys._current_frames().get(self.thread_id)
+            if frame is None:
+                break
+            stacks[self.collapse(frame)] += 1
+            self.samples += 1
+            del frame
+            time.sleep(self.interval)
+        with open(self.path, 'w') as f:
+            for stack, count in stacks.most_common():
+                f.write(f"{stack} {count}\n")
+
+
+def census(*roots):
+    """
+    Objects reachable from the roots by type, without modules, classes
+    and functions they refer to
+    :return: {type name: [count, bytes]}
+    """
+    seen = set()
+    result = {}
+    stack = list(roots)
+    while stack:
+        obj = stack.pop()
+        if id(obj) in seen or \
+                isinstance(obj, (type, ModuleType, FunctionType)):
+            continue
+        seen.add(id(obj))
+        item = result.setdefault(type(obj).__name__, [0, 0])
+        item[0] += 1
+        item[1] += sys.getsizeof(obj)
+        stack.extend(gc.get_referents(obj))
+    return result
+
+
+class Diagnostics:
+    """
+    On-demand diagnostics of the engine of a pair.
+
+    Triggered by signals (SIGUSR1 - profile, SIGUSR2 - heap) or by a
+    {"control": "profile" | "heap"} message at the pair socket. Requests
+    are only remembered there and run by the engine between messages,
+    so the book is never read in the middle of a change:
+    - profile: SamplingProfiler of the matching thread for
+      PROFILE_SECONDS, written to {pair}_profile_{time}.collapsed
+    - heap: census of OrderTree objects by type and, if tracemalloc
+      traces (TRACEMALLOC setting or the previous heap request), top
+      allocations of the book modules, written to {pair}_heap_{time}.txt.
+      Tracing started by a heap request is time-boxed like the profiler:
+      the heap is dumped again after PROFILE_SECONDS (or at the next
+      request) with the allocations and tracemalloc is stopped
+    """
+
+    def __init__(self, pair):
+        self._pair = pair
+        self.pending = {}
+        self._lock = Lock()
+        self.profiler = None
+        self.thread_id = None
+        self.seconds = getattr(settings, "PROFILE_SECONDS", 30)
+        self.interval = getattr(settings, "PROFILE_INTERVAL", 0.005)
+        # follow-up heap request of the tracing started by dump_heap
+        self.heap_timer = None
+
+    def start(self):
+        """Called in the matching thread"""
+        from threading import get_ident
+        self.thread_id = get_ident()
+        signal.signal(signal.SIGUSR1, lambda *args: self.request('profile'))
+        signal.signal(signal.SIGUSR2, lambda *args: self.request('heap'))
+        if getattr(settings, "TRACEMALLOC", False):
+            tracemalloc.start()
+
+    def request(self, name, **options):
+        with self._lock:
+            self.pending[name] = options
+
+    def path(self, kind, extension):
+        now = time.time()
+        stamp = f"{time.strftime('%Y%m%d_%H%M%S', time.localtime(now))}" \
+                f"_{int(now * 1000) % 1000:03d}"
+        return os.path.join(diagnostics_dir(),
+                            f"{self._pair}_{kind}_{stamp}.{extension}")
+
+    def run_pending(self, bids, asks):
+        """
+        Run the requested diagnostics, called by the engine between messages
+        :return: list of written (or being written) files
+        """
+        with self._lock:
+            pending, self.pending = self.pending, {}
+        files = []
+        if 'profile' in pending:
+            if self.profiler is None or not self.profiler.is_alive():
+                options = pending['profile']
+                self.profiler = SamplingProfiler(
+                    self.thread_id,
+                    float(options.get('seconds') or self.seconds),
+                    self.interval, self.path('profile', 'collapsed')
+                )
+                self.profiler.start()
+                files.append(self.profiler.path)
+        if 'heap' in pending:
+            files.append(self.dump_heap(
+                bids, asks, follow_up=pending['heap'].get('follow_up')
+            ))
+        return files
+
+    def dump_heap(self, bids, asks, follow_up=False):
+        """
+        :param follow_up: requested by heap_timer, doesn't start tracing
+                          again if the allocations were dumped before it
+        """
+        path = self.path('heap', 'txt')
+        with open(path, 'w') as f:
+            f.write(f"orders: {len(bids)} bids, {len(asks)} asks, "
+                    f"levels: {bids.depth} bids, {asks.depth} asks\n\n")
+            f.write("OrderTree objects by type\n")
+            f.write("type\tcount\tbytes\n")
+            types = census(bids, asks)
+            for name, (count, size) in sorted(types.items(),
+                                              key=lambda item: -item[1][1]):
+                f.write(f"{name}\t{count}\t{size}\n")
+            f.write(f"total\t{sum(c for c, s in types.values())}\t"
+                    f"{sum(s for c, s in types.values())}\n\n")
+
+            if not tracemalloc.is_tracing():
+                if follow_up:
+                    return path
+                # allocations are traced from now on, the next heap
+                # request shows them
+                tracemalloc.start()
+                self.heap_timer = Timer(self.seconds, self.request,
+                                        ('heap',), {'follow_up': True})
+                self.heap_timer.daemon = True
+                self.heap_timer.start()
+                f.write(f"tracemalloc started, allocations follow in "
+                        f"{self.seconds:g}s or at the next heap request\n")
+                return path
+            snapshot = tracemalloc.take_snapshot().filter_traces([
+                tracemalloc.Filter(True, f"*{os.sep}{name}")
+                for name in ('ordertree.py', 'orderlist.py', 'order.py',
+                             'level_sums.py', 'stop_index.py', 'rbtree.py')
+            ])
+            f.write("Allocations of the book modules\n")
+            for stat in snapshot.statistics('lineno')[:30]:
+                f.write(f"{stat}\n")
+        if self.heap_timer is not None:
+            # трассировка была только для этого дампа
+            self.heap_timer.cancel()
+            self.heap_timer = None
+            tracemalloc.stop()
+        return path
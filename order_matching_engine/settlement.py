@@ -0,0 +1,71 @@
+from _decimal import Decimal
+
+from django.conf import settings
+
+from .histogram import timed
+from .money_manager import nothing_frozen
+from .storage import redis_balances
+
+
+@timed('redis_assets')
+def settle_trades(quote, trades, balances=None):
+    """
+    Settle all fills of an incoming order at once.
+
+    Balances are netted per key and changed at once (one pipeline at
+    redis, the same amounts as change_assets per fill). Transactions are
+    aggregated too: 2 rows for the incoming order and 2 rows for every
+    resting order it was matched with, instead of 4 rows per fill.
+    Per fill details stay at the trade log.
+    :param quote: incoming order
+    :param trades: trades of OrderBook.process_order_list
+    :param balances: BalanceStore, redis by default
+    :return: rows for the DB writer:
+             [curr, user_id, order_id, tx_type, amount, commission]
+    """
+    main_curr, second_curr = quote['pair'].split('_')
+    market_bid = nothing_frozen(quote)
+    commission_rate = Decimal(settings.DEFAULT_COMMISSION)
+    deltas = {}
+    rows = {}
+
+    def add(kind, curr, user_id, amount):
+        key = (kind, curr, user_id)
+        deltas[key] = deltas.get(key, Decimal(0)) + amount
+
+    def add_row(curr, user_id, order_id, tx_type, amount, commission):
+        row = rows.setdefault((curr, user_id, order_id, tx_type),
+                              [Decimal(0), Decimal(0)])
+        row[0] += amount
+        row[1] += commission
+
+    for trade in trades:
+        total = trade['price'] * trade['quantity']
+        maker_user, maker_side, maker_order = trade['party1'][:3]
+        taker_user, taker_side, taker_order = trade['party2'][:3]
+        for user_id, side, order_id, taker in (
+                (taker_user, taker_side, taker_order, True),
+                (maker_user, maker_side, maker_order, False)):
+            if side == 'bid':
+                curr, counter_curr = main_curr, second_curr
+                reduction, incoming = total, trade['quantity']
+            else:
+                curr, counter_curr = second_curr, main_curr
+                reduction, incoming = trade['quantity'], total
+            commission = Decimal(0)
+            if taker and market_bid:
+                # market bid pays commission from active assets
+                commission = reduction * commission_rate
+                add('active', curr, user_id, -(reduction + commission))
+            else:
+                add('frozen', curr, user_id, -reduction)
+            add('active', counter_curr, user_id, incoming)
+            add_row(curr, user_id, order_id, 'reduction',
+                    reduction, commission)
+            add_row(counter_curr, user_id, order_id, 'incoming',
+                    incoming, Decimal(0))
+
+    (balances or redis_balances).change(deltas)
+    return [[curr, user_id, order_id, tx_type, str(amount), str(commission)]
+            for (curr, user_id, order_id, tx_type), (amount, commission)
+            in rows.items()]
@@ -0,0 +1,383 @@
+"""
+Simulation of the order book over recorded or generated order flow.
+
+Messages are matched by the real OrderBook (process_order and everything
+it calls) on in-memory backends, without the socket, the DB writer and
+market data publishing. What the API does before sending an order
+(freezing assets, the order hash) is done by Simulation.submit, the
+messages are queued and taken by priority like SocketHandler does.
+Simulated time is the timestamp of the last message, good-till-time
+orders expire by it.
+
+Strategies trade as their own users: they see every message of the
+flow and the fills of their orders, and submit and cancel orders.
+
+    simulation = Simulation('BTC_ETH', [MyStrategy(user_id=1000000)])
+    report = simulation.run(read_flow('BTC_ETH_flow_20261019.jsonl'))
+"""
+import gc
+import os
+import tempfile
+import time
+from _decimal import Decimal
+
+from .money_manager import MoneyManager, nothing_frozen
+from .order_book import OrderBook, PRIORITIES
+from .storage import memory_backends
+
+
+# ids of the orders submitted by the simulation itself (strategies,
+# edits), far from the ids of recorded orders
+FIRST_ORDER_ID = 10 ** 15
+FLOW_BALANCE = 10 ** 12
+
+
+class Strategy:
+    """
+    Base of simulated strategies. Subclasses override on_message and
+    on_fill and trade with buy/sell/cancel
+    :param user_id: user the orders are submitted as
+    :param balances: {curr: amount} - active assets at the start
+    """
+
+    def __init__(self, user_id, balances):
+        self.user_id = user_id
+        self.initial = {curr: Decimal(amount)
+                        for curr, amount in balances.items()}
+        self.simulation = None
+        self.fills = 0
+        self.maker_fills = 0
+        self.bought = Decimal(0)
+        self.sold = Decimal(0)
+        self.bought_notional = Decimal(0)
+        self.sold_notional = Decimal(0)
+        self.rejected = 0
+
+    def on_start(self):
+        pass
+
+    def on_message(self, quote):
+        """Called after every message of the flow is processed"""
+        pass
+
+    def on_fill(self, trade, side, order_id, remaining, maker):
+        """
+        :param remaining: quantity of the order still at the book
+                          (maker) or to trade (taker)
+        """
+        pass
+
+    def order(self, side, quantity, price=0, order_type='limit', **extra):
+        """:return: order_id, None - not enough assets"""
+        quote = {
+            'user_id': self.user_id, 'side': side, 'order_type': order_type,
+            'quantity': Decimal(quantity), 'price': Decimal(price),
+        }
+        quote.update(extra)
+        order_id = self.simulation.submit(quote, check=True)
+        if order_id is None:
+            self.rejected += 1
+        return order_id
+
+    def buy(self, quantity, price=0, order_type='limit', **extra):
+        return self.order('bid', quantity, price, order_type, **extra)
+
+    def sell(self, quantity, price=0, order_type='limit', **extra):
+        return self.order('ask', quantity, price, order_type, **extra)
+
+    def cancel(self, order_id):
+        self.simulation.submit({'order_id': order_id, 'cancelled': True})
+
+    def cancel_all(self, side=None):
+        self.simulation.submit({'user_id': self.user_id, 'side': side,
+                                'cancel_all': True})
+
+    def record_fill(self, trade, party, maker):
+        user_id, side, order_id, remaining = party
+        notional = trade['price'] * trade['quantity']
+        self.fills += 1
+        self.maker_fills += maker
+        if side == 'bid':
+            self.bought += trade['quantity']
+            self.bought_notional += notional
+        else:
+            self.sold += trade['quantity']
+            self.sold_notional += notional
+        self.on_fill(trade, side, order_id, remaining, maker)
+
+    def assets(self, kind, curr):
+        return self.simulation.balances.get(kind, curr, self.user_id) or \
+            Decimal(0)
+
+    def report(self, mark_price):
+        """
+        PnL is the change of active assets in the main currency, the
+        second one valued at mark_price. Commissions stay frozen, so
+        fees are what is left frozen once the orders are cancelled
+        """
+        main_curr, second_curr = self.simulation.pair.split('_')
+        cash = self.assets('active', main_curr) - \
+            self.initial.get(main_curr, 0)
+        position = self.assets('active', second_curr) - \
+            self.initial.get(second_curr, 0)
+        mark_price = mark_price or Decimal(0)
+        gross = self.sold_notional - self.bought_notional + \
+            (self.bought - self.sold) * mark_price
+        pnl = cash + position * mark_price
+        return {
+            'fills': self.fills,
+            'maker_fills': self.maker_fills,
+            'rejected': self.rejected,
+            'bought': str(self.bought),
+            'sold': str(self.sold),
+            'buy_vwap': str(self.bought_notional / self.bought)
+            if self.bought else None,
+            'sell_vwap': str(self.sold_notional / self.sold)
+            if self.sold else None,
+            'position': str(position),
+            'cash': str(cash),
+            'frozen': {curr: str(self.assets('frozen', curr))
+                       for curr in (main_curr, second_curr)},
+            'pnl': str(pnl),
+            'fees': str(gross - pnl),
+        }
+
+
+class SimulatedBook(OrderBook):
+    """OrderBook of a simulation: fills and edits go to the simulation"""
+
+    def __init__(self, simulation, pair, backends):
+        OrderBook.__init__(self, pair, backends)
+        self.simulation = simulation
+
+    def record_trade(self, trade):
+        # market data is not published: no candles and trades channel,
+        # the ticker is kept for the last price of stop orders
+        self.metrics.inc('engine_fills_total')
+        trade['seq'] = self.trade_log.append(trade)
+        self.tape.appendleft(trade)
+        self.ticker.add_trade(trade['time'], trade['price'],
+                              trade['quantity'])
+        self.simulation.on_trade(trade)
+
+    def host_order(self, quote):
+        self.simulation.submit(quote, check=True)
+
+
+class Simulation:
+    """
+    :param strategies: list of Strategy
+    :param flow_balance: active assets of every user of the flow, their
+                         orders were already accepted by the API
+    :param trade_log: path of the trade log, a temporary file by default
+    """
+
+    def __init__(self, pair, strategies=(), flow_balance=FLOW_BALANCE,
+                 trade_log=None):
+        self.pair = pair
+        self.backends = memory_backends()
+        self.orders = self.backends.orders
+        self.balances = self.backends.balances
+        self.book = SimulatedBook(self, pair, self.backends)
+        self._directory = None
+        if trade_log is None:
+            self._directory = tempfile.TemporaryDirectory()
+            trade_log = os.path.join(self._directory.name,
+                                     f"{pair}_trades.bin")
+        self.book.trade_log.path = trade_log
+        self.strategies = list(strategies)
+        self.by_user = {str(strategy.user_id): strategy
+                        for strategy in self.strategies}
+        self.flow_balance = flow_balance
+        self.funded = set()
+        self.last_id = FIRST_ORDER_ID
+        self.started = False
+        self.now = 0
+        self.messages = 0
+        self.trades = 0
+        self.volume = Decimal(0)
+        self.notional = Decimal(0)
+        self.spread_sum = 0.
+        self.spread_count = 0
+        self.spread_min = None
+        self.spread_max = None
+        self.seconds = 0.       # processing the messages
+        self.wall_seconds = 0.  # reading or generating the flow included
+
+    def fund(self, user_id, balances):
+        self.balances.change({('active', curr, user_id): amount
+                              for curr, amount in balances.items()})
+        self.funded.add(str(user_id))
+
+    def start(self, now):
+        self.started = True
+        self.now = now
+        self.book.trade_log.open()
+        self.book.expiries.start(now)
+        # collection is deferred like in the low latency mode of the engine
+        self.book.gc.low_latency = True
+        self.book.gc.after_load()
+        for strategy in self.strategies:
+            strategy.simulation = self
+            self.fund(strategy.user_id, strategy.initial)
+        for strategy in self.strategies:
+            strategy.on_start()
+
+    def close(self):
+        self.book.trade_log.close()
+        if self.book.gc.low_latency:
+            gc.unfreeze()
+            gc.enable()
+        if self._directory is not None:
+            self._directory.cleanup()
+            self._directory = None
+
+    def submit(self, quote, check=False):
+        """
+        Host the message like the API and queue it like SocketHandler
+        :param check: reject the order if the user can't afford it
+        :return: order_id, None - rejected
+        """
+        heap_queue = self.book.heap_queue
+        quote.setdefault('timestamp', self.now)
+        if quote.get('cancelled') or quote.get('cancel_all'):
+            heap_queue.put(PRIORITIES['cancel'], quote['timestamp'], quote)
+            return quote.get('order_id')
+        if quote.get('edited'):
+            heap_queue.put(PRIORITIES['edit'], quote['timestamp'], quote)
+            return quote['former_order_id']
+        quote.setdefault('pair', self.pair)
+        if 'order_id' not in quote:
+            self.last_id += 1
+            quote['order_id'] = self.last_id
+        quote.setdefault('initial_quantity', quote['quantity'])
+        if not nothing_frozen(quote):
+            mm = MoneyManager(quote, balances=self.balances)
+            if check and not mm.check_assets():
+                return None
+            mm.freeze()
+        self.orders.update(quote['order_id'], quote)
+        heap_queue.put(PRIORITIES['market' if quote['order_type'] == 'market'
+                                  else 'limit'], quote['timestamp'], quote)
+        return quote['order_id']
+
+    def drain(self):
+        """Process the queued messages, triggered stops among them"""
+        heap_queue = self.book.heap_queue
+        while heap_queue.size():
+            priority, timestamp, quote = heap_queue.get()
+            self.book.process_order(quote)
+
+    def on_trade(self, trade):
+        self.trades += 1
+        self.volume += trade['quantity']
+        self.notional += trade['price'] * trade['quantity']
+        for party, maker in ((trade['party1'], True),
+                             (trade['party2'], False)):
+            strategy = self.by_user.get(str(party[0]))
+            if strategy is not None:
+                strategy.record_fill(trade, party, maker)
+
+    def step(self, quote):
+        """One message of the flow"""
+        timestamp = quote.get('timestamp')
+        if timestamp and float(timestamp) > self.now:
+            self.now = float(timestamp)
+        user_id = quote.get('user_id')
+        if user_id is not None and str(user_id) not in self.funded:
+            self.fund(user_id, {curr: self.flow_balance
+                                for curr in self.pair.split('_')})
+        self.submit(quote)
+        self.drain()
+        self.book.gc.tick()
+        if self.book.expire_orders(self.now):
+            self.drain()
+        for strategy in self.strategies:
+            strategy.on_message(quote)
+        if self.strategies:
+            self.drain()
+        self.messages += 1
+        self.sample()
+
+    def sample(self):
+        best_bid = self.book.bids.max_price()
+        best_ask = self.book.asks.min_price()
+        if best_bid is None or best_ask is None:
+            return
+        spread = float(best_ask - best_bid)
+        self.spread_sum += spread
+        self.spread_count += 1
+        if self.spread_min is None or spread < self.spread_min:
+            self.spread_min = spread
+        if self.spread_max is None or spread > self.spread_max:
+            self.spread_max = spread
+
+    def finish(self):
+        """Cancel orders of the strategies, their assets become active"""
+        for strategy in self.strategies:
+            strategy.cancel_all()
+        self.drain()
+
+    def run(self, flow, limit=None, finish=True):
+        """
+        :param flow: iterable of messages (order_flow.read_flow,
+                     benchmarks.flows)
+        :param limit: stop after this many messages
+        :param finish: cancel orders of the strategies at the end,
+                       False - the flow is continued by another run
+        :return: report
+        """
+        perf_counter = time.perf_counter
+        started = perf_counter()
+        try:
+            for quote in flow:
+                if not self.started:
+                    self.start(float(quote.get('timestamp') or time.time()))
+                step_started = perf_counter()
+                self.step(quote)
+                self.seconds += perf_counter() - step_started
+                if limit and self.messages >= limit:
+                    break
+        finally:
+            self.wall_seconds += perf_counter() - started
+        if finish and self.started:
+            self.finish()
+        return self.report()
+
+    def report(self):
+        book = self.book
+        last_price = book.ticker.last_price
+        return {
+            'messages': self.messages,
+            'seconds': self.seconds,
+            'wall_seconds': self.wall_seconds,
+            'events_per_second': self.messages / self.seconds
+            if self.seconds else 0,
+            'trades': self.trades,
+            'volume': str(self.volume),
+            'vwap': str(self.notional / self.volume) if self.volume else None,
+            'last_price': str(last_price) if last_price else None,
+            'spread': {
+                'mean': self.spread_sum / self.spread_count
+                if self.spread_count else None,
+                'min': self.spread_min,
+                'max': self.spread_max,
+            },
+            'book': {
+                'best_bid': str(book.bids.max_price()),
+                'best_ask': str(book.asks.min_price()),
+                'resting_orders': {'bid': len(book.bids),
+                                   'ask': len(book.asks)},
+                'price_levels': {'bid': book.bids.depth,
+                                 'ask': book.asks.depth},
+                'volume': {'bid': str(book.bids.volume),
+                           'ask': str(book.asks.volume)},
+                'stop_orders': len(book.stops),
+                'gtt_orders': len(book.expiries),
+            },
+            'writer_commands': dict(book.persistence.commands),
+            'strategies': {
+                str(strategy.user_id): strategy.report(last_price)
+                for strategy in self.strategies
+            },
+        }
@@ -0,0 +1,65 @@
+from bintrees import RBTree
+
+
+class StopIndex(object):
+    """
+    Pending stop orders of a pair sorted by stop price.
+
+    Bid stops are triggered when the last price rises to the stop price,
+    ask stops - when it falls to the stop price. Each side is an RBTree of
+    stop price : {order_id : quote} (orders of one price are kept in the
+    order they came), so triggering k stops takes O(k log n).
+    """
+
+    def __init__(self):
+        self.bids = RBTree()
+        self.asks = RBTree()
+        self.order_map = {}     # Dictionary containing order_id : (side, stop price)
+
+    def __len__(self):
+        return len(self.order_map)
+
+    def order_exists(self, order_id):
+        return int(order_id) in self.order_map
+
+    def add(self, quote, stop_price):
+        order_id = int(quote['order_id'])
+        tree = self.bids if quote['side'] == 'bid' else self.asks
+        if stop_price not in tree:
+            tree.insert(stop_price, {})
+        tree[stop_price][order_id] = quote
+        self.order_map[order_id] = (quote['side'], stop_price)
+
+    def remove(self, order_id):
+        """
+        :return: quote of the removed stop, None - there is no such stop
+        """
+        order_id = int(order_id)
+        if order_id not in self.order_map:
+            return None
+        side, stop_price = self.order_map.pop(order_id)
+        tree = self.bids if side == 'bid' else self.asks
+        orders = tree[stop_price]
+        quote = orders.pop(order_id)
+        if not orders:
+            tree.remove(stop_price)
+        return quote
+
+    def triggered(self, last_price):
+        """
+        Pop every stop crossed by the last price
+        :return: list of quotes, the earliest stop prices first
+        """
+        quotes = []
+        while self.bids and self.bids.min_key() <= last_price:
+            stop_price, orders = self.bids.pop_min()
+            quotes += self._pop_orders(orders)
+        while self.asks and self.asks.max_key() >= last_price:
+            stop_price, orders = self.asks.pop_max()
+            quotes += self._pop_orders(orders)
+        return quotes
+
+    def _pop_orders(self, orders):
+        for order_id in orders:
+            del self.order_map[order_id]
+        return list(orders.values())
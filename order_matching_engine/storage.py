@@ -0,0 +1,341 @@
+"""
+Storage backends of the engine.
+
+OrderBook works with three stores:
+- OrderStore: live state of orders (redis hashes order_{id} written by the
+  API and the engine, the "cancelled" hash of orders cancelled in the queue)
+- BalanceStore: active and frozen assets of users
+- Persistence: writes the results to the RDB (DBwriter commands) and loads
+  resting orders when the engine starts
+
+Redis/ORM backends are what production runs, in-memory ones keep
+everything in dicts of the process for simulations and load tests.
+"""
+import abc
+from collections import Counter
+from _decimal import Decimal
+
+from . import histogram
+from .histogram import TimedQueue
+from .metrics import enabled as metrics_enabled
+from .utils import r
+
+
+DECIMAL_FIELDS = ('quantity', 'price', 'initial_quantity')
+ZERO = Decimal(0)
+
+
+class OrderStore(abc.ABC):
+    @abc.abstractmethod
+    def get(self, order_id):
+        """
+        :return: dict of the order, quantity/price/initial_quantity
+                 are Decimal, {} - no such order
+        """
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def get_field(self, order_id, field):
+        """:return: str or None"""
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def update(self, order_id, fields, removed=()):
+        """Set fields of the order and remove the removed ones"""
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def set_quantity(self, order_id, quantity):
+        """Zero quantity deletes the order"""
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def delete(self, *order_ids):
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def mark_cancelled(self, order_id):
+        """The order is cancelled while waiting in the queue"""
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def pop_cancelled(self, order_id):
+        """:return: True - the order was cancelled in the queue"""
+        raise NotImplementedError
+
+
+class BalanceStore(abc.ABC):
+    @abc.abstractmethod
+    def get(self, kind, curr, user_id):
+        """
+        :param kind: 'active' or 'frozen'
+        :return: Decimal or None - the user has no such balance
+        """
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def change(self, deltas):
+        """
+        Add amounts to balances at once
+        :param deltas: {(kind, curr, user_id): Decimal}
+        """
+        raise NotImplementedError
+
+
+class Persistence(abc.ABC):
+    def start(self, pair):
+        pass
+
+    @abc.abstractmethod
+    def put(self, item):
+        """(command, payload) of DBwriter"""
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def host_order(self, quote):
+        """New order of an edit, hosted like the API does"""
+        raise NotImplementedError
+
+    def qsize(self):
+        return 0
+
+    def failed(self):
+        """:return: True - writing failed, the engine has to stop"""
+        return False
+
+    def stop(self):
+        pass
+
+    def load_orders(self, pair):
+        """:return: quotes of the resting orders of the pair"""
+        return []
+
+
+class RedisOrderStore(OrderStore):
+    def __init__(self, connection=r):
+        self.r = connection
+
+    def get(self, order_id):
+        quote = {}
+        for key, value in self.r.hgetall(f"order_{order_id}").items():
+            key = key.decode()
+            value = value.decode()
+            if key in DECIMAL_FIELDS:
+                value = Decimal(value)
+            quote[key] = value
+        return quote
+
+    def get_field(self, order_id, field):
+        value = self.r.hget(f"order_{order_id}", field)
+        return value.decode() if value is not None else None
+
+    def update(self, order_id, fields, removed=()):
+        if len(fields) == 1 and not removed:
+            (key, value), = fields.items()
+            self.r.hset(f"order_{order_id}", key, str(value))
+            return
+        pipe = self.r.pipeline()
+        for key, value in fields.items():
+            pipe.hset(f"order_{order_id}", key, str(value))
+        if removed:
+            pipe.hdel(f"order_{order_id}", *removed)
+        pipe.execute()
+
+    def set_quantity(self, order_id, quantity):
+        if Decimal(quantity) == 0:
+            self.r.delete(f"order_{order_id}")
+        else:
+            self.r.hset(f"order_{order_id}", "quantity", str(quantity))
+
+    def delete(self, *order_ids):
+        if order_ids:
+            self.r.delete(*[f"order_{order_id}" for order_id in order_ids])
+
+    def mark_cancelled(self, order_id):
+        self.r.hset("cancelled", f"{order_id}", order_id)
+
+    def pop_cancelled(self, order_id):
+        if self.r.hget("cancelled", f"{order_id}"):
+            self.r.hdel("cancelled", f"{order_id}")
+            return True
+        return False
+
+
+class RedisBalanceStore(BalanceStore):
+    def __init__(self, connection=r):
+        self.r = connection
+
+    def get(self, kind, curr, user_id):
+        value = self.r.get(f"{kind}_{curr}_{user_id}")
+        if not value:
+            return None
+        return Decimal(value.decode())
+
+    def change(self, deltas):
+        if not deltas:
+            return
+        pipe = self.r.pipeline()
+        for (kind, curr, user_id), amount in deltas.items():
+            pipe.incrbyfloat(f"{kind}_{curr}_{user_id}", str(amount))
+        pipe.execute()
+
+
+class ORMPersistence(Persistence):
+    """DBwriter process of the pair, fed through a queue"""
+
+    def __init__(self):
+        self.queue = None
+        self.writer = None
+
+    def start(self, pair):
+        from multiprocessing import Queue as mpqueue
+        from .db_writer import DBwriter
+        self.queue = TimedQueue(
+            mpqueue(), stamped=histogram.enabled() or metrics_enabled()
+        )
+        self.writer = DBwriter(self.queue, pair)
+        self.writer.start()
+
+    def put(self, item):
+        self.queue.put(item)
+
+    def host_order(self, quote):
+        from orders.serializers.create_order import CreateOrderSerializer
+        errors = CreateOrderSerializer(data=quote).host_order()
+        if errors:
+            print(f"Errors occurred - {errors}")
+
+    def qsize(self):
+        return self.queue.qsize() if self.queue is not None else 0
+
+    def failed(self):
+        return bool(r.get("db_stopped"))
+
+    def stop(self):
+        if self.writer is None:
+            return
+        self.queue.put(('stop', ''))
+        self.writer.join()
+        self.writer = None
+
+    def load_orders(self, pair):
+        from django.db import connections
+        from orders.models import Order
+        orders = Order.objects.filter(
+            pair=pair,
+            quantity__gt=0,
+            status='pending',
+        )
+        quotes = [{
+            'user_id': order.user_id, 'pair': order.pair,
+            'side': order.side, 'order_type': order.order_type,
+            'initial_quantity': order.initial_quantity,
+            'quantity': order.quantity, 'price': order.price,
+            'timestamp': order.created_at.timestamp(),
+            'order_id': order.pk,
+        } for order in orders]
+        connections['default'].close()
+        return quotes
+
+
+class InMemoryOrderStore(OrderStore):
+    def __init__(self):
+        self.orders = {}        # str(order_id): dict
+        self.cancelled = set()
+
+    def get(self, order_id):
+        quote = dict(self.orders.get(str(order_id), {}))
+        for key in DECIMAL_FIELDS:
+            if key in quote:
+                quote[key] = Decimal(quote[key])
+        return quote
+
+    def get_field(self, order_id, field):
+        value = self.orders.get(str(order_id), {}).get(field)
+        return str(value) if value is not None else None
+
+    def update(self, order_id, fields, removed=()):
+        order = self.orders.setdefault(str(order_id), {})
+        order.update(fields)
+        for key in removed:
+            order.pop(key, None)
+
+    def set_quantity(self, order_id, quantity):
+        if Decimal(quantity) == 0:
+            self.orders.pop(str(order_id), None)
+        else:
+            self.update(order_id, {'quantity': quantity})
+
+    def delete(self, *order_ids):
+        for order_id in order_ids:
+            self.orders.pop(str(order_id), None)
+
+    def mark_cancelled(self, order_id):
+        self.cancelled.add(str(order_id))
+
+    def pop_cancelled(self, order_id):
+        if str(order_id) in self.cancelled:
+            self.cancelled.discard(str(order_id))
+            return True
+        return False
+
+
+class InMemoryBalanceStore(BalanceStore):
+    def __init__(self):
+        self.balances = {}      # (kind, curr, user_id): Decimal
+
+    def get(self, kind, curr, user_id):
+        return self.balances.get((kind, curr, str(user_id)))
+
+    def change(self, deltas):
+        balances = self.balances
+        for (kind, curr, user_id), amount in deltas.items():
+            if amount.__class__ is not Decimal:
+                amount = Decimal(amount)
+            key = (kind, curr, str(user_id))
+            balances[key] = balances.get(key, ZERO) + amount
+
+
+class InMemoryPersistence(Persistence):
+    """
+    Counts DBwriter commands, keeps them if record is set
+    :param orders: quotes returned by load_orders
+    """
+
+    def __init__(self, orders=(), record=False):
+        self.orders = list(orders)
+        self.record = record
+        self.commands = Counter()
+        self.log = []
+        self.hosted = []    # new orders of edits, there is no API to host them
+
+    def host_order(self, quote):
+        self.hosted.append(quote)
+
+    def put(self, item):
+        self.commands[item[0]] += 1
+        if self.record:
+            self.log.append(item)
+
+    def load_orders(self, pair):
+        return [quote for quote in self.orders if quote['pair'] == pair]
+
+
+class Backends:
+    def __init__(self, orders, balances, persistence):
+        self.orders = orders
+        self.balances = balances
+        self.persistence = persistence
+
+
+redis_orders = RedisOrderStore()
+redis_balances = RedisBalanceStore()
+
+
+def redis_backends():
+    return Backends(redis_orders, redis_balances, ORMPersistence())
+
+
+def memory_backends(orders=(), record=False):
+    return Backends(InMemoryOrderStore(), InMemoryBalanceStore(),
+                    InMemoryPersistence(orders, record))
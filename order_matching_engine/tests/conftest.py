@@ -0,0 +1,88 @@
+import itertools
+import os
+import time
+from _decimal import Decimal
+
+import pytest
+
+try:
+    import django
+    from django.conf import settings
+except ImportError:
+    # the data structures are tested without Django, OrderBook is skipped
+    django = None
+else:
+    if not os.environ.get('DJANGO_SETTINGS_MODULE') and \
+            not settings.configured:
+        settings.configure(
+            DEFAULT_COMMISSION='0.002',
+            PAIRS=('BTC_ETH',),
+            SOCKET_PAIR_PORTS={'BTC_ETH': 9000},
+            METRICS_ENABLED=False,
+            USE_TZ=True,
+        )
+        django.setup()
+
+
+PAIR = 'BTC_ETH'
+USERS = (1, 2, 3)
+FUNDS = Decimal(1000)
+
+
+@pytest.fixture
+def book(tmp_path):
+    """OrderBook of BTC_ETH on the in-memory backends, USERS have FUNDS"""
+    if django is None:
+        pytest.skip("OrderBook needs Django")
+    from orders.order_matching_engine.order_book import OrderBook
+    from orders.order_matching_engine.storage import memory_backends
+    backends = memory_backends(record=True)
+    backends.balances.change({('active', curr, user_id): FUNDS
+                              for curr in PAIR.split('_')
+                              for user_id in USERS})
+    book = OrderBook(PAIR, backends)
+    book.trade_log.path = str(tmp_path / f"{PAIR}_trades.bin")
+    book.trade_log.open()
+    book.expiries.start(time.time())
+    yield book
+    book.trade_log.close()
+
+
+@pytest.fixture
+def place(book):
+    """
+    Host an order like the API does (assets frozen, the order stored)
+    and process it with what it queued (triggered stops)
+    :return: place(user_id, side, quantity, price, order_type, **extra)
+             -> order_id
+    """
+    from orders.order_matching_engine.money_manager import (MoneyManager,
+                                                            nothing_frozen)
+    order_ids = itertools.count(1)
+
+    def place(user_id, side, quantity, price=0, order_type='limit',
+              **extra):
+        order_id = next(order_ids)
+        quote = {
+            'order_id': order_id, 'user_id': user_id, 'pair': PAIR,
+            'side': side, 'order_type': order_type,
+            'quantity': Decimal(quantity), 'price': Decimal(price),
+            'initial_quantity': Decimal(quantity), 'timestamp': time.time(),
+        }
+        quote.update(extra)
+        if not nothing_frozen(quote):
+            MoneyManager(quote, balances=book.balances).freeze()
+        book.orders.update(order_id, quote)
+        book.process_order(dict(quote))
+        while book.heap_queue.size():
+            priority, timestamp, queued = book.heap_queue.get()
+            book.process_order(queued)
+        return order_id
+
+    return place
+
+
+@pytest.fixture
+def trades(book):
+    """Trades recorded by the book, the earliest first"""
+    return lambda: list(reversed(book.tape))
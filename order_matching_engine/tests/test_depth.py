@@ -0,0 +1,64 @@
+import json
+from _decimal import Decimal, ROUND_CEILING, ROUND_FLOOR
+
+import pytest
+
+pytest.importorskip('django')
+
+from orders.benchmarks.fakes import FakeRedis, patch_redis  # noqa: E402
+from orders.order_matching_engine.depth import (  # noqa: E402
+    DepthPublisher, estimate_sweep
+)
+from orders.order_matching_engine.ordertree import OrderTree  # noqa: E402
+from orders.order_matching_engine.utils import r  # noqa: E402
+
+
+@pytest.fixture
+def redis():
+    fake = FakeRedis()
+    patch_redis(fake)
+    yield fake
+    r.set_connection(None)
+
+
+def quote(order_id, side, quantity, price):
+    return {
+        'order_id': order_id, 'user_id': 1, 'side': side,
+        'order_type': 'limit', 'quantity': Decimal(quantity),
+        'initial_quantity': Decimal(quantity), 'price': Decimal(price),
+        'timestamp': 1,
+    }
+
+
+def make_trees():
+    bids, asks = OrderTree(), OrderTree()
+    bids.add_band(Decimal('0.1'), ROUND_FLOOR)
+    asks.add_band(Decimal('0.1'), ROUND_CEILING)
+    bids.insert_order(quote(1, 'bid', 2, '0.125'))
+    bids.insert_order(quote(2, 'bid', 3, '0.12'))
+    asks.insert_order(quote(3, 'ask', 4, '0.13'))
+    asks.insert_order(quote(4, 'ask', 1, '0.13'))
+    return bids, asks
+
+
+def test_snapshot_levels_are_cumulative():
+    bids, asks = make_trees()
+    snapshot = DepthPublisher('BTC_ETH', bids, asks).snapshot()
+    assert snapshot['bids'] == [['0.125', '2', 1, '2', '0.250'],
+                                ['0.12', '3', 1, '5', '0.610']]
+    assert snapshot['asks'] == [['0.13', '5', 2, '5', '0.65']]
+    assert estimate_sweep(snapshot['bids'], Decimal(4)) == \
+        (4, Decimal('0.490'), Decimal('0.12'))
+
+
+def test_publish_writes_the_book_and_its_bands(redis):
+    bids, asks = make_trees()
+    publisher = DepthPublisher('BTC_ETH', bids, asks)
+    assert publisher.publish(force=True)['seq'] == 1
+    # nothing changed since
+    assert publisher.publish(force=True) is None
+    assert json.loads(redis.get('depth_BTC_ETH'))['asks'][0][:3] == \
+        ['0.13', '5', 2]
+    banded = json.loads(redis.get('depth_BTC_ETH_0.1'))
+    assert banded['bids'][0][:3] == ['0.1', '5', 2]
+    assert banded['asks'][0][:3] == ['0.2', '5', 2]
@@ -0,0 +1,73 @@
+import random
+from _decimal import Decimal
+
+from orders.order_matching_engine.level_sums import LevelSums
+
+
+def brute_sweep(levels, quantity, reverse=False):
+    filled = notional = Decimal(0)
+    worst_price = None
+    for price in sorted(levels, reverse=reverse):
+        if quantity <= 0:
+            break
+        taken = min(quantity, levels[price])
+        filled += taken
+        notional += taken * price
+        quantity -= taken
+        worst_price = price
+    return filled, notional, worst_price
+
+
+def test_sweep_takes_levels_from_the_best_price():
+    sums = LevelSums()
+    sums.update(Decimal(10), Decimal(5))
+    sums.update(Decimal(11), Decimal(5))
+    sums.update(Decimal(12), Decimal(5))
+    assert sums.volume == 15
+    assert sums.sweep(Decimal(5)) == (5, 50, 10)
+    assert sums.sweep(Decimal(8)) == (8, 83, 11)
+    assert sums.sweep(Decimal(8), reverse=True) == (8, 93, 11)
+    # more than the book has
+    assert sums.sweep(Decimal(20)) == (15, 165, 12)
+
+
+def test_emptied_level_is_removed():
+    sums = LevelSums()
+    sums.update(Decimal(10), Decimal(5))
+    sums.update(Decimal(11), Decimal(5))
+    sums.update(Decimal(10), Decimal(-5))
+    assert sums.volume == 5
+    assert sums.sweep(Decimal(1)) == (1, 11, 11)
+    sums.update(Decimal(11), Decimal(-5))
+    assert sums.root is None
+    assert sums.sweep(Decimal(1)) == (0, 0, None)
+
+
+def test_sweep_notional_stops_at_a_level_it_cant_take_whole():
+    sums = LevelSums()
+    sums.update(Decimal(10), Decimal(5))
+    sums.update(Decimal(20), Decimal(5))
+    assert sums.sweep_notional(Decimal(50)) == (5, 50, 10)
+    assert sums.sweep_notional(Decimal(90)) == (7, 90, 20)
+    assert sums.sweep_notional(Decimal(1000)) == (10, 150, 20)
+
+
+def test_prefix_sums_match_walking_the_levels():
+    rng = random.Random(7)
+    sums = LevelSums()
+    levels = {}
+    for _ in range(2000):
+        price = Decimal(rng.randint(90, 110))
+        if price in levels and rng.random() < 0.4:
+            volume = -levels[price]
+        else:
+            volume = Decimal(rng.randint(1, 50)) / 10
+        sums.update(price, volume)
+        levels[price] = levels.get(price, 0) + volume
+        if not levels[price]:
+            del levels[price]
+        quantity = Decimal(rng.randint(1, 300)) / 10
+        reverse = rng.random() < 0.5
+        assert sums.sweep(quantity, reverse) == \
+            brute_sweep(levels, quantity, reverse)
+    assert sums.volume == sum(levels.values())
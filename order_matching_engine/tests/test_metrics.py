@@ -0,0 +1,43 @@
+from threading import Thread
+
+import pytest
+
+pytest.importorskip('django')
+
+from orders.order_matching_engine.metrics import Metrics  # noqa: E402
+
+
+def test_render():
+    metrics = Metrics('BTC_ETH', 'engine')
+    metrics.describe('engine_fills_total', "Trades")
+    metrics.inc('engine_fills_total')
+    metrics.inc('engine_fills_total', 2)
+    metrics.observe('engine_busy_seconds', 0.5, type='limit')
+    metrics.gauge('engine_resting_orders', lambda: {(('side', 'bid'),): 3})
+    text = metrics.render()
+    assert '# HELP engine_fills_total Trades\n' in text
+    assert 'engine_fills_total{pair="BTC_ETH",process="engine"} 3\n' in text
+    assert 'engine_busy_seconds_count{pair="BTC_ETH",process="engine",' \
+           'type="limit"} 1\n' in text
+    assert 'engine_resting_orders{pair="BTC_ETH",process="engine",' \
+           'side="bid"} 3\n' in text
+
+
+def test_counters_of_two_threads_while_rendering():
+    """The engine and its socket thread count, the endpoint renders"""
+    metrics = Metrics('BTC_ETH', 'engine')
+
+    def count(name):
+        for number in range(100000):
+            metrics.inc('engine_orders_total', type=str(number % 100))
+            metrics.inc(f"{name}_{number % 300}_total")
+
+    threads = [Thread(target=count, args=(name,))
+               for name in ('engine', 'socket')]
+    for thread in threads:
+        thread.start()
+    while any(thread.is_alive() for thread in threads):
+        metrics.render()
+    for thread in threads:
+        thread.join()
+    assert sum(metrics.counters['engine_orders_total'].values()) == 200000
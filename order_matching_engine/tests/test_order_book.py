@@ -0,0 +1,246 @@
+from _decimal import Decimal
+
+import pytest
+
+from .conftest import FUNDS
+
+
+def assets(book, kind, curr, user_id):
+    return book.balances.get(kind, curr, user_id) or Decimal(0)
+
+
+def commission():
+    from django.conf import settings
+    return Decimal(settings.DEFAULT_COMMISSION)
+
+
+def makers(trades):
+    return [(trade['party1'][2], trade['quantity']) for trade in trades]
+
+
+def test_refilled_iceberg_loses_its_priority(book, place, trades):
+    iceberg = place(1, 'ask', 10, 10, display_quantity=Decimal(2))
+    resting = place(2, 'ask', 3, 10)
+    place(3, 'bid', 2, 10)
+    place(3, 'bid', 4, 10)
+    assert makers(trades()) == [(iceberg, 2), (resting, 3), (iceberg, 1)]
+    order = book.asks.get_order(iceberg)
+    assert (order.quantity, order.hidden_quantity) == (1, 6)
+    assert book.orders.get(iceberg)['quantity'] == 7
+
+
+def test_market_bid_takes_the_hidden_quantity(book, place, trades):
+    iceberg = place(1, 'ask', 10, 1, display_quantity=Decimal(2))
+    bid = place(2, 'bid', 5, order_type='market')
+    assert makers(trades()) == [(iceberg, 2), (iceberg, 2), (iceberg, 1)]
+    assert not book.bids.order_exists(bid)
+    assert book.asks.get_order(iceberg).full_quantity() == 5
+
+
+def test_market_bid_rest_doesnt_cross_the_asks(book, place, trades):
+    """Money for 3 of the iceberg's 10: the rest is cancelled, not resting"""
+    place(1, 'ask', 10, 1, display_quantity=Decimal(2))
+    book.balances.change({('active', 'BTC', 2): 3 * (1 + commission()) - FUNDS})
+    bid = place(2, 'bid', 5, order_type='market')
+    assert sum(trade['quantity'] for trade in trades()) == 3
+    assert not book.bids.order_exists(bid)
+    assert not book.bids
+    assert book.persistence.log[-1] == ('cancel', bid)
+
+
+def self_trade(place, mode):
+    """
+    User 1 rests an ask 5@10, user 2 an ask 5@11,
+    then user 1 bids 8@11 with the self-trade prevention mode
+    """
+    own = place(1, 'ask', 5, 10)
+    other = place(2, 'ask', 5, 11)
+    bid = place(1, 'bid', 8, 11, stp=mode)
+    return own, other, bid
+
+
+def test_cancel_newest_cancels_the_incoming_order(book, place, trades):
+    c = commission()
+    own, other, bid = self_trade(place, 'cancel_newest')
+    assert trades() == []
+    assert book.asks.order_exists(own)
+    assert not book.bids.order_exists(bid)
+    assert book.orders.get(bid) == {}
+    # commission of an unchanged order stays frozen (MoneyManager.refund)
+    assert assets(book, 'active', 'BTC', 1) == FUNDS - 88 * c
+    assert assets(book, 'frozen', 'BTC', 1) == 88 * c
+    assert assets(book, 'frozen', 'ETH', 1) == 5 * (1 + c)
+
+
+def test_cancel_oldest_cancels_the_resting_order(book, place, trades):
+    c = commission()
+    own, other, bid = self_trade(place, 'cancel_oldest')
+    assert makers(trades()) == [(other, 5)]
+    assert not book.asks.order_exists(own)
+    assert book.bids.get_order(bid).quantity == 3
+    assert assets(book, 'active', 'BTC', 1) == FUNDS - 88 * (1 + c)
+    assert assets(book, 'frozen', 'BTC', 1) == 33 + 88 * c
+    assert assets(book, 'active', 'ETH', 1) == FUNDS + 5 - 5 * c
+    assert assets(book, 'frozen', 'ETH', 1) == 5 * c
+    assert assets(book, 'active', 'BTC', 2) == FUNDS + 55
+    assert assets(book, 'frozen', 'ETH', 2) == 5 * c
+
+
+def test_decrement_both_cancels_the_smaller_quantity(book, place, trades):
+    c = commission()
+    own, other, bid = self_trade(place, 'decrement_both')
+    # 5 of the bid is cancelled with the own ask, 3 is traded
+    assert makers(trades()) == [(other, 3)]
+    assert not book.asks.order_exists(own)
+    assert not book.bids.order_exists(bid)
+    assert book.asks.get_order(other).quantity == 2
+    assert assets(book, 'active', 'BTC', 1) == FUNDS - 33 * (1 + c)
+    assert assets(book, 'frozen', 'BTC', 1) == 33 * c
+    assert assets(book, 'active', 'ETH', 1) == FUNDS + 3 - 5 * c
+    assert assets(book, 'frozen', 'ETH', 1) == 5 * c
+    assert assets(book, 'active', 'BTC', 2) == FUNDS + 33
+    assert assets(book, 'frozen', 'ETH', 2) == 5 * (1 + c) - 3
+
+
+@pytest.mark.parametrize('mode', ['cancel_newest', 'cancel_oldest',
+                                  'decrement_both'])
+def test_self_trade_prevention_keeps_assets(book, place, mode):
+    """Nothing is created or lost, only moved between the users"""
+    self_trade(place, mode)
+    for curr in ('BTC', 'ETH'):
+        total = sum(assets(book, kind, curr, user_id)
+                    for kind in ('active', 'frozen') for user_id in (1, 2))
+        assert total == 2 * FUNDS
+
+
+@pytest.mark.parametrize('side', ['bid', 'ask'])
+def test_market_order_without_a_price_is_cancelled(book, place, side):
+    """Empty book and no last price: cancelled, not updated after that"""
+    order_id = place(1, side, 1, order_type='market')
+    log = book.persistence.log
+    assert log[-1] == ('cancel', order_id)
+    assert 'update' not in [command for command, payload in log]
+    assert book.orders.get(order_id) == {}
+    assert not book.bids and not book.asks
+    assert assets(book, 'active', 'BTC', 1) + \
+        assets(book, 'frozen', 'BTC', 1) == FUNDS
+
+
+def test_fok_filled_by_the_exact_quantity(book, place, trades):
+    other = place(2, 'ask', 5, 10)
+    place(1, 'bid', 5, 10, order_type='fok')
+    assert makers(trades()) == [(other, 5)]
+    assert not book.asks
+
+
+def test_fok_filled_across_levels(book, place, trades):
+    first = place(2, 'ask', 3, 10)
+    second = place(2, 'ask', 3, 11)
+    third = place(3, 'ask', 3, 12)
+    place(1, 'bid', 8, 12, order_type='fok')
+    assert makers(trades()) == [(first, 3), (second, 3), (third, 2)]
+    assert book.asks.get_order(third).quantity == 1
+
+
+def test_fok_one_tick_short_is_killed(book, place, trades):
+    place(2, 'bid', 3, 12)
+    place(2, 'bid', 3, 11)
+    fok = place(1, 'ask', 5, Decimal('11.001'), order_type='fok')
+    assert trades() == []
+    assert book.bids.volume == 6
+    assert book.orders.get(fok) == {}
+    assert book.persistence.log[-1] == ('cancel', fok)
+    # quantity unchanged: the commission stays frozen (MoneyManager.refund)
+    assert assets(book, 'active', 'ETH', 1) == FUNDS - 5 * commission()
+
+
+def test_fok_doesnt_count_own_orders(book, place, trades):
+    place(1, 'ask', 5, 10)
+    place(2, 'ask', 5, 11)
+    place(1, 'bid', 8, 11, order_type='fok', stp='cancel_oldest')
+    assert trades() == []
+    assert book.asks.volume == 10
+    # own orders are liquidity when self-trade is allowed
+    place(1, 'bid', 8, 11, order_type='fok', stp='none')
+    assert [trade['quantity'] for trade in trades()] == [5, 3]
+
+
+@pytest.mark.parametrize('mode', ['cancel_newest', 'cancel_oldest',
+                                  'decrement_both'])
+def test_fok_with_self_trade_prevention_fills_completely(book, place,
+                                                         trades, mode):
+    own = place(1, 'ask', 5, 10)
+    first = place(2, 'ask', 5, 11)
+    second = place(3, 'ask', 5, 11)
+    place(1, 'bid', 8, 11, order_type='fok', stp=mode)
+    assert makers(trades()) == [(first, 5), (second, 3)]
+    # own orders in the way are cancelled
+    assert not book.asks.order_exists(own)
+    assert not book.bids
+
+
+def test_fok_not_filled_by_others_keeps_own_orders(book, place, trades):
+    """User A: ask 5@10, user B: ask 5@11, A's FOK bid 8@11"""
+    own = place(1, 'ask', 5, 10)
+    place(2, 'ask', 5, 11)
+    fok = place(1, 'bid', 8, 11, order_type='fok', stp='cancel_oldest')
+    assert trades() == []
+    assert book.asks.order_exists(own)
+    assert book.persistence.log[-1] == ('cancel', fok)
+    assert assets(book, 'frozen', 'ETH', 1) == 5 * (1 + commission())
+
+
+def test_fill_book_restores_resting_orders(book):
+    def loaded(order_id, side, order_type, **extra):
+        quote = {
+            'order_id': order_id, 'user_id': 1, 'pair': 'BTC_ETH',
+            'side': side, 'order_type': order_type,
+            'quantity': Decimal(10), 'initial_quantity': Decimal(10),
+            'price': Decimal(100), 'timestamp': 1,
+        }
+        book.orders.update(order_id, dict(quote, **extra))
+        return quote
+
+    book.persistence.orders = [
+        loaded(1, 'ask', 'limit', display_quantity='2',
+               expires_at=str(10 ** 10)),
+        loaded(2, 'bid', 'stop', stop_price='120'),
+        loaded(3, 'bid', 'stop_limit'),
+    ]
+    book.orders.get_field = None    # one read of the order, not per field
+    book.fill_book()
+    iceberg = book.asks.get_order(1)
+    assert (iceberg.quantity, iceberg.hidden_quantity) == (2, 8)
+    assert 1 in book.expiries.timers
+    assert book.stops.order_exists(2)
+    # triggered before the restart: a limit order now
+    assert book.bids.get_order(3).order_type == 'limit'
+    assert book.orders.get(3)['at_book'] is True
+
+
+def edit(book, order_id, quantity=0, price=0):
+    book.process_order({'edited': True, 'former_order_id': order_id,
+                        'quantity': str(quantity), 'price': str(price),
+                        'timestamp': 2})
+
+
+@pytest.mark.parametrize('quantity, price', [(-5, 0), (0, -1), (-5, -1),
+                                             ('NaN', 0), (0, 'Infinity')])
+def test_invalid_amend_changes_nothing(book, place, quantity, price):
+    bid = place(1, 'bid', 10, 1)
+    balances = dict(book.balances.balances)
+    levels = book.bids.price_levels()
+    edit(book, bid, quantity, price)
+    assert book.balances.balances == balances
+    assert book.bids.price_levels() == levels
+    assert book.orders.get(bid)['quantity'] == 10
+    assert 'amend' not in book.persistence.commands
+
+
+def test_amend_freezes_the_difference(book, place):
+    c = commission()
+    bid = place(1, 'bid', 10, 1)
+    edit(book, bid, quantity=4)
+    assert book.bids.price_levels() == [['1', '4', 1]]
+    assert assets(book, 'frozen', 'BTC', 1) == 4 * (1 + c)
+    assert assets(book, 'active', 'BTC', 1) == FUNDS - 4 * (1 + c)
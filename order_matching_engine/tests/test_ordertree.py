@@ -0,0 +1,76 @@
+from _decimal import Decimal
+
+from orders.order_matching_engine.ordertree import OrderTree
+
+
+def quote(order_id, quantity, price, timestamp=1, user_id=1, **extra):
+    quote = {
+        'order_id': order_id, 'user_id': user_id, 'side': 'ask',
+        'order_type': 'limit', 'quantity': Decimal(quantity),
+        'initial_quantity': Decimal(quantity), 'price': Decimal(price),
+        'timestamp': timestamp,
+    }
+    quote.update(extra)
+    return quote
+
+
+def test_iceberg_shows_its_slice_only():
+    tree = OrderTree()
+    tree.insert_order(quote(1, 10, 100, display_quantity=Decimal(2)))
+    order = tree.get_order(1)
+    assert order.quantity == 2
+    assert order.hidden_quantity == 8
+    assert order.full_quantity() == 10
+    assert tree.volume == 2
+    # the hidden quantity can be taken, the sums count it
+    assert tree.sweep_cost(Decimal(10)) == (10, 1000, 100)
+    assert tree.full_volume() == 10
+
+
+def test_refilled_iceberg_goes_behind_the_level():
+    tree = OrderTree()
+    tree.insert_order(quote(1, 10, 100, display_quantity=Decimal(2)))
+    tree.insert_order(quote(2, 3, 100, user_id=2))
+    order_list = tree.get_price_list(Decimal(100))
+    assert order_list.get_head_order().order_id == 1
+    tree.replenish_order(1, 2)
+    assert order_list.get_head_order().order_id == 2
+    assert order_list.tail_order.order_id == 1
+    assert tree.get_order(1).hidden_quantity == 6
+
+
+def test_refills_keep_the_level_sums():
+    tree = OrderTree()
+    tree.insert_order(quote(1, 5, 100, display_quantity=Decimal(2)))
+    tree.update_order_quantity(1, Decimal(1))
+    tree.replenish_order(1, 2)
+    tree.replenish_order(1, 3)
+    order = tree.get_order(1)
+    assert (order.quantity, order.hidden_quantity) == (1, 0)
+    assert tree.volume == 1
+    assert tree.get_price_list(Decimal(100)).volume == 1
+    assert tree.sweep_cost(Decimal(5)) == (1, 100, 100)
+
+
+def test_user_orders_follow_removal():
+    tree = OrderTree()
+    tree.insert_order(quote(1, 1, 100))
+    tree.insert_order(quote(2, 1, 101))
+    tree.insert_order(quote(3, 1, 101, user_id=2))
+    assert [order.order_id for order in tree.user_orders(1)] == [1, 2]
+    tree.remove_order_by_id(1)
+    tree.remove_order_by_id(2)
+    assert tree.user_orders(1) == []
+    assert 1 not in tree.user_map
+
+
+def test_level_changes_reach_the_sums_at_the_next_sweep():
+    tree = OrderTree()
+    tree.insert_order(quote(1, 5, 100))
+    tree.insert_order(quote(2, 5, 101))
+    tree.update_order_quantity(1, Decimal(2))
+    tree.remove_order_by_id(2)
+    assert tree.pending_sums
+    assert tree.sweep_cost(Decimal(10)) == (2, 200, 100)
+    assert not tree.pending_sums
+    assert tree.sums.volume == tree.volume == 2
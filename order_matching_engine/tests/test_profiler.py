@@ -0,0 +1,51 @@
+import os
+import tracemalloc
+
+import pytest
+
+pytest.importorskip('django')
+
+from orders.order_matching_engine.ordertree import OrderTree  # noqa: E402
+from orders.order_matching_engine.profiler import Diagnostics  # noqa: E402
+
+
+@pytest.fixture
+def diagnostics(tmp_path, monkeypatch):
+    diagnostics = Diagnostics('BTC_ETH')
+    monkeypatch.setattr(diagnostics, 'path',
+                        lambda kind, extension: os.path.join(
+                            tmp_path, f"{len(os.listdir(tmp_path))}.txt"))
+    yield diagnostics
+    if diagnostics.heap_timer is not None:
+        diagnostics.heap_timer.cancel()
+    if tracemalloc.is_tracing():
+        tracemalloc.stop()
+
+
+def dump(diagnostics):
+    with open(diagnostics.run_pending(OrderTree(), OrderTree())[0]) as f:
+        return f.read()
+
+
+def test_heap_request_traces_until_the_next_dump(diagnostics):
+    diagnostics.request('heap')
+    assert 'tracemalloc started' in dump(diagnostics)
+    assert tracemalloc.is_tracing()
+    diagnostics.request('heap')
+    assert 'Allocations of the book modules' in dump(diagnostics)
+    assert not tracemalloc.is_tracing()
+    assert diagnostics.heap_timer is None
+
+
+def test_tracing_stops_after_profile_seconds(diagnostics):
+    diagnostics.seconds = 0.01
+    diagnostics.request('heap')
+    dump(diagnostics)
+    diagnostics.heap_timer.join()
+    assert diagnostics.pending == {'heap': {'follow_up': True}}
+    assert 'Allocations of the book modules' in dump(diagnostics)
+    assert not tracemalloc.is_tracing()
+    # a late follow-up doesn't start tracing again
+    diagnostics.request('heap', follow_up=True)
+    assert 'tracemalloc' not in dump(diagnostics)
+    assert not tracemalloc.is_tracing()
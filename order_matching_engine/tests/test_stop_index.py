@@ -0,0 +1,51 @@
+from _decimal import Decimal
+
+from orders.order_matching_engine.stop_index import StopIndex
+
+
+def stop(order_id, side):
+    return {'order_id': order_id, 'side': side}
+
+
+def test_bid_stops_trigger_when_the_price_rises_to_them():
+    stops = StopIndex()
+    stops.add(stop(1, 'bid'), Decimal(105))
+    stops.add(stop(2, 'bid'), Decimal(110))
+    assert stops.triggered(Decimal(104)) == []
+    assert stops.triggered(Decimal(105)) == [stop(1, 'bid')]
+    assert stops.triggered(Decimal(120)) == [stop(2, 'bid')]
+    assert len(stops) == 0
+
+
+def test_ask_stops_trigger_when_the_price_falls_to_them():
+    stops = StopIndex()
+    stops.add(stop(1, 'ask'), Decimal(95))
+    stops.add(stop(2, 'ask'), Decimal(90))
+    assert stops.triggered(Decimal(96)) == []
+    # the nearest stop price first
+    assert stops.triggered(Decimal(80)) == [stop(1, 'ask'), stop(2, 'ask')]
+
+
+def test_price_between_the_sides_triggers_nothing():
+    stops = StopIndex()
+    stops.add(stop(1, 'bid'), Decimal(105))
+    stops.add(stop(2, 'ask'), Decimal(95))
+    assert stops.triggered(Decimal(100)) == []
+    assert len(stops) == 2
+
+
+def test_orders_of_one_price_keep_their_order():
+    stops = StopIndex()
+    for order_id in (3, 1, 2):
+        stops.add(stop(order_id, 'bid'), Decimal(105))
+    assert [quote['order_id'] for quote in stops.triggered(Decimal(105))] \
+        == [3, 1, 2]
+
+
+def test_removed_stop_is_not_triggered():
+    stops = StopIndex()
+    stops.add(stop(1, 'bid'), Decimal(105))
+    assert stops.remove(1) == stop(1, 'bid')
+    assert stops.remove(1) is None
+    assert not stops.order_exists(1)
+    assert stops.triggered(Decimal(200)) == []
@@ -0,0 +1,58 @@
+from orders.order_matching_engine.timing_wheel import TimingWheel
+
+
+def test_timer_expires_at_its_tick():
+    wheel = TimingWheel(resolution=1, sizes=(10, 10))
+    wheel.start(0)
+    wheel.add('a', 5)
+    assert wheel.advance(4) == []
+    assert wheel.advance(5) == ['a']
+    assert len(wheel) == 0
+
+
+def test_past_expiry_fires_at_the_next_advance():
+    wheel = TimingWheel(resolution=1, sizes=(10, 10))
+    wheel.start(100)
+    wheel.add('a', 50)
+    assert wheel.advance(101) == ['a']
+
+
+def test_timers_cascade_from_the_upper_levels():
+    wheel = TimingWheel(resolution=1, sizes=(10, 10))
+    wheel.start(0)
+    wheel.add('level1', 37)
+    wheel.add('overflow', 250)
+    assert wheel.timers['level1'][0] == 1
+    assert wheel.timers['overflow'] == (None, None)
+    assert wheel.advance(36) == []
+    # moved down to level 0 when its slot of level 1 turned
+    assert wheel.timers['level1'][0] == 0
+    assert wheel.advance(37) == ['level1']
+    assert wheel.advance(199) == []
+    assert wheel.timers['overflow'] == (None, None)
+    # the whole wheel turned, the overflow is placed again
+    assert wheel.advance(200) == []
+    assert wheel.timers['overflow'][0] == 1
+    assert wheel.advance(250) == ['overflow']
+
+
+def test_removed_and_replaced_timers():
+    wheel = TimingWheel(resolution=1, sizes=(10, 10))
+    wheel.start(0)
+    wheel.add('a', 5)
+    wheel.add('b', 5)
+    assert wheel.remove('a')
+    assert not wheel.remove('a')
+    # adding again moves the timer
+    wheel.add('b', 15)
+    assert wheel.advance(10) == []
+    assert wheel.advance(20) == ['b']
+
+
+def test_resolution_groups_timers_by_tick():
+    wheel = TimingWheel(resolution=0.5, sizes=(10, 10))
+    wheel.start(0)
+    wheel.add('a', 1.2)
+    wheel.add('b', 1.4)
+    assert wheel.advance(0.9) == []
+    assert sorted(wheel.advance(1.0)) == ['a', 'b']
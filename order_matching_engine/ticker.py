@@ -0,0 +1,139 @@
+import json
+import time
+from collections import deque
+from _decimal import Decimal
+
+from django.conf import settings
+
+from .candles import PERIODS
+from .utils import r
+
+
+TICKER_FIELDS = ('last_price', 'volume', 'high', 'low', 'open', 'change',
+                 'best_bid', 'best_ask', 'spread', 'last_trade_time')
+
+
+def parse_ticker(raw):
+    ticker = json.loads(raw) if raw else {}
+    return {field: float(ticker.get(field) or 0) for field in TICKER_FIELDS}
+
+
+def get_ticker(pair):
+    """
+    :return: dict of floats, zeros if the pair wasn't traded yet
+    """
+    return parse_ticker(r.get(f"ticker_{pair}"))
+
+
+def get_tickers(pairs):
+    return dict(zip(pairs, map(parse_ticker, r.mget(
+        [f"ticker_{pair}" for pair in pairs]
+    ))))
+
+
+class Ticker:
+    """
+    Rolling window (24h by default) statistics of a pair.
+
+    Trades are counted in one minute buckets
+    [start, open, high, low, close, volume], so the window slides
+    by dropping old buckets instead of recounting trades.
+    Best bid/ask are taken from the book on every flush.
+    Result is stored as json under `ticker_{pair}` key.
+    """
+
+    def __init__(self, pair):
+        self._pair = pair
+        self.window = getattr(settings, "TICKER_WINDOW", 24 * 60 * 60)
+        self.interval = getattr(settings, "TICKER_FLUSH_INTERVAL", 1)
+        self.bucket = PERIODS["1_min"]
+        self.buckets = deque()
+        self.volume = Decimal(0)
+        self.last_price = None
+        self.last_trade_time = None
+        self.best_bid = None
+        self.best_ask = None
+        self.dirty = True
+        self.last_flush = 0
+
+    def load(self, bars):
+        """Warm up the window with the stored 1 minute candles"""
+        for bar in bars:
+            self.buckets.append(list(bar))
+            self.volume += bar[5]
+        if self.buckets:
+            self.last_price = self.buckets[-1][4]
+            self.last_trade_time = self.buckets[-1][0]
+
+    def add_trade(self, timestamp, price, quantity):
+        start = int(timestamp // self.bucket * self.bucket)
+        if not self.buckets or start > self.buckets[-1][0]:
+            self.buckets.append([start, price, price, price, price, quantity])
+        else:
+            bucket = self.buckets[-1]
+            if price > bucket[2]:
+                bucket[2] = price
+            if price < bucket[3]:
+                bucket[3] = price
+            bucket[4] = price
+            bucket[5] += quantity
+        self.volume += quantity
+        self.last_price = price
+        self.last_trade_time = timestamp
+        self.dirty = True
+
+    def update_book(self, best_bid, best_ask):
+        if best_bid != self.best_bid or best_ask != self.best_ask:
+            self.best_bid = best_bid
+            self.best_ask = best_ask
+            self.dirty = True
+
+    def expire(self, now):
+        while self.buckets and self.buckets[0][0] <= now - self.window:
+            self.volume -= self.buckets.popleft()[5]
+            self.dirty = True
+
+    def stats(self):
+        high = low = open_price = None
+        change = spread = Decimal(0)
+        if self.buckets:
+            high = max(bucket[2] for bucket in self.buckets)
+            low = min(bucket[3] for bucket in self.buckets)
+            open_price = self.buckets[0][1]
+            if open_price:
+                change = (self.last_price - open_price) * 100 / open_price
+        if self.best_bid and self.best_ask:
+            spread = (self.best_ask - self.best_bid) * 100 / self.best_ask
+        stats = {
+            'pair': self._pair,
+            'timestamp': time.time(),
+            'last_price': self.last_price,
+            'volume': self.volume,
+            'high': high,
+            'low': low,
+            'open': open_price,
+            'change': change,
+            'best_bid': self.best_bid,
+            'best_ask': self.best_ask,
+            'spread': spread,
+            'last_trade_time': self.last_trade_time,
+        }
+        return {key: str(value) if isinstance(value, Decimal) else value
+                for key, value in stats.items()}
+
+    def flush(self, force=False):
+        """
+        :return: written stats
+                 None - nothing changed or throttled
+        """
+        now = time.time()
+        if not force and now - self.last_flush < self.interval:
+            return None
+        self.expire(now)
+        if not self.dirty:
+            return None
+        stats = self.stats()
+        r.set(f"ticker_{self._pair}", json.dumps(stats))
+        self.dirty = False
+        self.last_flush = now
+        return stats
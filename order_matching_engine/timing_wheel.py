@@ -0,0 +1,97 @@
+class TimingWheel(object):
+    """
+    Hierarchical timing wheel of order expiries.
+
+    Level 0 has a slot per tick (resolution seconds), every next level
+    has a slot per full turn of the previous one, so with the default
+    sizes (60, 60, 24) and 1 second resolution the wheel covers a day,
+    farther expiries wait in the overflow until the top level turns.
+    Adding and removing a timer is O(1), advancing the wheel takes
+    a slot per passed tick plus re-placing timers of the turned slots.
+    """
+
+    def __init__(self, resolution=1.0, sizes=(60, 60, 24)):
+        self.resolution = resolution
+        self.sizes = sizes
+        self.widths = []        # ticks per slot of each level
+        width = 1
+        for size in sizes:
+            self.widths.append(width)
+            width *= size
+        self.span = width       # ticks covered by the whole wheel
+        self.levels = [[{} for _ in range(size)] for size in sizes]
+        self.overflow = {}
+        self.timers = {}        # Dictionary containing key : (level, slot)
+        self.current = 0
+
+    def __len__(self):
+        return len(self.timers)
+
+    def tick(self, timestamp):
+        return int(timestamp // self.resolution)
+
+    def start(self, now):
+        self.current = self.tick(now)
+
+    def add(self, key, expires_at):
+        """
+        Expired timers are fired at the next advance
+        """
+        self.remove(key)
+        self._place(key, max(self.tick(expires_at), self.current + 1))
+
+    def remove(self, key):
+        if key not in self.timers:
+            return False
+        level, slot = self.timers.pop(key)
+        if level is None:
+            del self.overflow[key]
+        else:
+            del self.levels[level][slot][key]
+        return True
+
+    def _place(self, key, tick):
+        for level, (width, size) in enumerate(zip(self.widths, self.sizes)):
+            if tick // width - self.current // width < size:
+                slot = tick // width % size
+                self.levels[level][slot][key] = tick
+                self.timers[key] = (level, slot)
+                return
+        self.overflow[key] = tick
+        self.timers[key] = (None, None)
+
+    def advance(self, now):
+        """
+        Turn the wheel up to now
+        :return: list of expired keys
+        """
+        target = self.tick(now)
+        if not self.timers:
+            self.current = max(self.current, target)
+            return []
+        expired = []
+        while self.current < target:
+            self.current += 1
+            if self.current % self.span == 0:
+                timers, self.overflow = self.overflow, {}
+                self._cascade(timers)
+            for level in range(len(self.sizes) - 1, 0, -1):
+                width = self.widths[level]
+                if self.current % width == 0:
+                    slots = self.levels[level]
+                    slot = self.current // width % self.sizes[level]
+                    timers, slots[slot] = slots[slot], {}
+                    self._cascade(timers)
+            slots = self.levels[0]
+            slot = self.current % self.sizes[0]
+            if slots[slot]:
+                for key in slots[slot]:
+                    del self.timers[key]
+                expired += slots[slot]
+                slots[slot] = {}
+        return expired
+
+    def _cascade(self, timers):
+        for key, tick in timers.items():
+            del self.timers[key]
+            self._place(key, tick)
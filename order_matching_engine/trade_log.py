@@ -0,0 +1,138 @@
+import mmap
+import os
+import struct
+from _decimal import Decimal
+
+from django.conf import settings
+
+
+MAGIC = b'OMETRLG1'
+# magic, number of records
+HEADER = struct.Struct('<8sq')
+# seq, time, price, quantity, maker order_id, taker order_id,
+# maker user_id, taker user_id, taker side (b'b'/b'a')
+RECORD = struct.Struct('<qdqqqqqqc7x')
+# prices and quantities are stored as integers with 10 decimal places,
+# same as DecimalField(max_digits=18, decimal_places=10) in RDB
+SCALE = 10 ** 10
+CHUNK = 65536   # records the file grows by
+
+
+def trade_log_path(pair):
+    pf = getattr(settings, "TRADE_LOG_DIR", os.path.join(
+        os.path.dirname(os.path.abspath(__file__)), 'trade_logs'
+    ))
+    return os.path.join(pf, f"{pair}_trades.bin")
+
+
+def get_trades(pair, before=None, limit=100):
+    """
+    Page through the trades of a pair without touching RDB
+    :param before: seq of the last trade of the previous page
+    :return: list of trades, newest first
+    """
+    if not os.path.exists(trade_log_path(pair)):
+        return []
+    trade_log = TradeLog(pair, readonly=True)
+    trade_log.open()
+    try:
+        return trade_log.page(before, limit)
+    finally:
+        trade_log.close()
+
+
+class TradeLog:
+    """
+    Append-only per-pair log of trades with fixed-width records.
+
+    The file is memory mapped and preallocated by CHUNK records,
+    so appending a trade is a single struct.pack_into.
+    Trade with seq N is the record N - 1.
+    """
+
+    def __init__(self, pair, readonly=False):
+        self.path = trade_log_path(pair)
+        self.readonly = readonly
+        self.count = 0
+        self._file = None
+        self._mmap = None
+
+    def open(self):
+        if self.readonly:
+            self._file = open(self.path, 'rb')
+            self._mmap = mmap.mmap(self._file.fileno(), 0,
+                                   access=mmap.ACCESS_READ)
+        else:
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            exists = os.path.exists(self.path)
+            self._file = open(self.path, 'r+b' if exists else 'w+b')
+            if not exists:
+                self._file.write(HEADER.pack(MAGIC, 0))
+                self._file.truncate(HEADER.size + CHUNK * RECORD.size)
+                self._file.flush()
+            self._mmap = mmap.mmap(self._file.fileno(), 0)
+        magic, self.count = HEADER.unpack_from(self._mmap, 0)
+        if magic != MAGIC:
+            raise ValueError(f"{self.path} is not a trade log")
+
+    def close(self):
+        if self._mmap is not None:
+            if not self.readonly:
+                self._mmap.flush()
+            self._mmap.close()
+            self._file.close()
+            self._mmap = None
+            self._file = None
+
+    def _grow(self):
+        size = len(self._mmap) + CHUNK * RECORD.size
+        self._mmap.flush()
+        self._mmap.close()
+        self._file.truncate(size)
+        self._mmap = mmap.mmap(self._file.fileno(), 0)
+
+    def append(self, trade):
+        """
+        :param trade: trade dict of OrderBook
+        :return: seq of the trade
+        """
+        offset = HEADER.size + self.count * RECORD.size
+        if offset + RECORD.size > len(self._mmap):
+            self._grow()
+        maker_user, _, maker_order = trade['party1'][:3]
+        taker_user, taker_side, taker_order = trade['party2'][:3]
+        seq = self.count + 1
+        RECORD.pack_into(
+            self._mmap, offset,
+            seq, trade['time'],
+            int(trade['price'] * SCALE), int(trade['quantity'] * SCALE),
+            int(maker_order), int(taker_order),
+            int(maker_user), int(taker_user),
+            b'b' if taker_side == 'bid' else b'a'
+        )
+        self.count = seq
+        HEADER.pack_into(self._mmap, 0, MAGIC, seq)
+        return seq
+
+    def read(self, seq):
+        (seq, timestamp, price, quantity, maker_order, taker_order,
+         maker_user, taker_user, taker_side) = RECORD.unpack_from(
+            self._mmap, HEADER.size + (seq - 1) * RECORD.size
+        )
+        return {
+            'seq': seq,
+            'time': timestamp,
+            'price': Decimal(price).scaleb(-10),
+            'quantity': Decimal(quantity).scaleb(-10),
+            'maker_order_id': maker_order,
+            'taker_order_id': taker_order,
+            'maker_user_id': maker_user,
+            'taker_user_id': taker_user,
+            'side': 'bid' if taker_side == b'b' else 'ask',
+        }
+
+    def page(self, before=None, limit=100):
+        """Trades with seq < before (or the last ones), newest first"""
+        last = self.count if before is None else min(before - 1, self.count)
+        first = max(last - limit, 0) + 1
+        return [self.read(seq) for seq in range(last, first - 1, -1)]
@@ -1,16 +1,52 @@
 import os
-import django
 from _decimal import Decimal
 
-os.environ['DJANGO_SETTINGS_MODULE'] = 'cex_backend.settings'
-django.setup()
+from .histogram import timed
 
-from django_redis import get_redis_connection
 
+_django_ready = False
 
-r = get_redis_connection()
 
+def setup_django():
+    """django.setup() once per process, before models are imported"""
+    global _django_ready
+    if _django_ready:
+        return
+    import django
+    os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'cex_backend.settings')
+    django.setup()
+    _django_ready = True
 
+
+class LazyRedis:
+    """
+    Redis client of the process, connected on first use.
+
+    Modules keep `from .utils import r`, set_connection() replaces the
+    client for all of them (another server, a fake in benchmarks).
+    """
+
+    def __init__(self):
+        self._connection = None
+
+    def set_connection(self, connection):
+        self._connection = connection
+
+    def get_connection(self):
+        if self._connection is None:
+            setup_django()
+            from django_redis import get_redis_connection
+            self._connection = get_redis_connection()
+        return self._connection
+
+    def __getattr__(self, name):
+        return getattr(self.get_connection(), name)
+
+
+r = LazyRedis()
+
+
+@timed('redis_orders')
 def get_order_from_redis(order_id):
     order_keys = r.hkeys(f"order_{order_id}")
     return_quote = {}
@@ -23,6 +59,7 @@ def get_order_from_redis(order_id):
     return return_quote
 
 
+@timed('redis_orders')
 def change_order(order_id, new_quantity):
     if Decimal(new_quantity) == 0:
         r.delete(f"order_{order_id}")
@@ -41,6 +78,16 @@ def get_currencies(quote):
     return second_curr, main_curr
 
 
+def dec_to_str(quote):
+    """:return: copy of the quote with Decimal values as str"""
+    another_quote = {}
+    another_quote.update(quote)
+    for key, value in another_quote.items():
+        if isinstance(value, Decimal):
+            another_quote[key] = str(value)
+    return another_quote
+
+
 def get_quantity(quote):
     """
     :param quote: dict
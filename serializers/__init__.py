@@ -1,5 +1,5 @@
 from .create_order import CreateOrderSerializer
-from .cancel_order import CancelOrderSerializer
+from .cancel_order import CancelOrderSerializer, CancelAllOrdersSerializer
 from .pairs_info import (MarketsListSerializer, MarketDetailSerializer,
                          ActiveUserOrdersSerializer, AllUserOrdersSerializer,
                          SliderSerializer)
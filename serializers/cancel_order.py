@@ -29,3 +29,25 @@ class CancelOrderSerializer(serializers.Serializer):
             sock.send(quote.encode())
         else:
             return str(self.errors)
+
+
+class CancelAllOrdersSerializer(serializers.Serializer):
+    user_id = serializers.IntegerField(required=True, validators=[positive_id])
+    pair = serializers.ChoiceField(choices=settings.PAIRS, required=True)
+    side = serializers.ChoiceField(choices=('bid', 'ask'), required=False)
+
+    def cancel_orders(self):
+        if self.is_valid():
+            pair = self.validated_data['pair']
+            quote = json.dumps({
+                "user_id": self.validated_data['user_id'],
+                "side": self.validated_data.get('side'),
+                "timestamp": timezone.now().timestamp(),
+                "cancel_all": True
+            })
+
+            sock = socket.socket()
+            sock.connect(('localhost', settings.SOCKET_PAIR_PORTS[pair]))
+            sock.send(quote.encode())
+        else:
+            return str(self.errors)
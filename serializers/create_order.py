@@ -1,20 +1,21 @@
 from _decimal import Decimal
 
 import json
-import socket
 
 from djmoney.money import Money
 from rest_framework import serializers
 from django.utils import timezone
 from django.conf import settings
-from orders.order_matching_engine.money_manager import MoneyManager
+from orders.order_matching_engine.money_manager import (MoneyManager,
+                                                        nothing_frozen)
 from orders.order_matching_engine.utils import r, get_currencies, get_quantity
 from orders.models import Order
 from transactions.models import (InternalTransactionBTC, InternalTransactionEOS,
                                  InternalTransactionERC20Token, InternalTransactionETH,
                                  InternalTransactionXRP)
 from cryptocurrency.models.wallets import WalletBTC, WalletETH, WalletXRP
-from .utils import dec_to_str
+from .utils import (dec_to_str, engine_is_busy, send_to_engine,
+                    ENGINE_BUSY)
 
 
 def create_at_redis(quote):
@@ -29,6 +30,13 @@ def create_at_redis(quote):
     pipe.hset(f"order_{order_id}", "initial_quantity", str(quote['quantity']))
     pipe.hset(f"order_{order_id}", "price", str(quote['price']))
     pipe.hset(f"order_{order_id}", "timestamp", quote['timestamp'])
+    if quote.get('stop_price'):
+        pipe.hset(f"order_{order_id}", "stop_price", str(quote['stop_price']))
+    if quote.get('expires_at'):
+        pipe.hset(f"order_{order_id}", "expires_at", quote['expires_at'])
+    if quote.get('display_quantity'):
+        pipe.hset(f"order_{order_id}", "display_quantity",
+                  str(quote['display_quantity']))
     pipe.execute()
 
 
@@ -37,7 +45,7 @@ def create_order(quote):
     quantity = quote['quantity']
     user_id = int(quote['user_id'])
 
-    if quote['order_type'] == 'market' and quote['side'] == 'bid':
+    if nothing_frozen(quote):
         market_bid = True
     else:
         mm = MoneyManager(quote)
@@ -47,6 +55,11 @@ def create_order(quote):
         mm.freeze()
 
     quote.update({'initial_quantity': quantity})
+    # стоп-цена, время жизни и видимый объем хранятся только в редисе
+    stop_price = quote.pop('stop_price', None)
+    expires_at = quote.pop('expires_at', None)
+    display_quantity = quote.pop('display_quantity', None)
+    stp = quote.pop('stp', None)
     try:
         order = Order.objects.create(**quote)
         if not market_bid:
@@ -79,6 +92,14 @@ def create_order(quote):
         'order_id': order.pk,
         'timestamp': order.created_at.timestamp()
     }
+    if stop_price:
+        few_items['stop_price'] = stop_price
+    if expires_at:
+        few_items['expires_at'] = expires_at.timestamp()
+    if display_quantity:
+        few_items['display_quantity'] = display_quantity
+    if stp:
+        few_items['stp'] = stp
     quote.update(few_items)
 
     create_at_redis(quote)
@@ -87,12 +108,39 @@ def create_order(quote):
     quote = dec_to_str(quote)
     quote = json.dumps(quote)
 
-    sock = socket.socket()
-    sock.connect(('localhost', settings.SOCKET_PAIR_PORTS[pair]))
-    sock.send(quote.encode())
+    if not send_to_engine(pair, quote):
+        rollback_order(order, None if market_bid else mm)
+        return ENGINE_BUSY
     return None
 
 
+def rollback_order(order, mm=None):
+    """
+    The engine shed the order (its queue is full): the order is closed
+    as cancelled, frozen assets go back to active with the commission
+    and the freeze transaction is reversed by a cancel_bet one
+    :param mm: MoneyManager that froze the assets, None - market bid
+    """
+    r.delete(f"order_{order.pk}")
+    Order.objects.filter(pk=order.pk).update(
+        status='cancelled', closed_at=timezone.now()
+    )
+    if mm is None:
+        return
+    mm.move('frozen', 'active', mm.reserved())
+    main_curr, fil_cur = get_currencies(order.__dict__)
+    amount = Money(get_quantity(order.__dict__), main_curr)
+    comm_amount = Money(
+        Decimal(settings.DEFAULT_COMMISSION) * amount.amount, main_curr
+    )
+    eval(f"InternalTransaction{main_curr}").objects.create(
+        user_id=order.user_id, order_id=order.pk,
+        category='cancel_bet', amount=amount,
+        commission_amount=comm_amount, tx_type='incoming',
+        wallet=eval(f"Wallet{main_curr}").objects.get(user_id=order.user_id)
+    )
+
+
 class CreateOrderSerializer(serializers.Serializer):
     user_id = serializers.IntegerField(required=True)
     pair = serializers.ChoiceField(choices=settings.PAIRS, required=True)
@@ -106,6 +154,48 @@ class CreateOrderSerializer(serializers.Serializer):
     price = serializers.DecimalField(
         max_digits=18, decimal_places=10, required=False
     )
+    stop_price = serializers.DecimalField(
+        max_digits=18, decimal_places=10, required=False
+    )
+    expires_at = serializers.DateTimeField(required=False)
+    display_quantity = serializers.DecimalField(
+        max_digits=18, decimal_places=10, required=False
+    )
+    # self-trade prevention, settings.SELF_TRADE_PREVENTION if not given
+    stp = serializers.ChoiceField(
+        choices=('cancel_newest', 'cancel_oldest', 'decrement_both', 'none'),
+        required=False
+    )
+
+    def validate(self, data):
+        if data['order_type'] in ('stop', 'stop_limit'):
+            if not data.get('stop_price') or data['stop_price'] <= 0:
+                raise serializers.ValidationError(
+                    "stop_price is required for stop orders"
+                )
+            if data['order_type'] == 'stop_limit' and not data.get('price'):
+                raise serializers.ValidationError(
+                    "price is required for stop_limit orders"
+                )
+        else:
+            data.pop('stop_price', None)
+        if data.get('expires_at'):
+            if data['order_type'] in ('market', 'ioc', 'fok'):
+                raise serializers.ValidationError(
+                    "expires_at is for orders that rest at the book"
+                )
+            if data['expires_at'] <= timezone.now():
+                raise serializers.ValidationError("expires_at has passed")
+        if data.get('display_quantity'):
+            if data['order_type'] not in ('limit', 'stop_limit'):
+                raise serializers.ValidationError(
+                    "display_quantity is for limit orders"
+                )
+            if not 0 < data['display_quantity'] < data['quantity']:
+                raise serializers.ValidationError(
+                    "display_quantity must be less than quantity"
+                )
+        return data
 
     def host_order(self):
         """
@@ -125,18 +215,25 @@ class CreateOrderSerializer(serializers.Serializer):
             "order_type": "limit",
             "price": "0.125"
             "quantity": "4",
+            "stop_price": "0.13" - stop/stop_limit orders only,
+            "expires_at": 1532677000.0 - good-till-time orders only,
+            "display_quantity": "1" - iceberg orders only,
+            "stp": "cancel_oldest" - self-trade prevention mode
             "initial_quantity": "4",
             "timestamp": 1532590590.3393712
         }
 
         :return: "not enough assets"
+                 ENGINE_BUSY - the engine's queue of the pair is full
                  "invalid data"
                  None - OK
         """
         if self.is_valid():
             if r.get("db_stopped"):
                 return "Sorry, we cannot host orders atm"
-            if self.validated_data['order_type'] == 'market':
+            if engine_is_busy(self.validated_data['pair']):
+                return ENGINE_BUSY
+            if self.validated_data['order_type'] in ('market', 'stop'):
                 self.validated_data['price'] = Decimal(0)
             return create_order(quote=self.validated_data)
             # try:
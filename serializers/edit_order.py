@@ -1,12 +1,17 @@
-import socket
 import json
+from _decimal import Decimal
 
 from django.utils import timezone
 from django.conf import settings
 from rest_framework import serializers
 from orders.order_matching_engine.utils import r, get_order_from_redis
 from orders.models import Order
-from .utils import positive_id, dec_to_str
+from .utils import (positive_id, dec_to_str, engine_is_busy,
+                    send_to_engine, ENGINE_BUSY)
+
+
+# the smallest quantity/price of decimal_places, 0 or less is not an edit
+MIN_STEP = Decimal('0.0000000001')
 
 
 class EditOrderSerializer(serializers.Serializer):
@@ -14,11 +19,11 @@ class EditOrderSerializer(serializers.Serializer):
     pair = serializers.ChoiceField(required=True, choices=settings.PAIRS)
     edited_quantity = serializers.DecimalField(
         required=False,
-        decimal_places=10, max_digits=18
+        decimal_places=10, max_digits=18, min_value=MIN_STEP
     )
     edited_price = serializers.DecimalField(
         required=False,
-        decimal_places=10, max_digits=18
+        decimal_places=10, max_digits=18, min_value=MIN_STEP
     )
 
     def edit_order(self):
@@ -31,6 +36,9 @@ class EditOrderSerializer(serializers.Serializer):
             if not (edited_quantity or edited_price):
                 return "You have to edit one of the fields"
 
+            if engine_is_busy(pair):
+                return ENGINE_BUSY
+
             order = get_order_from_redis(former_order_id)
             if not order:
                 return "Order was already completed/cancelled/edited"
@@ -44,8 +52,7 @@ class EditOrderSerializer(serializers.Serializer):
             }
 
             edited_quote = json.dumps(edited_quote)
-            sock = socket.socket()
-            sock.connect(('localhost', settings.SOCKET_PAIR_PORTS[pair]))
-            sock.send(edited_quote.encode())
+            if not send_to_engine(pair, edited_quote):
+                return ENGINE_BUSY
         else:
             return str(self.errors)
@@ -68,8 +68,41 @@ class GraphicOrderSerializer(serializers.Serializer):
         fields = ("graphic",)
 
 class BooksOrderSerializer(serializers.Serializer):
+    pair = serializers.CharField(read_only=True)
+    seq = serializers.IntegerField(read_only=True)
+    timestamp = serializers.FloatField(read_only=True)
+    band = serializers.CharField(read_only=True, allow_null=True)
     bids = serializers.JSONField(read_only=True)
     asks = serializers.JSONField(read_only=True)
 
     class Meta:
-        fields = ("bids", "asks")
+        fields = ("pair", "seq", "timestamp", "band", "bids", "asks")
+
+class RecentTradesSerializer(serializers.Serializer):
+    trades = serializers.JSONField(read_only=True)
+    next_before = serializers.IntegerField(read_only=True)
+
+    class Meta:
+        fields = ("trades", "next_before")
+
+class QuoteEstimateSerializer(serializers.Serializer):
+    pair = serializers.CharField(read_only=True)
+    side = serializers.CharField(read_only=True)
+    quantity = serializers.CharField(read_only=True)
+    filled = serializers.CharField(read_only=True)
+    notional = serializers.CharField(read_only=True)
+    vwap = serializers.CharField(read_only=True, allow_null=True)
+    worst_price = serializers.CharField(read_only=True, allow_null=True)
+    commission = serializers.CharField(read_only=True)
+
+    class Meta:
+        fields = ("pair", "side", "quantity", "filled", "notional", "vwap",
+                  "worst_price", "commission")
+
+class LatencySerializer(serializers.Serializer):
+    pair = serializers.CharField(read_only=True)
+    engine = serializers.JSONField(read_only=True)
+    writer = serializers.JSONField(read_only=True)
+
+    class Meta:
+        fields = ("pair", "engine", "writer")
@@ -1,6 +1,11 @@
-from _decimal import Decimal
+import socket
 
+from django.conf import settings
 from rest_framework import serializers
+from orders.order_matching_engine.utils import r, dec_to_str
+
+
+ENGINE_BUSY = "The engine of the pair is busy, try again later"
 
 
 def positive_id(value):
@@ -10,15 +15,6 @@ def positive_id(value):
         raise serializers.ValidationError('order_id interval (0, +INF)')
 
 
-def dec_to_str(quote):
-    another_quote = {}
-    another_quote.update(quote)
-    for key, value in another_quote.items():
-        if isinstance(value, Decimal):
-            another_quote[key] = str(value)
-    return another_quote
-
-
 def str_to_dec(quote):
     another_quote = {}
     another_quote.update(quote)
@@ -28,5 +24,29 @@ def str_to_dec(quote):
     return another_quote
 
 
+def engine_is_busy(pair):
+    """The engine shed orders of the pair during the last BUSY_FLAG_TTL"""
+    return bool(r.get(f"{pair}_busy"))
+
+
+def send_to_engine(pair, message):
+    """
+    Send the json message to the engine of the pair and wait for its answer
+    :return: False - the engine's queue is full, the message was shed
+    """
+    sock = socket.socket()
+    sock.settimeout(getattr(settings, "ENGINE_REPLY_TIMEOUT", 1))
+    sock.connect(('localhost', settings.SOCKET_PAIR_PORTS[pair]))
+    try:
+        sock.sendall(message.encode())
+        reply = sock.recv(16)
+    except socket.timeout:
+        # sent, but not answered - it's at the queue as before
+        return True
+    finally:
+        sock.close()
+    return reply != b'BUSY'
+
+
 if __name__ == '__main__':
     pass
@@ -1,9 +1,10 @@
 import datetime
+import json
 import random
-import dateutils
+from decimal import Decimal, InvalidOperation
 import logging
 from django.conf import settings
-from django.db.models import Sum, Max, Min, Count
+from django.db.models import Count
 from django.shortcuts import get_object_or_404
 from django.utils import timezone
 from rest_framework.generics import (CreateAPIView, RetrieveAPIView,
@@ -12,17 +13,25 @@ from rest_framework.exceptions import APIException
 from rest_framework.response import Response
 from rest_framework.permissions import AllowAny
 from .serializers import (CreateOrderSerializer, CancelOrderSerializer,
+                          CancelAllOrdersSerializer,
                           MarketsListSerializer, MarketDetailSerializer,
                           EditOrderSerializer, ActiveUserOrdersSerializer,
                           AllUserOrdersSerializer, SliderSerializer)
 
+from .serializers.utils import ENGINE_BUSY
 from .serializers.pairs_info import (GraphicOrderSerializer, PairInfoSerializer,
-                                     BooksOrderSerializer)
+                                     BooksOrderSerializer, RecentTradesSerializer,
+                                     QuoteEstimateSerializer, LatencySerializer)
 
 
 from .models import Order
 from posts.models import Post
 from .order_matching_engine.utils import r
+from .order_matching_engine.candles import get_candles
+from .order_matching_engine.depth import estimate_sweep
+from .order_matching_engine.ticker import get_ticker, get_tickers
+from .order_matching_engine.trade_log import get_trades
+from .order_matching_engine.histogram import get_latency
 
 
 PAIRS = getattr(settings, "PAIRS", ('BTC_ETH', 'BTC_XRP', 'BTC_EOS', 'BTC_NEO',
@@ -67,9 +76,13 @@ class CreateOrderView(CreateAPIView):
             context=self.get_serializer_context()
         )
         error = serializer.host_order()
+        if error == ENGINE_BUSY:
+            return Response({"error": error}, status=503)
         if error:
             return Response({"error": error}, status=400)
-        return Response(status=200)
+        # id of the created order to cancel/edit it and follow it in RDB
+        return Response({"order_id": serializer.validated_data.get('order_id')},
+                        status=200)
 
 
 class CancelOrderView(CreateAPIView):
@@ -92,6 +105,29 @@ class CancelOrderView(CreateAPIView):
         return Response(status=200)
 
 
+class CancelAllOrdersView(CreateAPIView):
+    """
+    Отмена всех ордеров пользователя в стакане пары
+    (side - только одной стороны):
+    ---
+        {
+            "user_id": 1,
+            "pair": "BTC_ETH",
+            "side": "bid"
+        }
+    ---
+    """
+    permission_classes = (AllowAny,)
+    serializer_class = CancelAllOrdersSerializer
+
+    def create(self, request, *args, **kwargs):
+        serializer = self.serializer_class(data=request.data)
+        error = serializer.cancel_orders()
+        if error:
+            return Response({"error": error}, status=400)
+        return Response(status=200)
+
+
 class EditOrderView(CreateAPIView):
     """
     Изменение ордера:
@@ -109,6 +145,8 @@ class EditOrderView(CreateAPIView):
     def create(self, request, *args, **kwargs):
         serializer = self.serializer_class(data=request.data)
         error = serializer.edit_order()
+        if error == ENGINE_BUSY:
+            return Response({"error": error}, status=503)
         if error:
             return Response({"error": error})
         return Response(status=200)
@@ -185,15 +223,11 @@ class SliderOrdersView(RetrieveAPIView):
     permission_classes = (AllowAny,)
 
     def get_object(self):
-        queryset = self.get_queryset()
         random_currency = random.choice(settings.CURRENCIES)
-        last_price = 0.0
-        total_quantity = 0.0
         pairs = list(filter(lambda x: random_currency in x.split("_"), PAIRS))
-        queryset = queryset.filter(pair__in=pairs, created_at__gte=datetime.datetime.now() + dateutils.relativedelta(hours=-24))
-        if queryset.exists():
-            total_quantity = queryset.aggregate(Sum("quantity"))["quantity__sum"]
-            last_price = queryset.reverse()[0].price
+        tickers = get_tickers(pairs).values()
+        total_quantity = sum(ticker["volume"] for ticker in tickers)
+        last_price = max(tickers, key=lambda ticker: ticker["last_trade_time"])["last_price"] if tickers else 0.0
         return {"order": {"currency": random_currency, "last_price": last_price, "volume": total_quantity}, "post": Post.objects.filter(language=self.lang, visible=True)}
 
     def retrieve(self, request, *args, **kwargs):
@@ -213,34 +247,8 @@ class PairInfoView(ListAPIView):
 
     def get_queryset(self):
         if self.pair in settings.PAIRS:
-            percent_change = 0.0
-            last_price = 0.0
-            percent_spread = 0.0
-            orders = self.queryset
-            pair = self.pair
-            previous_orders = orders.filter(pair=pair, created_at__gte=datetime.datetime.now() + dateutils.relativedelta(hours=-48), created_at__lt=datetime.datetime.now() + dateutils.relativedelta(hours=-24)).exclude(status__in=('completed', 'cancelled')).order_by("-created_at")
-            orders = orders.filter(pair=pair, created_at__gte=datetime.datetime.now() + dateutils.relativedelta(hours=-24)).exclude(status__in=('completed', 'cancelled')).order_by("-created_at")
-            bids_order = orders.filter(side="bid")
-            asks_order = orders.filter(side="ask")
-            volume = bids_order.aggregate(Sum("quantity"))["quantity__sum"] or 0
-            max_price = bids_order.aggregate(Max("price"))["price__max"] or 0
-            min_price = bids_order.aggregate(Min("price"))["price__min"] or 0
-            best_bid_price = max_price or 0
-            best_ask_price = asks_order.aggregate(Min("price"))["price__min"] or 0
-            spread = best_ask_price - best_bid_price
-            if bids_order.count():
-                last_order = bids_order[0]
-                last_price = last_order.price or 0
-                if previous_orders.count():
-                    last_prev_price = previous_orders.filter(side="bid")[0].price
-                    if last_prev_price:
-                        percent_change = (last_price-last_prev_price) * 100/last_prev_price
-                    previous_best_bid_price = previous_orders.filter(side="bid").aggregate(Max("price"))["price__max"] or 0
-                    previous_best_ask_price = previous_orders.filter(side="ask").aggregate(Min("price"))["price__min"] or 0
-                    previous_spread = previous_best_ask_price - previous_best_bid_price
-                    if previous_spread:
-                        percent_spread = (spread - previous_spread) * 100/previous_spread
-            return {"currency": pair.split("_")[-1], "volume": float(volume), "change": percent_change, "last_price": float(last_price), "day_high": float(max_price), "day_low": float(min_price), "spread": percent_spread}
+            ticker = get_ticker(self.pair)
+            return {"currency": self.pair.split("_")[-1], "volume": ticker["volume"], "change": ticker["change"], "last_price": ticker["last_price"], "day_high": ticker["high"], "day_low": ticker["low"], "spread": ticker["spread"]}
         else:
             raise APIException("Unknown pair")
 
@@ -275,71 +283,178 @@ class GraphicOrderView(RetrieveAPIView):
         super().__init__(*args, **kwargs)
 
     def get_info(self, *args, **kwargs):
-        queryset = Order.objects.filter(pair=self.pair, created_at__gte=timezone.now() - datetime.timedelta(hours=24), created_at__lte=timezone.now()).exclude(status__in=('completed', 'cancelled')).order_by("-created_at")
-        bid_orders = queryset.filter(side="bid")
-        ask_orders = queryset.filter(side="ask")
-        total_quantity_bid = bid_orders.aggregate(Sum("quantity"))["quantity__sum"] or 0
-        last_bid_price = bid_orders.first().price if bid_orders.exists() else 0
-        last_ask_price = ask_orders.first().price if ask_orders.exists() else 0
-        max_bid_price = bid_orders.aggregate(Max("price"))["price__max"] or 0
-        min_bid_price = bid_orders.aggregate(Min("price"))["price__min"] or 0
-        last_price = Order.objects.filter(status="completed").order_by("-created_at")[0].price
-        return [self.pair in self.request.user.pairs_list, last_price, last_bid_price, last_ask_price, total_quantity_bid, max_bid_price, min_bid_price]
+        ticker = get_ticker(self.pair)
+        return [self.pair in self.request.user.pairs_list, ticker["last_price"], ticker["best_bid"], ticker["best_ask"], ticker["volume"], ticker["high"], ticker["low"]]
 
     def filter_queryset(self, queryset):
         return queryset.filter(pair=self.pair)
 
     def get_object(self):
-        queryset = self.get_queryset()
-        queryset = self.filter_queryset(queryset)
+        if self.pair not in settings.PAIRS:
+            raise APIException("Unknown pair")
+        if self.period not in self._periods:
+            raise APIException("Unknown period")
+        seconds = int(datetime.timedelta(**self._periods[self.period]).total_seconds())
+        end = int(timezone.now().timestamp()) // seconds * seconds
+        start = end - (self.limit - 1) * seconds
+        bars = {bar[0]: bar for bar in get_candles(self.pair, self.period, start, end)}
         graphic_list = []
-        current_datetime = timezone.now()
-        _periods = self._periods
-        if queryset.exists():
-            first_order_date = queryset.first().created_at
-            while current_datetime>=first_order_date:
-                qqq = queryset.filter(created_at__lte=current_datetime, created_at__gte=current_datetime-datetime.timedelta(**_periods[self.period]))
-                if qqq.exists():
-                    open_price = qqq[0].price or 0
-                    last_price = qqq.reverse()[0].price or 0
-                    max_price = qqq.aggregate(Max("price"))["price__max"] or 0
-                    min_price = qqq.aggregate(Min("price"))["price__min"] or 0
-                    # graphic_list.append([open_price, max_price, min_price, last_price])
+        if bars:
+            start = max(start, min(bars))
+            for bar_start in range(end, start - 1, -seconds):
+                date = datetime.datetime.fromtimestamp(bar_start, tz=datetime.timezone.utc)
+                if bar_start in bars:
+                    _, open_price, max_price, min_price, last_price, volume = bars[bar_start]
                     graphic_list.append({"open_price": open_price,
                                          "max_price": max_price,
                                          "min_price": min_price,
                                          "last_price": last_price,
-                                         "date": current_datetime})
+                                         "volume": volume,
+                                         "date": date})
                 else:
-                    # graphic_list.append([0, 0, 0, 0])
                     graphic_list.append({"open_price": 0,
                                          "max_price": 0,
                                          "min_price": 0,
                                          "last_price": 0,
-                                         "date": current_datetime})
-                current_datetime -= datetime.timedelta(**_periods[self.period])
+                                         "volume": 0,
+                                         "date": date})
         return {"graphic": graphic_list}
 
     def retrieve(self, request, *args, **kwargs):
-        self.period = request.GET.get("period")
+        self.period = request.GET.get("period", self.period)
         self.pair = request.GET.get("pair")
+        try:
+            limit = int(request.GET.get("limit", 500))
+        except ValueError:
+            limit = 0
+        if limit < 1:
+            return Response({"error": "limit must be a positive integer"}, status=400)
+        self.limit = min(limit, getattr(settings, "CANDLES_MAX_BARS", 5000))
         return super().retrieve(request, *args, **kwargs)
 
 class BooksOrderView(RetrieveAPIView):
+    """
+    Стакан пары - снапшот, который публикует OrderBook
+    (?pair=BTC_ETH&band=0.01 - уровни сгруппированы с шагом band):
+    ---
+        {
+            "pair": "BTC_ETH",
+            "seq": 1,
+            "timestamp": 1532590590.3393712,
+            "band": null,
+            "bids": [["0.125", "16", 2, "16", "2.000"]],
+            "asks": [["0.126", "8", 1, "8", "1.008"]]
+        }
+    ---
+    Уровень - [цена, объем, кол-во ордеров, накопленный объем, накопленная сумма (цена * объем)]
+    """
     serializer_class = BooksOrderSerializer
 
     def get_object(self):
-        pipe = r.pipeline()
-        orders = r.keys("order_*")
-        bid_orders = []
-        ask_orders = []
-        for order in orders:
-            data_order = r.hgetall(order)
-            data = {}
-            for key, value in data_order.items():
-                data[str(key)] = value
-            if r.hget(order, "side") == b"bid":
-                bid_orders.append(data)
-            elif r.hget(order, "side") == b"ask":
-                ask_orders.append(data)
-        return {"bids": bid_orders, "asks": ask_orders}
+        if self.pair not in settings.PAIRS:
+            raise APIException("Unknown pair")
+        if self.band:
+            snapshot = r.get(f"depth_{self.pair}_{self.band}")
+        else:
+            snapshot = r.get(f"depth_{self.pair}")
+        if not snapshot:
+            return {"pair": self.pair, "seq": 0, "band": self.band, "bids": [], "asks": []}
+        return json.loads(snapshot)
+
+    def retrieve(self, request, *args, **kwargs):
+        self.pair = kwargs.get("pair") or request.GET.get("pair")
+        self.band = request.GET.get("band")
+        if self.band and self.band not in getattr(settings, "DEPTH_BANDS", {}).get(self.pair, ()):
+            raise APIException("Unknown band")
+        return super().retrieve(request, *args, **kwargs)
+
+
+class RecentTradesView(RetrieveAPIView):
+    """
+    Последние сделки пары, от новых к старым:
+    ---
+        ?pair=BTC_ETH&limit=100&before=1234
+    ---
+    Следующая страница - before=next_before
+    """
+    serializer_class = RecentTradesSerializer
+    permission_classes = (AllowAny,)
+
+    def get_object(self):
+        if self.pair not in settings.PAIRS:
+            raise APIException("Unknown pair")
+        trades = [{"seq": trade["seq"], "time": trade["time"], "price": format(trade["price"], "f"), "quantity": format(trade["quantity"], "f"), "side": trade["side"]}
+                  for trade in get_trades(self.pair, self.before, self.limit)]
+        return {"trades": trades, "next_before": trades[-1]["seq"] if trades else None}
+
+    def retrieve(self, request, *args, **kwargs):
+        self.pair = kwargs.get("pair") or request.GET.get("pair")
+        try:
+            limit = int(request.GET.get("limit", 100))
+            self.before = int(request.GET["before"]) if request.GET.get("before") else None
+        except ValueError:
+            return Response({"error": "limit and before must be integers"}, status=400)
+        if limit < 1:
+            return Response({"error": "limit must be a positive integer"}, status=400)
+        self.limit = min(limit, 1000)
+        return super().retrieve(request, *args, **kwargs)
+
+
+class QuoteEstimateView(RetrieveAPIView):
+    """
+    Оценка маркет ордера по опубликованному стакану (bid забирает аски, ask - биды):
+    ---
+        ?pair=BTC_ETH&side=bid&quantity=16
+    ---
+    filled < quantity - в стакане (топ DEPTH_SNAPSHOT_LEVELS уровней) не хватает объема
+    """
+    serializer_class = QuoteEstimateSerializer
+    permission_classes = (AllowAny,)
+
+    def get_object(self):
+        if self.pair not in settings.PAIRS:
+            raise APIException("Unknown pair")
+        if self.side not in settings.SIDES:
+            raise APIException("Unknown side")
+        quantity = self.quantity
+        snapshot = r.get(f"depth_{self.pair}")
+        levels = json.loads(snapshot)["asks" if self.side == "bid" else "bids"] if snapshot else []
+        filled, notional, worst_price = estimate_sweep(levels, quantity)
+        commission = (notional if self.side == "bid" else filled) * Decimal(settings.DEFAULT_COMMISSION)
+        return {"pair": self.pair, "side": self.side, "quantity": str(quantity), "filled": str(filled),
+                "notional": str(notional), "vwap": str(notional / filled) if filled else None,
+                "worst_price": str(worst_price) if worst_price is not None else None,
+                "commission": str(commission)}
+
+    def retrieve(self, request, *args, **kwargs):
+        self.pair = kwargs.get("pair") or request.GET.get("pair")
+        self.side = request.GET.get("side")
+        try:
+            self.quantity = Decimal(request.GET.get("quantity", "0"))
+        except InvalidOperation:
+            self.quantity = None
+        if self.quantity is None or not self.quantity.is_finite() or self.quantity <= 0:
+            return Response({"error": "quantity must be a positive number"}, status=400)
+        return super().retrieve(request, *args, **kwargs)
+
+
+class LatencyView(RetrieveAPIView):
+    """
+    Гистограммы задержек движка пары по этапам (settings.LATENCY_HISTOGRAMS):
+    ---
+        ?pair=BTC_ETH
+    ---
+    Время в микросекундах: count, min, mean, p50, p90, p99, p999, max
+    """
+    serializer_class = LatencySerializer
+    permission_classes = (AllowAny,)
+
+    def get_object(self):
+        if self.pair not in settings.PAIRS:
+            raise APIException("Unknown pair")
+        latency = get_latency(self.pair)
+        return {"pair": self.pair, "engine": latency.get("engine", {}), "writer": latency.get("writer", {})}
+
+    def retrieve(self, request, *args, **kwargs):
+        self.pair = kwargs.get("pair") or request.GET.get("pair")
+        return super().retrieve(request, *args, **kwargs)